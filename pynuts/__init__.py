@@ -9,8 +9,9 @@ from werkzeug.utils import cached_property
 from flask.ext.uploads import configure_uploads, patch_request_class
 from dulwich.repo import Repo
 
-from .environment import alter_environment
-from . import document, rights, view
+from .environment import alter_environment, BlobBytecodeCache
+from .cache import FileSystemCache
+from . import document, rights, view, git, jobs, maintenance
 from .view import auth_url_for
 
 
@@ -36,10 +37,34 @@ class Pynuts(object):
                                    os.path.join(app.instance_path, 'uploads'))
         self.app.config.setdefault('PYNUTS_DOCUMENT_REPOSITORY',
                                    'documents.git')
+        self.app.config.setdefault('PYNUTS_GIT_CACHE_SIZE',
+                                   git.OBJECT_CACHE_SIZE)
+        self.app.config.setdefault('PYNUTS_ENVIRONMENT_POOL_SIZE', 64)
+        self.app.config.setdefault('PYNUTS_BYTECODE_CACHE', None)
+        self.app.config.setdefault('PYNUTS_PDF_CACHE', None)
+        self.app.config.setdefault('PYNUTS_PDF_WORKERS', 0)
+        self.app.config.setdefault('PYNUTS_PDF_JOBS', False)
+        self.app.config.setdefault('PYNUTS_PDF_JOBS_DIRECTORY', None)
+        self.app.config.setdefault('PYNUTS_MAINTENANCE_COMMITS', None)
+        self.app.config.setdefault('PYNUTS_MAINTENANCE_INTERVAL', None)
+        self.app.config.setdefault(
+            'PYNUTS_MAINTENANCE_GRACE_PERIOD',
+            maintenance.PRUNE_GRACE_PERIOD)
+        self.app.config.setdefault('PYNUTS_BRANCH_LOCKS', False)
+        self.app.config.setdefault('PYNUTS_BRANCH_LOCK_TIMEOUT', 30)
 
         self.documents = {}
         self.views = {}
 
+        bytecode_cache = self.app.config.get('PYNUTS_BYTECODE_CACHE')
+        if bytecode_cache:
+            bytecode_cache = os.path.join(app.instance_path, bytecode_cache)
+            if not os.path.isdir(bytecode_cache):
+                os.makedirs(bytecode_cache)
+            self.bytecode_cache = BlobBytecodeCache(bytecode_cache)
+        else:
+            self.bytecode_cache = None
+
         # Serve files from the Pynuts static folder
         # at the /_pynuts/static/<path:filename> URL
         self.app.add_url_rule('/_pynuts/static/<path:filename>',
@@ -48,11 +73,40 @@ class Pynuts(object):
             '/_pynuts/update_content', '_pynuts-update_content',
             lambda: document.update_content(self),
             methods=('POST',))
+        if self.app.config['PYNUTS_PDF_JOBS']:
+            self.app.add_url_rule(
+                '/_pynuts/pdf_jobs', '_pynuts-submit_pdf_job',
+                lambda: jobs.submit_pdf_job(self), methods=('POST',))
+            self.app.add_url_rule(
+                '/_pynuts/pdf_jobs/<job_id>', '_pynuts-pdf_job_status',
+                lambda job_id: jobs.pdf_job_status(self, job_id))
+            self.app.add_url_rule(
+                '/_pynuts/pdf_jobs/<job_id>/pdf', '_pynuts-pdf_job_result',
+                lambda job_id: jobs.pdf_job_result(self, job_id))
+        jobs_directory = self.app.config['PYNUTS_PDF_JOBS_DIRECTORY']
+        self.pdf_jobs = jobs.PDFJobs(
+            self, self.app.config['PYNUTS_PDF_WORKERS'],
+            store=FileSystemCache(
+                os.path.join(app.instance_path, jobs_directory),
+                suffix='.job') if jobs_directory else None)
+        self.maintenance = maintenance.Maintenance(
+            self, self.app.config['PYNUTS_MAINTENANCE_COMMITS'],
+            self.app.config['PYNUTS_MAINTENANCE_INTERVAL'],
+            self.app.config['PYNUTS_MAINTENANCE_GRACE_PERIOD'])
+        #: `pynuts.git.LockManager` of the document repository, or ``None``
+        self.lock_manager = None
 
         class Document(document.Document):
             """Document base class of the application."""
             _pynuts = self
             _app = self.app
+            environment_pool = document.EnvironmentPool(
+                self.app.config['PYNUTS_ENVIRONMENT_POOL_SIZE'])
+
+        pdf_cache = self.app.config.get('PYNUTS_PDF_CACHE')
+        if pdf_cache:
+            Document.pdf_cache = FileSystemCache(
+                os.path.join(app.instance_path, pdf_cache), suffix='.pdf')
 
         self.Document = Document
 
@@ -90,7 +144,7 @@ class Pynuts(object):
             # Create a new Jinja2 environment with Pynuts helpers
             environment = self.app.jinja_env
 
-        alter_environment(self.app.jinja_env)
+        alter_environment(self.app.jinja_env, self.bytecode_cache)
 
         self.app.jinja_env.globals.update({'pynuts': self})
         self.app.jinja_env.globals.update({'auth_url_for': auth_url_for})
@@ -124,16 +178,52 @@ class Pynuts(object):
         # If document_repository_path does not exist,
         # create it (and possible parent folders) and initialize the bare repo
         if os.path.exists(self.document_repository_path):
-            return Repo(self.document_repository_path)
+            repository = Repo(self.document_repository_path)
         else:
             os.makedirs(self.document_repository_path)
-            return Repo.init_bare(self.document_repository_path)
+            repository = Repo.init_bare(self.document_repository_path)
+        git.object_cache(
+            repository, self.app.config.get('PYNUTS_GIT_CACHE_SIZE'))
+        # A new application replaces the maintenance of the previous one
+        if self.maintenance.commits or self.maintenance.interval:
+            git.add_commit_hook(
+                repository, self.maintenance.commit_hook, 'pynuts.maintenance')
+        else:
+            git.remove_commit_hook(repository, 'pynuts.maintenance')
+        if self.app.config['PYNUTS_BRANCH_LOCKS']:
+            self.lock_manager = git.LockManager(
+                repository, self.app.config['PYNUTS_BRANCH_LOCK_TIMEOUT'])
+            git.set_lock_manager(repository, self.lock_manager)
+        return repository
 
     def render_rest(self, document_type, part='index.rst.jinja2',
                     **kwargs):
         """Return the generated ReST version of the document."""
         return self.documents[document_type].generate_rest(part, **kwargs)
 
+    def warm_bytecode_cache(self):
+        """Compile the templates of the latest version of every document.
+
+        With a `PYNUTS_BYTECODE_CACHE` directory, this fills the bytecode
+        cache, for example before starting the application workers.
+
+        Return the number of templates compiled.
+
+        """
+        return sum(
+            document_class.warm_bytecode_cache()
+            for document_class in self.documents.values())
+
+    def maintain_repository(self):
+        """Pack the objects and the refs of the document repository, and
+        remove its unreachable objects.
+
+        Return a dict of counters, or ``None`` if a maintenance is already
+        running. See :mod:`pynuts.maintenance`.
+
+        """
+        return self.maintenance.run()
+
     def create_context(self):
         """Create the request context."""
         flask.g.context = self._context_class()
@@ -0,0 +1,161 @@
+"""Caches for Pynuts."""
+
+import os
+import json
+import errno
+import shutil
+import tempfile
+import weakref
+import threading
+import cPickle as pickle
+from hashlib import sha1
+from collections import OrderedDict
+
+
+#: All the LRU caches, see `after_fork`
+_lru_caches = weakref.WeakSet()
+
+
+def after_fork():
+    """Reset the locks of the LRU caches in a process forked from a
+    multi-threaded process, where other threads may hold them.
+
+    """
+    for cache in list(_lru_caches):
+        cache._lock = threading.Lock()
+
+
+def cache_key(*values):
+    """Return a stable hash of `values`, serializable as JSON.
+
+    :raises TypeError, ValueError: if `values` can't be serialized
+
+    """
+    return sha1(json.dumps(
+        values, sort_keys=True, separators=(',', ':'))).hexdigest()
+
+
+class LRUCache(object):
+    """Thread-safe cache discarding the least recently used values first.
+
+    :param max_size: maximum total size of the cached values
+    :param sizeof: function returning the size of a value. If not given,
+        each value has a size of 1 and `max_size` is a number of values.
+
+    Values bigger than `max_size` are never cached.
+
+    """
+    def __init__(self, max_size, sizeof=None):
+        self.max_size = max_size
+        self.sizeof = sizeof or (lambda value: 1)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._values = OrderedDict()
+        self._lock = threading.Lock()
+        _lru_caches.add(self)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __contains__(self, key):
+        return key in self._values
+
+    def get(self, key, default=None):
+        """Return the value cached for `key`, or `default`."""
+        with self._lock:
+            try:
+                value, size = self._values.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            # Move the value to the most recently used end
+            self._values[key] = value, size
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        """Cache `value` for `key`, evicting old values if needed."""
+        size = self.sizeof(value)
+        if size > self.max_size:
+            return
+        with self._lock:
+            if key in self._values:
+                self.size -= self._values.pop(key)[1]
+            self._values[key] = value, size
+            self.size += size
+            while self.size > self.max_size:
+                _, (_, old_size) = self._values.popitem(last=False)
+                self.size -= old_size
+
+    def clear(self):
+        """Remove all the cached values and reset the counters."""
+        with self._lock:
+            self._values.clear()
+            self.size = self.hits = self.misses = 0
+
+    def stats(self):
+        """Return a dict of counters about the cache usage."""
+        return {
+            'hits': self.hits, 'misses': self.misses,
+            'entries': len(self._values),
+            'size': self.size, 'max_size': self.max_size}
+
+
+class FileSystemCache(object):
+    """Cache storing pickled values in the files of `directory`.
+
+    The cache can be shared between processes. It is not bounded, the
+    directory may be cleaned when needed.
+
+    :param directory: the directory where the values are stored
+    :param suffix: the suffix of the file names
+
+    Keys must be valid file names, as returned by `cache_key`.
+
+    """
+    def __init__(self, directory, suffix='.cache'):
+        self.directory = directory
+        self.suffix = suffix
+        self.hits = 0
+        self.misses = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _filename(self, key):
+        """Return the name of the file storing the value of `key`."""
+        return os.path.join(self.directory, key + self.suffix)
+
+    def __contains__(self, key):
+        return os.path.exists(self._filename(key))
+
+    def get(self, key, default=None):
+        """Return the value cached for `key`, or `default`."""
+        try:
+            with open(self._filename(key), 'rb') as cache_file:
+                value = pickle.load(cache_file)
+        except IOError as exception:
+            if exception.errno != errno.ENOENT:
+                raise
+            self.misses += 1
+            return default
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        """Cache `value` for `key`."""
+        # Other processes may be reading the cache: write atomically
+        fd, temp_filename = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(fd, 'wb') as cache_file:
+            pickle.dump(value, cache_file, pickle.HIGHEST_PROTOCOL)
+        os.rename(temp_filename, self._filename(key))
+
+    def clear(self):
+        """Remove all the cached values and reset the counters."""
+        shutil.rmtree(self.directory)
+        os.makedirs(self.directory)
+        self.hits = self.misses = 0
+
+    def stats(self):
+        """Return a dict of counters about the cache usage."""
+        return {'hits': self.hits, 'misses': self.misses}
@@ -5,9 +5,17 @@ import json
 from docutils.parsers.rst import directives, Directive
 import docutils.core
 
+from .document import DocumentRegistry
 from .git import NotFoundError
 
 
+def _registry(settings):
+    """Return the `DocumentRegistry` of the rendering using `settings`."""
+    if getattr(settings, '_documents', None) is None:
+        settings._documents = DocumentRegistry(settings._pynuts)
+    return settings._documents
+
+
 class Editable(Directive):
     """A rest directive which creates a contenteditable in HTML.
 
@@ -33,10 +41,9 @@ class Editable(Directive):
     def run(self):
         document_type, document_id, version, part = \
             self.arguments[0].split('/')
-        cls = self.state.document.settings._pynuts.documents[document_type]
-        document = cls(document_id, version)
+        registry = _registry(self.state.document.settings)
         try:
-            content = document.git.read(part).decode('utf-8')
+            content = registry.read(document_type, document_id, version, part)
         except NotFoundError:
             content = '\n'.join(self.content)
             content = docutils.core.publish_parts(
@@ -99,10 +106,10 @@ class Content(Directive):
     def run(self):
         document_type, document_id, version, part = \
             self.arguments[0].split('/')
-        cls = self.state.document.settings._pynuts.documents[document_type]
-        document = cls(document_id, version)
+        registry = _registry(self.state.document.settings)
+        document = registry.document(document_type, document_id, version)
         try:
-            content = document.git.read(part).decode('utf-8')
+            content = registry.read(document_type, document_id, version, part)
         except NotFoundError:
             content = '\n'.join(self.content)
 
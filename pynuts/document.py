@@ -1,26 +1,255 @@
 """Document file for Pynuts."""
 
 import os
+import re
+import time
+import zipfile
+import calendar
 import datetime
+import threading
+from collections import namedtuple
+from hashlib import sha1
 import docutils
 import jinja2
 import docutils.core
 import mimetypes
 from urllib import quote, unquote
+from urlparse import urljoin
 from flask import (Response, render_template, request, redirect, flash,
-                   url_for, jsonify)
+                   url_for, jsonify, abort)
 from werkzeug.datastructures import Headers
-from flask_weasyprint import HTML
+from werkzeug.http import unquote_etag
+from werkzeug.utils import cached_property
+from werkzeug.wsgi import wrap_file
+from flask_weasyprint import HTML, CSS, make_url_fetcher
 from docutils_html5 import Writer
 
+from .cache import LRUCache, cache_key
 from .environment import create_environment
-from .git import Git, ConflictError
+from .git import (
+    CHUNK_SIZE, Git, ConflictError, MergeConflictError, NotFoundError,
+    ObjectTypeError, add_packed_refs, read_object, ref_index)
+
+
+#: Time in seconds during which the resources of a document version can be
+#: cached. Versions are immutable.
+RESOURCE_MAX_AGE = 365 * 24 * 60 * 60
+
+#: Parsed stylesheets shared by the documents generated in batches
+_stylesheets = LRUCache(32)
+
+_sha_re = re.compile('^[0-9a-f]{40}$')
+
+# URLs referenced by a stylesheet, and URLs not depending on the base URL
+_css_reference_re = re.compile(
+    r'''(?:url\(\s*|@import\s+(?!url\())['"]?([^'")\s;]+)''', re.IGNORECASE)
+_absolute_url_re = re.compile(r'^([a-z][a-z0-9+.-]*:|/)', re.IGNORECASE)
+
+# Arguments of the Editable and Content directives in a ReST source
+_directive_re = re.compile(
+    r'^\s*\.\.\s+(?:editable|content)::\s*(.+?)\s*$', re.MULTILINE)
 
 
 class InvalidId(ValueError):
     """The '/' character is not allowed in document identifiers."""
 
 
+def _directory_fingerprint(root):
+    """Return a hash changing when the files under `root` are added,
+    removed or modified, or ``None`` if a file has been modified too
+    recently for its modification time to be trusted.
+
+    """
+    entries = []
+    now = time.time()
+    for directory, directories, filenames in os.walk(root, followlinks=True):
+        directories.sort()
+        for name in sorted(filenames):
+            path = os.path.join(directory, name)
+            try:
+                stat_result = os.stat(path)
+            except OSError:
+                # Broken link, ignored by Git.store_directory
+                continue
+            if now - stat_result.st_mtime < 1:
+                return None
+            entries.append((
+                os.path.relpath(path, root), stat_result.st_mtime,
+                stat_result.st_size))
+    return cache_key(entries)
+
+
+def _file_range(blob_file, start, stop):
+    """Yield by chunks the bytes of `blob_file` from `start` to `stop`,
+    and close it.
+
+    """
+    try:
+        position = 0
+        while position < stop:
+            chunk = blob_file.read(min(CHUNK_SIZE, stop - position))
+            if not chunk:
+                break
+            if position + len(chunk) > start:
+                yield chunk[max(0, start - position):]
+            position += len(chunk)
+    finally:
+        blob_file.close()
+
+
+def _skipping_url_fetcher(skipped_url):
+    """Return a WeasyPrint URL fetcher giving an empty stylesheet for
+    `skipped_url`, relative to the current request, and fetching the other
+    URLs as Flask-WeasyPrint does.
+
+    """
+    url_fetcher = make_url_fetcher()
+    skipped_url = urljoin(request.url, skipped_url)
+
+    def fetcher(url):
+        if url == skipped_url:
+            return {'string': '', 'mime_type': 'text/css'}
+        return url_fetcher(url)
+    return fetcher
+
+
+class DocumentRegistry(object):
+    """Documents shared by the directives of one rendering.
+
+    The Editable and Content directives get their documents and parts from
+    the registry in the ``_documents`` docutils setting: a document is
+    built once for each ``(type, id, version)``, and its parts are read
+    once.
+
+    :param pynuts: the Pynuts application
+
+    """
+    def __init__(self, pynuts):
+        self.pynuts = pynuts
+        self._documents = {}
+        self._contents = {}
+
+    def document(self, document_type, document_id, version):
+        """Return the shared document `document_id` of `document_type` at
+        `version`.
+
+        """
+        key = document_type, document_id, version
+        document = self._documents.get(key)
+        if document is None:
+            document = self._documents[key] = (
+                self.pynuts.documents[document_type](document_id, version))
+        return document
+
+    def read(self, document_type, document_id, version, part):
+        """Return the content of `part` in the document as an Unicode
+        string.
+
+        :raises: NotFoundError
+
+        """
+        key = document_type, document_id, version
+        contents = self._contents.setdefault(key, {})
+        if part not in contents:
+            git = self.document(document_type, document_id, version).git
+            contents[part] = git.read(part).decode('utf-8')
+        return contents[part]
+
+    def _references(self, source):
+        """Return a dict giving the set of parts used by the directives of
+        the ReST `source` for each ``(type, id, version)`` tuple.
+
+        """
+        parts = {}
+        for argument in _directive_re.findall(source):
+            values = argument.split('/')
+            if len(values) == 4:
+                parts.setdefault(tuple(values[:3]), set()).add(values[3])
+        return parts
+
+    def versions(self, source):
+        """Return a sorted list of ``[type, id, version, sha]`` lists for
+        the documents used by the directives of the ReST `source`, where
+        `sha` is the commit resolved from `version`, or ``None``.
+
+        """
+        versions = []
+        for key in self._references(source):
+            sha = None
+            if key[0] in self.pynuts.documents:
+                try:
+                    head = self.document(*key).git.head
+                except (KeyError, ObjectTypeError):
+                    head = None
+                sha = head.id if head else None
+            versions.append(list(key) + [sha])
+        return sorted(versions)
+
+    def prefetch(self, source):
+        """Read the parts used by the directives of the ReST `source`,
+        with one pass over the tree of each document.
+
+        """
+        for key, paths in self._references(source).items():
+            if key[0] not in self.pynuts.documents:
+                continue
+            contents = self._contents.setdefault(key, {})
+            paths = [path for path in paths if path not in contents]
+            try:
+                git = self.document(*key).git
+                found = git.read_many(paths)
+            except (KeyError, ObjectTypeError):
+                # Reported by the directives
+                continue
+            for path, content in found.items():
+                contents[path] = content.decode('utf-8')
+
+
+class EnvironmentPool(object):
+    """Bounded pool of Jinja environments for documents, keyed by document
+    class and commit.
+
+    Commits are immutable: the templates compiled in an environment can be
+    reused by all the documents of a class at the same version.
+
+    :param max_size: maximum number of environments in the pool
+
+    """
+    def __init__(self, max_size):
+        self.environments = LRUCache(max_size)
+        #: Estimated time saved by reusing compiled templates, in seconds
+        self.compile_time_saved = 0
+        self._lock = threading.Lock()
+
+    def get(self, cls, commit):
+        """Return the environment of the documents of `cls` at `commit`."""
+        key = cls, commit
+        environment = self.environments.get(key)
+        if environment is None:
+            environment = cls.create_jinja_environment(
+                Git(cls._pynuts.document_repository, commit=commit))
+            self.environments.set(key, environment)
+        else:
+            with self._lock:
+                self.compile_time_saved += environment.compile_time
+        return environment
+
+    def stats(self):
+        """Return a dict of counters about the pool usage."""
+        stats = self.environments.stats()
+        with self._lock:
+            stats['compile_time_saved'] = self.compile_time_saved
+        return stats
+
+
+class DocumentSummary(namedtuple(
+        'DocumentSummary', 'document_id version datetime author')):
+    """Description of the latest version of a document, built without
+    creating a `Document`.
+
+    """
+
+
 class MetaDocument(type):
     """Metaclass for document classes."""
     def __init__(cls, name, bases, dict_):
@@ -57,8 +286,20 @@ class Document(object):
     """
     __metaclass__ = MetaDocument
 
-    #: Jinja Environment
-    jinja_environment = None
+    #: Pool of Jinja environments shared by documents on the same commit
+    environment_pool = None
+
+    #: Cache of the rendered HTML parts, for example a
+    #: :class:`pynuts.cache.LRUCache` or a
+    #: :class:`pynuts.cache.FileSystemCache`. Documents are only cached
+    #: when :meth:`render_cache_data` is serializable as JSON. The ReST
+    #: source is generated to find the cached rendering: it includes the
+    #: content of the other documents rendered by the templates, and the
+    #: versions used by its directives are resolved.
+    render_cache = None
+
+    #: Cache of the generated PDF files, see :attr:`render_cache`
+    pdf_cache = None
 
     #: Docutils settings
     docutils_settings = None
@@ -75,6 +316,12 @@ class Document(object):
     #: Model path, absolute or relative to the application root path
     model_path = None
 
+    #: Extensions of the templates stored in documents
+    template_extensions = ('.jinja', '.jinja2')
+
+    # ``(model_path, fingerprint, tree_id)`` of the last stored model
+    _model_tree = None
+
     # Templates
     edit_template = '_pynuts/edit_document.jinja2'
 
@@ -83,16 +330,7 @@ class Document(object):
             raise InvalidId("The '/' character is not allowed in "
                             "document identifiers.")
         self.document_id = document_id
-        self.git = Git(
-            self._pynuts.document_repository, branch=self.branch,
-            commit=version)
-        self.archive_git = Git(
-            self._pynuts.document_repository, branch=self.archive_branch)
-
-        loader = self.git.jinja_loader()
-        self.jinja_environment = create_environment(loader)
-        self.jinja_environment.globals['render_rest'] = \
-            self._pynuts.render_rest
+        self._version = version
         # Take the class attribute
         docutils_settings = dict(self.docutils_settings or {})
         docutils_settings['_pynuts'] = self._pynuts
@@ -100,17 +338,106 @@ class Document(object):
         self.docutils_settings = docutils_settings
         self.data = None
 
+    @cached_property
+    def git(self):
+        """Git object of the document branch, at the document version."""
+        return Git(
+            self._pynuts.document_repository, branch=self.branch,
+            commit=self._version)
+
+    @cached_property
+    def archive_git(self):
+        """Git object of the document archives branch."""
+        return Git(
+            self._pynuts.document_repository, branch=self.archive_branch)
+
+    @cached_property
+    def jinja_environment(self):
+        """Jinja environment loading templates from the document version."""
+        if self.environment_pool is not None and self.git.head:
+            return self.environment_pool.get(type(self), self.git.head.id)
+        return self.create_jinja_environment(self.git)
+
+    @classmethod
+    def create_jinja_environment(cls, git):
+        """Create the Jinja environment loading templates from `git`."""
+        environment = create_environment(
+            git.jinja_loader(), cls._pynuts.bytecode_cache)
+        environment.globals['render_rest'] = cls._pynuts.render_rest
+        return environment
+
     @classmethod
-    def list_document_ids(cls):
-        """Return a list of document ids."""
+    def warm_bytecode_cache(cls):
+        """Compile the templates of the latest version of the documents.
+
+        Return the number of templates compiled.
+
+        """
+        count = 0
+        for document in cls.list_documents():
+            for path in document.git.list_paths():
+                if os.path.splitext(path)[1] not in cls.template_extensions:
+                    continue
+                try:
+                    document.jinja_environment.get_template(
+                        path.decode('utf-8'))
+                except jinja2.TemplateSyntaxError:
+                    # Reported when the template is rendered
+                    continue
+                count += 1
+        return count
+
+    @classmethod
+    def _list_heads(cls, offset=0, limit=None, prefix=None):
+        """Return a sorted list of ``(document_id, version)`` tuples."""
         base = 'refs/heads/documents/' + quote(cls.type_name.encode('utf8'))
-        for doc_id in cls._pynuts.document_repository.refs.keys(base=base):
-            yield unquote(doc_id).decode('utf8')
+        refs = ref_index(cls._pynuts.document_repository, base).refs()
+        heads = sorted(
+            (unquote(name).decode('utf8'), sha)
+            for name, sha in refs.items())
+        if prefix:
+            heads = [head for head in heads if head[0].startswith(prefix)]
+        return heads[offset:None if limit is None else offset + limit]
+
+    @classmethod
+    def list_document_ids(cls, offset=0, limit=None, prefix=None):
+        """Return a sorted list of document ids.
+
+        :param offset: number of document ids to skip
+        :param limit: maximum number of document ids to return
+        :param prefix: only return the document ids starting with `prefix`
+
+        """
+        return [document_id for document_id, _ in cls._list_heads(
+            offset=offset, limit=limit, prefix=prefix)]
+
+    @classmethod
+    def list_documents(cls, offset=0, limit=None, prefix=None):
+        """Return the whole document list.
+
+        See :meth:`list_document_ids` for the parameters.
+
+        """
+        return (cls(doc_id) for doc_id in cls.list_document_ids(
+            offset=offset, limit=limit, prefix=prefix))
 
     @classmethod
-    def list_documents(cls):
-        """Return the whole document list."""
-        return (cls(doc_id) for doc_id in cls.list_document_ids())
+    def list_summaries(cls, offset=0, limit=None, prefix=None):
+        """Return a list of :class:`DocumentSummary` objects.
+
+        See :meth:`list_document_ids` for the parameters.
+
+        """
+        repository = cls._pynuts.document_repository
+        summaries = []
+        for document_id, version in cls._list_heads(
+                offset=offset, limit=limit, prefix=prefix):
+            commit = read_object(repository, version)
+            summaries.append(DocumentSummary(
+                document_id, version,
+                datetime.datetime.utcfromtimestamp(commit.commit_time),
+                commit.author.decode('utf-8')))
+        return summaries
 
     @property
     def branch(self):
@@ -162,6 +489,83 @@ class Document(object):
         for version in self.archive_git.history():
             yield type(self)(self.document_id, version=version)
 
+    def history_summaries(self, offset=0, limit=None, since=None,
+                          until=None, archive=False):
+        """Return a list of :class:`DocumentSummary` objects for the
+        versions of the document, from the newest to the oldest.
+
+        The summaries are read from the history index of the branch,
+        without loading the commits.
+
+        :param offset: number of versions skipped
+        :param limit: maximum number of versions returned
+        :param since: only include the versions saved at this UTC naive
+            datetime or after
+        :param until: only include the versions saved at this UTC naive
+            datetime or before
+        :param archive: list the archives of the document if `True`
+
+        """
+        git = Git(self._pynuts.document_repository,
+                  branch=self.archive_branch if archive else self.branch)
+        since, until = [
+            None if value is None else calendar.timegm(value.utctimetuple())
+            for value in (since, until)]
+        return [
+            DocumentSummary(
+                self.document_id, entry.id,
+                datetime.datetime.utcfromtimestamp(entry.commit_time),
+                entry.author.decode('utf-8'))
+            for entry in git.history_entries(offset, limit, since, until)]
+
+    @classmethod
+    def create_many(cls, rows, author_name=None, author_email=None,
+                    message=None):
+        """Create many ReST documents at once.
+
+        The commits of the new documents are written in one pack file, and
+        their branches are added to the packed refs in one transaction.
+
+        Return a list of ``(document_id, version)`` tuples, one for each
+        row. The version is ``None`` if the document id was already used.
+
+        :param rows: an iterable of dicts giving the data of the documents,
+            as the keyword arguments of :meth:`create`
+        :param author_name: commit author name
+        :param author_email: commit author email
+        :param message: commit message
+
+        """
+        repository = cls._pynuts.document_repository
+        git = Git(repository)
+        tree_id = cls.model_tree().id
+        commits, refs, results = {}, {}, []
+        for row in rows:
+            document = cls.from_data(**row)
+            ref = 'refs/heads/' + document.branch
+            if ref in refs:
+                results.append((document.document_id, None))
+                continue
+            commit = git.new_commit(
+                tree_id, author_name or 'Pynuts',
+                author_email or 'pynut@pynuts.org',
+                message or 'Create %s' % document.document_id, parents=[])
+            commits[commit.id] = commit
+            refs[ref] = commit.id
+            results.append((document.document_id, ref))
+        if not refs:
+            return [(document_id, None) for document_id, _ in results]
+        object_store = repository.object_store
+        if not os.path.isdir(object_store.pack_dir):
+            os.makedirs(object_store.pack_dir)
+        object_store.add_objects(
+            [(commit, None) for commit in commits.values()])
+        existing = add_packed_refs(repository, refs)
+        return [
+            (document_id,
+             None if ref is None or ref in existing else refs[ref])
+            for document_id, ref in results]
+
     @classmethod
     def from_data(cls, version=None, **kwargs):
         """Create an instance of the class from the given data."""
@@ -170,6 +574,55 @@ class Document(object):
         instance.data = kwargs
         return instance
 
+    def render_cache_data(self):
+        """Return the data of the document used in the keys of caches.
+
+        The result must be serializable as JSON and must identify all the
+        data used to render the document. Override this method when the
+        data includes other objects, such as model views.
+
+        """
+        return self.data
+
+    def _docutils_settings(self):
+        """Return the Docutils settings used to render the document, with
+        a new `DocumentRegistry`.
+
+        """
+        settings = dict(self.docutils_settings)
+        settings.setdefault('stylesheet', self.resource_url(self.stylesheet))
+        settings['_documents'] = DocumentRegistry(self._pynuts)
+        return settings
+
+    def _cache_key(self, kind, part, archive, editable=True, source=None):
+        """Return the key identifying a rendering of this document in
+        caches, or ``None`` if the document can't be cached.
+
+        The key depends on the ReST `source` of the rendering, generated
+        when not given, and on the versions of the documents used by its
+        directives.
+
+        """
+        git = self.archive_git if archive else self.git
+        if git.head is None:
+            return None
+        if source is None:
+            source = self._generate_rest(
+                part=part, archive=archive, editable=editable)
+        all_settings = self._docutils_settings()
+        settings = dict(
+            (name, value) for name, value in all_settings.items()
+            if not name.startswith('_'))
+        if isinstance(source, unicode):
+            source = source.encode('utf-8')
+        try:
+            return cache_key(
+                kind, self.type_name, git.head.id, part, archive, editable,
+                settings, self.render_cache_data(), sha1(source).hexdigest(),
+                all_settings['_documents'].versions(source))
+        except (TypeError, ValueError):
+            return None
+
     def resource_url(self, filename):
         """Resource URL for the application."""
         return url_for(
@@ -182,14 +635,57 @@ class Document(object):
     def static_route(cls, document_id, filename, version):
         """Serve static files for documents.
 
+        The blob is read from the commit `version`, without building the
+        document. Responses can be cached forever, their ETag is the SHA of
+        the blob. Conditional requests and single range requests are
+        supported.
+
         :param document_id: id of the document
         :param filename: name of the document
         :param version: version of the document
 
         """
+        if not _sha_re.match(version):
+            abort(404)
+        try:
+            git = Git(cls._pynuts.document_repository, commit=version)
+            sha = git.blob_id(filename)
+        except (KeyError, ValueError, NotFoundError, ObjectTypeError):
+            abort(404)
         mimetype, _ = mimetypes.guess_type(filename)
-        return Response(
-            cls(document_id, version).git.read(filename), mimetype=mimetype)
+        headers = Headers({
+            'Cache-Control': 'public, max-age=%i, immutable' % (
+                RESOURCE_MAX_AGE),
+            'Accept-Ranges': 'bytes',
+            'ETag': '"%s"' % sha})
+        if sha in request.if_none_match:
+            return Response(status=304, headers=headers)
+
+        blob_file = git.open(filename)
+        byte_range = request.range
+        if_range = request.headers.get('If-Range')
+        if (byte_range is None or byte_range.units != 'bytes' or
+                len(byte_range.ranges) != 1 or
+                (if_range and unquote_etag(if_range)[0] != sha)):
+            response = Response(
+                wrap_file(request.environ, blob_file), mimetype=mimetype,
+                headers=headers, direct_passthrough=True)
+            response.content_length = blob_file.size
+            return response
+
+        start_stop = byte_range.range_for_length(blob_file.size)
+        if start_stop is None:
+            blob_file.close()
+            headers['Content-Range'] = 'bytes */%i' % blob_file.size
+            return Response(status=416, headers=headers)
+        start, stop = start_stop
+        headers['Content-Range'] = 'bytes %i-%i/%i' % (
+            start, stop - 1, blob_file.size)
+        response = Response(
+            _file_range(blob_file, start, stop), status=206,
+            mimetype=mimetype, headers=headers, direct_passthrough=True)
+        response.content_length = stop - start
+        return response
 
     @classmethod
     def generate_rest(cls, part='index.rst.jinja2', archive=False,
@@ -228,7 +724,7 @@ class Document(object):
             part=part, archive=archive, editable=editable)
 
     def _generate_html(self, part='index.rst.jinja2', archive=False,
-                       editable=True):
+                       editable=True, source=None):
         """Generate the HTML samples of the document.
 
         The output is a dict corresponding to the different HTML samples as
@@ -240,6 +736,8 @@ class Document(object):
             ReST directive and if you need to render html with
             'contenteditable="false"',
             set this parameter to 'False'. For more info see :ref:`api`
+        :param source: the ReST source of the document, generated when not
+            given
 
         .. seealso::
            `Docutils writer publish parts
@@ -248,14 +746,23 @@ class Document(object):
 
         """
         part = 'index.rst' if archive else part
-        source = self._generate_rest(
-            part=part, archive=archive, editable=editable)
-
-        settings = dict(self.docutils_settings)
-        settings.setdefault('stylesheet', self.resource_url(self.stylesheet))
+        if source is None:
+            source = self._generate_rest(
+                part=part, archive=archive, editable=editable)
+        key = None
+        if self.render_cache is not None:
+            key = self._cache_key('html', part, archive, editable, source)
+            if key is not None:
+                parts = self.render_cache.get(key)
+                if parts is not None:
+                    return dict(parts)
+
+        settings = self._docutils_settings()
+        settings['_documents'].prefetch(source)
         parts = docutils.core.publish_parts(
-            source=source, writer=Writer(),
-            settings_overrides=settings)
+            source=source, writer=Writer(), settings_overrides=settings)
+        if key is not None:
+            self.render_cache.set(key, dict(parts))
         return parts
 
     @classmethod
@@ -270,22 +777,118 @@ class Document(object):
         return cls.from_data(version=version, **kwargs)._generate_pdf(
             part=part, archive=archive)
 
-    def _generate_pdf(self, part='index.rst.jinja2', archive=False):
+    def _generate_pdf(self, part='index.rst.jinja2', archive=False,
+                      stylesheets=None, url_fetcher=None, source=None):
         """Generate the PDF version from the document.
 
         :param part: part of the document to render.
         :param archive: return archive content if `True`
+        :param stylesheets: a list of additional WeasyPrint stylesheets
+        :param url_fetcher: an optional WeasyPrint URL fetcher
+        :param source: the ReST source of the document, generated when not
+            given
         """
 
         part = 'index.rst' if archive else part
-        html = self._generate_html(part=part, archive=archive)['whole']
-        return HTML(string=html, encoding='utf8').write_pdf()
+        if source is None:
+            source = self._generate_rest(part=part, archive=archive)
+        key = None
+        if self.pdf_cache is not None:
+            key = self._cache_key('pdf', part, archive, source=source)
+            if key is not None:
+                pdf = self.pdf_cache.get(key)
+                if pdf is not None:
+                    return pdf
+
+        html = self._generate_html(
+            part=part, archive=archive, source=source)['whole']
+        kwargs = {} if url_fetcher is None else {'url_fetcher': url_fetcher}
+        pdf = HTML(string=html, encoding='utf8', **kwargs).write_pdf(
+            stylesheets=stylesheets)
+        if key is not None:
+            self.pdf_cache.set(key, pdf)
+        return pdf
+
+    def _generate_batch_pdf(self, part='index.rst.jinja2', archive=False):
+        """Generate the PDF version from the document, with a parsed
+        stylesheet shared with the other documents generated in batches.
+
+        :param part: part of the document to render.
+        :param archive: return archive content if `True`
+        """
+        if 'stylesheet' in self.docutils_settings:
+            return self._generate_pdf(part=part, archive=archive)
+        try:
+            blob_id = self.git.blob_id(self.stylesheet)
+        except NotFoundError:
+            return self._generate_pdf(part=part, archive=archive)
+        source = self.git.read(self.stylesheet).decode('utf-8')
+        stylesheet_url = self.resource_url(self.stylesheet)
+        key = blob_id
+        if not all(_absolute_url_re.match(url)
+                   for url in _css_reference_re.findall(source)):
+            # Relative URLs are resolved from the URL of the stylesheet
+            key = (blob_id, stylesheet_url)
+        stylesheet = _stylesheets.get(key)
+        if stylesheet is None:
+            stylesheet = CSS(string=source, base_url=stylesheet_url)
+            _stylesheets.set(key, stylesheet)
+        # Give the parsed stylesheet to WeasyPrint instead of fetching and
+        # parsing the linked one, keeping the HTML and the cache keys of
+        # the other renderings
+        return self._generate_pdf(
+            part=part, archive=archive, stylesheets=[stylesheet],
+            url_fetcher=_skipping_url_fetcher(stylesheet_url))
+
+    @classmethod
+    def generate_pdf_batch(cls, documents, part='index.rst.jinja2',
+                           archive=False):
+        """Generate the PDF version of many documents.
+
+        Yield a ``(document_id, pdf)`` tuple for each document, in order.
+        The documents are rendered by the PDF workers of the application
+        when `PYNUTS_PDF_WORKERS` is set, a limited number at a time.
+
+        :param documents: an iterable of document ids, or of dicts of data
+            as given to :meth:`from_data`
+        :param part: part of the documents to render
+        :param archive: render the archives of the documents if `True`
+
+        """
+        return cls._pynuts.pdf_jobs.map(
+            cls, documents, part=part, archive=archive)
+
+    @classmethod
+    def write_pdf_zip(cls, zip_file, documents, part='index.rst.jinja2',
+                      archive=False, filename=u'{0}.pdf'):
+        """Write the PDF version of many documents in a zip file.
+
+        Only one PDF document at a time is kept in memory.
+
+        :param zip_file: a file name, or a seekable file object
+        :param documents: an iterable of document ids, or of dicts of data
+            as given to :meth:`from_data`
+        :param part: part of the documents to render
+        :param archive: render the archives of the documents if `True`
+        :param filename: the template of the names of the PDF files in the
+            zip file, formatted with the document id
+
+        """
+        with zipfile.ZipFile(zip_file, 'w', zipfile.ZIP_DEFLATED) as output:
+            for document_id, pdf in cls.generate_pdf_batch(
+                    documents, part=part, archive=archive):
+                output.writestr(
+                    filename.format(document_id).encode('utf-8'), pdf)
 
     @classmethod
     def download_pdf(cls, part='index.rst.jinja2', version=None, archive=False,
                      filename=None, **kwargs):
         """Get a HTTP response with PDF document as file in attachment.
 
+        The response has an ETag identifying the rendered ReST source of
+        the document, and requests with a matching ``If-None-Match`` header
+        get a "304 Not Modified" response without rendering the PDF.
+
         :param part: part of the document to render
         :param version: version of the document to render
         :param archive: whether to archive the given version of the document
@@ -293,13 +896,24 @@ class Document(object):
 
         """
         part = 'index.rst' if archive else part
+        document = cls.from_data(version=version, **kwargs)
+        source = document._generate_rest(part=part, archive=archive)
+        etag = document._cache_key('pdf', part, archive, source=source)
+        if etag is not None and request.if_none_match.contains(etag):
+            response = Response(status=304)
+            response.set_etag(etag)
+            return response
+
         headers = Headers()
         headers.add(
             'Content-Disposition', 'attachment',
             filename=(filename.encode('utf-8') if filename else None))
-        pdf = cls.generate_pdf(
-            part=part, version=version, archive=archive, **kwargs)
-        return Response(pdf, mimetype='application/pdf', headers=headers)
+        pdf = document._generate_pdf(
+            part=part, archive=archive, source=source)
+        response = Response(pdf, mimetype='application/pdf', headers=headers)
+        if etag is not None:
+            response.set_etag(etag)
+        return response
 
     @classmethod
     def archive(cls, part='index.rst.jinja2', version=None,
@@ -314,9 +928,10 @@ class Document(object):
 
         """
         document = cls.from_data(version=version, **kwargs)
-        document.git.write(
-            os.path.splitext(part)[0],
-            document.generate_rest(part=part, **kwargs).encode('utf-8'))
+        with document.git.batch():
+            document.git.write(
+                os.path.splitext(part)[0],
+                document.generate_rest(part=part, **kwargs).encode('utf-8'))
         git = document.archive_git
         git.tree = document.git.tree
         git.commit(
@@ -328,6 +943,28 @@ class Document(object):
     def update_content(cls):
         return update_content(cls._pynuts)
 
+    @classmethod
+    def model_tree(cls):
+        """Return the tree of the model directory, stored in the document
+        repository.
+
+        The model is only stored again when the modification times or the
+        sizes of its files change.
+
+        """
+        repository = cls._pynuts.document_repository
+        fingerprint = _directory_fingerprint(cls.model_path)
+        if fingerprint is not None and cls._model_tree is not None:
+            model_path, model_fingerprint, tree_id = cls._model_tree
+            if ((model_path, model_fingerprint) ==
+                    (cls.model_path, fingerprint) and
+                    tree_id in repository.object_store):
+                return read_object(repository, tree_id)
+        tree = Git(repository).store_directory(cls.model_path)
+        if fingerprint is not None:
+            cls._model_tree = cls.model_path, fingerprint, tree.id
+        return tree
+
     @classmethod
     def create(cls, author_name=None, author_email=None, message=None,
                **kwargs):
@@ -343,7 +980,7 @@ class Document(object):
         """
         document = cls.from_data(**kwargs)
         git = document.git
-        git.tree = git.store_directory(cls.model_path)
+        git.tree = cls.model_tree()
         git.commit(
             author_name or 'Pynuts',
             author_email or 'pynut@pynuts.org',
@@ -372,14 +1009,19 @@ class Document(object):
             document = cls.from_data(
                 version=request.form['_old_commit'], **kwargs)
             git = document.archive_git if archive else document.git
-            git.write(
-                'index.rst' if archive else part,
-                request.form['document'].encode('utf-8'))
             try:
-                git.commit(
-                    author_name or 'Pynuts',
-                    author_email or 'pynut@pynuts.org',
-                    message or 'Edit %s' % document.document_id)
+                with git.batch():
+                    git.write(
+                        'index.rst' if archive else part,
+                        request.form['document'].encode('utf-8'))
+                    git.commit(
+                        author_name or 'Pynuts',
+                        author_email or 'pynut@pynuts.org',
+                        message or 'Edit %s' % document.document_id,
+                        merge=True)
+            except MergeConflictError as exception:
+                flash('A conflict happened in %s.' % ', '.join(
+                    exception.paths), 'error')
             except ConflictError:
                 flash('A conflict happened.', 'error')
             else:
@@ -506,7 +1148,11 @@ def update_content(pynuts):
     It is used by the javascript/AJAX save function.
     It gets the request as JSON and update all the parts of the document
 
-    return document's information as JSON.
+    return document's information as JSON. The parts changed meanwhile by
+    other commits are merged, the documents whose parts have been changed
+    meanwhile are listed with their conflicting parts in ``conflicts``.
+    Documents that could not be committed for another reason, such as a
+    lock timeout, are listed in ``conflicts`` without parts.
 
     'See the save function<>_' for more details.
 
@@ -518,23 +1164,37 @@ def update_content(pynuts):
     message = request.json['message']
 
     documents = {}
+    parts = {}
     for values in contents:
         key = (values['document_type'], values['document_id'])
-        if key in documents:
-            document = documents[key]
-        else:
+        if key not in documents:
             cls = pynuts.documents[values['document_type']]
-            document = cls(values['document_id'], values['version'])
-            documents[key] = document
-        document.git.write(values['part'],
-                           values['content'].encode('utf-8'))
-    for document in documents.values():
-        document.git.commit(
-            author_name or 'Pynuts',
-            author_email or 'pynut@pynuts.org',
-            message or 'Edit %s' % document.document_id)
+            documents[key] = cls(values['document_id'], values['version'])
+            parts[key] = []
+        parts[key].append(values)
+    conflicts = []
+    for key, document in documents.items():
+        # Build the trees of the document once for all its parts, without
+        # other writers of the document if branch locks are enabled
+        try:
+            with document.git.lock(), document.git.batch():
+                for values in parts[key]:
+                    document.git.write(
+                        values['part'], values['content'].encode('utf-8'))
+                document.git.commit(
+                    author_name or 'Pynuts',
+                    author_email or 'pynut@pynuts.org',
+                    message or 'Edit %s' % document.document_id,
+                    merge=True)
+        except ConflictError as exception:
+            # Merge conflicts list their paths. Branches created meanwhile
+            # and lock timeouts have no path.
+            conflicts.append({
+                'document_type': document.type_name,
+                'document_id': document.document_id,
+                'paths': getattr(exception, 'paths', [])})
     return jsonify(documents=[{
         'document_type': document.type_name,
         'document_id': document.document_id,
         'version': document.version}
-        for document in documents.values()])
+        for document in documents.values()], conflicts=conflicts)
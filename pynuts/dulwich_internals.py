@@ -0,0 +1,126 @@
+"""Internals of Dulwich used by Pynuts.
+
+The repository maintenance and the readers of a repository changed by other
+processes need parts of Dulwich that are not in its public API: its caches
+of packs and packed refs, its loose objects and its pack writer. They are
+only used through these functions, that raise `UnsupportedDulwichError` if
+the installed Dulwich doesn't have them. They are known to work with
+Dulwich 0.9.
+
+"""
+
+import dulwich
+from dulwich.objects import Blob
+
+try:
+    from dulwich.pack import (
+        REF_DELTA, SHA1Writer, deltify_pack_objects, write_pack_header,
+        write_pack_object)
+except ImportError:
+    REF_DELTA = SHA1Writer = deltify_pack_objects = None
+    write_pack_header = write_pack_object = None
+
+
+class UnsupportedDulwichError(RuntimeError):
+    """The installed Dulwich doesn't have an internal used by Pynuts."""
+    def __init__(self, name):
+        super(UnsupportedDulwichError, self).__init__(
+            'Pynuts needs %s, not available in Dulwich %s.' % (
+                name, '.'.join(str(part) for part in getattr(
+                    dulwich, '__version__', ('unknown',)))))
+
+
+def _check(obj, name):
+    """Raise `UnsupportedDulwichError` if `obj` has no `name` attribute."""
+    if not hasattr(obj, name):
+        raise UnsupportedDulwichError(
+            '%s.%s' % (type(obj).__name__, name))
+
+
+def forget_packs(store):
+    """Make the disk object `store` list its packs again when needed."""
+    _check(store, '_pack_cache')
+    store._pack_cache = None
+
+
+def forget_packed_refs(container):
+    """Make the disk refs `container` read its packed refs again when
+    needed.
+
+    """
+    _check(container, '_packed_refs')
+    _check(container, '_peeled_refs')
+    container._packed_refs = container._peeled_refs = None
+
+
+def peeled_refs(container):
+    """Return a dict of the peeled values of the packed refs of
+    `container`, read by its last ``get_packed_refs()`` call.
+
+    """
+    _check(container, '_peeled_refs')
+    return dict(container._peeled_refs or {})
+
+
+def iter_loose_objects(store):
+    """Yield the SHAs of the loose objects of the disk object `store`."""
+    _check(store, '_iter_loose_objects')
+    return store._iter_loose_objects()
+
+
+def get_loose_object(store, sha):
+    """Return the loose object `sha` of the disk object `store`, or
+    ``None``.
+
+    """
+    _check(store, '_get_loose_object')
+    return store._get_loose_object(sha)
+
+
+def pack_paths(pack):
+    """Return the paths of the data and index files of `pack`."""
+    _check(pack, '_basename')
+    return [pack._basename + suffix for suffix in ('.pack', '.idx')]
+
+
+def lazy_blob(path):
+    """Return the blob stored as a loose object at `path`, whose data are
+    only read when they are used.
+
+    Dulwich reads the data of the blobs opened from a path to compute their
+    SHA, that is already given by the path.
+
+    """
+    blob = Blob.from_path(path)
+    _check(blob, '_needs_serialization')
+    blob._needs_serialization = False
+    return blob
+
+
+def deltify(objects):
+    """Yield the ``(type_num, sha, delta_base, raw)`` pack records of the
+    ``(object, path)`` tuples `objects`, stored as deltas of each other
+    when possible.
+
+    """
+    if deltify_pack_objects is None:
+        raise UnsupportedDulwichError('dulwich.pack.deltify_pack_objects')
+    return deltify_pack_objects(objects)
+
+
+def write_pack(pack_file, records, count):
+    """Write the `count` pack `records`, as yielded by `deltify`.
+
+    Deltas are written with the SHA of their base: ``write_pack_data``
+    writes wrong offsets for the bases stored earlier in the pack.
+
+    """
+    if write_pack_object is None:
+        raise UnsupportedDulwichError('dulwich.pack.write_pack_object')
+    pack_file = SHA1Writer(pack_file)
+    write_pack_header(pack_file, count)
+    for type_num, _, delta_base, raw in records:
+        if delta_base is not None:
+            type_num, raw = REF_DELTA, (delta_base, raw)
+        write_pack_object(pack_file, type_num, raw)
+    pack_file.write_sha()
@@ -1,11 +1,97 @@
 """Jinja2 environment for pynuts."""
 
 # Set the jinja2 environment by defining templates location and globals.
+import os
+import re
+import time
+import tempfile
+from hashlib import sha1
+
 import flask
+from dulwich.objects import Blob
 from jinja2 import nodes, Environment, PackageLoader, ChoiceLoader
+from jinja2.bccache import Bucket, FileSystemBytecodeCache
 from jinja2.ext import Extension
+from lxml.cssselect import CSSSelector
+from lxml.etree import HTMLPullParser
+from lxml.html import fromstring
 
 from . import filters
+from .cache import LRUCache
+
+
+#: Size in characters of the chunks of HTML parsed when looking for a match
+MATCH_CHUNK_SIZE = 16 * 1024
+
+# Compiled selectors of the showonmatch tags
+_selectors = LRUCache(256)
+
+# Selectors only made of lowercase tag names and descendant combinators
+_tag_selector_re = re.compile(r'^\s*[a-z][a-z0-9]*(\s+[a-z][a-z0-9]*)*\s*$')
+
+# Tags created, or renamed, by the parser around HTML fragments
+_implied_tags = frozenset(('html', 'head', 'body', 'p', 'div', 'span'))
+
+
+class _Selector(object):
+    """Compiled CSS selector telling whether an HTML string has a matching
+    element.
+
+    Selectors only made of tag names, such as ``'ul li'``, are resolved
+    without parsing when one of the tags is missing, and stop parsing at the
+    first matching element otherwise. Other selectors parse the whole HTML
+    string.
+
+    """
+    def __init__(self, selector):
+        self.selector = selector
+        self.tags = None
+        self._css_selector = None
+        if _tag_selector_re.match(selector):
+            tags = selector.split()
+            if not _implied_tags.intersection(tags):
+                self.tags = tags
+                self._tag_res = [
+                    re.compile(r'<%s[\s/>]' % tag, re.IGNORECASE)
+                    for tag in tags]
+
+    def __call__(self, html):
+        if self.tags is None:
+            if self._css_selector is None:
+                self._css_selector = CSSSelector(self.selector)
+            return bool(self._css_selector(fromstring(html)))
+        if not all(tag_re.search(html) for tag_re in self._tag_res):
+            return False
+        parser = HTMLPullParser(events=('start',), tag=self.tags[-1])
+        for start in xrange(0, len(html), MATCH_CHUNK_SIZE):
+            parser.feed(html[start:start + MATCH_CHUNK_SIZE])
+            if self._match_events(parser):
+                return True
+        parser.close()
+        return self._match_events(parser)
+
+    def _match_events(self, parser):
+        """Return whether an element started in `parser` matches."""
+        for _, element in parser.read_events():
+            tags = iter(reversed(self.tags[:-1]))
+            tag = next(tags, None)
+            for ancestor in element.iterancestors():
+                if tag is None:
+                    break
+                if ancestor.tag == tag:
+                    tag = next(tags, None)
+            if tag is None:
+                return True
+        return False
+
+
+def show_on_match(selector, html):
+    """Return whether `html` has an element matching the CSS `selector`."""
+    compiled_selector = _selectors.get(selector)
+    if compiled_selector is None:
+        compiled_selector = _Selector(selector)
+        _selectors.set(selector, compiled_selector)
+    return compiled_selector(html)
 
 
 class ShowOnMatch(Extension):
@@ -51,16 +137,9 @@ class ShowOnMatch(Extension):
                 None, None))
         assign_node = assign_node.set_lineno(lineno)
 
-        # Importe the needed lxml libraries
-        import_node = nodes.ImportedName('lxml.html.fromstring')
-        cssselector_node = nodes.ImportedName('lxml.cssselect.CSSSelector')
-
-        # Creates the if's test node
-        # Jinja AST equivalent of CSSSelector(selector)(fromstring(freevar))
-        test_node = nodes.Call(nodes.Call(cssselector_node,
-            [selector], [], None, None), [nodes.Call(import_node,
-                [name],
-                [], None, None)], [], None, None)
+        # Creates the if's test node, equivalent of
+        # show_on_match(selector, freevar)
+        test_node = self.call_method('_show_on_match', [selector, name])
 
         # Fill the if node
         if_node = nodes.If()
@@ -74,20 +153,104 @@ class ShowOnMatch(Extension):
         # and a test on the the selectors
         return [body_expr, assign_node, if_node]
 
+    def _show_on_match(self, selector, html):
+        """Test the rendered body of a showonmatch tag."""
+        return show_on_match(selector, html)
+
+
+class TimedEnvironment(Environment):
+    """Jinja2 environment recording the time spent compiling templates."""
+
+    #: Time spent compiling templates, in seconds
+    compile_time = 0
+
+    def compile(self, *args, **kwargs):
+        start = time.time()
+        try:
+            return super(TimedEnvironment, self).compile(*args, **kwargs)
+        finally:
+            self.compile_time += time.time() - start
+
 
-def create_environment(loader):
-    """Create a new Jinja2 environment with Pynuts helpers."""
+class BlobBytecodeCache(FileSystemBytecodeCache):
+    """Jinja2 bytecode cache storing compiled templates in `directory`.
+
+    Compiled templates are keyed by their name, by the SHA of their source
+    as a git blob and by the settings of the environment changing the
+    compiled code: they are shared by all the commits including the same
+    template, and by all the processes using the same directory.
+
+    """
+    def get_bucket(self, environment, name, filename, source):
+        blob_id = Blob.from_string(source.encode('utf-8')).id
+        key = sha1('%s\0%s\0%s' % (
+            name.encode('utf-8'), blob_id,
+            _environment_fingerprint(environment))).hexdigest()
+        bucket = Bucket(environment, key, blob_id)
+        self.load_bytecode(bucket)
+        return bucket
+
+    def dump_bytecode(self, bucket):
+        # Other processes may be reading the cache: write atomically
+        fd, temp_filename = tempfile.mkstemp(dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as bytecode_file:
+                bucket.write_bytecode(bytecode_file)
+            os.rename(temp_filename, self._get_cache_filename(bucket))
+        finally:
+            if os.path.exists(temp_filename):
+                os.remove(temp_filename)
+
+
+def _setting_fingerprint(value):
+    """Return a string identifying an environment setting in all the
+    processes, naming functions instead of giving their address.
+
+    """
+    if callable(value):
+        return '%s.%s' % (
+            getattr(value, '__module__', None),
+            getattr(value, '__name__', type(value).__name__))
+    return repr(value)
+
+
+def _environment_fingerprint(environment):
+    """Return a string identifying the settings of `environment` used
+    when compiling templates.
+
+    """
+    return '\0'.join((
+        ','.join(sorted(environment.extensions)),
+        _setting_fingerprint(environment.autoescape),
+        _setting_fingerprint(environment.finalize)))
+
+
+def create_environment(loader, bytecode_cache=None):
+    """Create a new Jinja2 environment with Pynuts helpers.
+
+    :param loader: the loader of the templates
+    :param bytecode_cache: an optional `jinja2.BytecodeCache`
+
+    """
     loaders = (loader, PackageLoader('pynuts', 'templates'))
-    environment = Environment(
-        loader=ChoiceLoader(loaders), extensions=[ShowOnMatch])
+    environment = TimedEnvironment(
+        loader=ChoiceLoader(loaders), extensions=[ShowOnMatch],
+        bytecode_cache=bytecode_cache)
     environment.globals.update({'url_for': flask.url_for})
     environment.filters['data'] = filters.data
     return environment
 
 
-def alter_environment(environment):
-    """Create a new Jinja2 environment with Pynuts helpers."""
+def alter_environment(environment, bytecode_cache=None):
+    """Add Pynuts helpers to an existing Jinja2 environment.
+
+    :param environment: the environment to alter
+    :param bytecode_cache: an optional `jinja2.BytecodeCache`
+
+    """
     environment.loader = ChoiceLoader(
         (environment.loader, PackageLoader('pynuts', 'templates')))
+    if bytecode_cache is not None:
+        environment.bytecode_cache = bytecode_cache
     environment.add_extension(ShowOnMatch)
     environment.filters['data'] = filters.data
@@ -1,11 +1,60 @@
 # coding: utf8
 
 """Git file for Pynuts."""
+import io
 import os
+import zlib
+import stat
 import time
+import errno
+import fcntl
+import struct
+import tempfile
+import threading
+import weakref
+from hashlib import sha1
+from contextlib import contextmanager
+from binascii import hexlify, unhexlify
+from collections import namedtuple
 
 import jinja2
-from dulwich.repo import Blob, Tree, Commit
+from dulwich.objects import hex_to_filename
+from dulwich.object_store import DiskObjectStore
+from dulwich.file import GitFile
+from dulwich.repo import (
+    Blob, Tree, Commit, DiskRefsContainer, read_packed_refs_with_peeled,
+    write_packed_refs)
+
+from .cache import LRUCache
+from .dulwich_internals import (
+    forget_packed_refs, forget_packs, lazy_blob, peeled_refs)
+
+
+#: Default maximum size in bytes of the object cache of a repository.
+OBJECT_CACHE_SIZE = 32 * 1024 * 1024
+
+#: Maximum number of paths kept in memory in the path indexes of trees.
+PATH_INDEX_SIZE = 100000
+
+#: Size in bytes of the chunks read when files are stored or blobs are read.
+CHUNK_SIZE = 64 * 1024
+
+#: Maximum number of merges tried by a commit when its branch keeps moving.
+MERGE_ATTEMPTS = 10
+
+#: Time in seconds between two attempts to take a busy branch lock.
+LOCK_POLL_INTERVAL = 0.01
+
+_object_caches = {}
+_object_caches_lock = threading.Lock()
+_ref_indexes = {}
+_ref_indexes_lock = threading.Lock()
+_path_indexes = LRUCache(PATH_INDEX_SIZE, sizeof=len)
+_history_indexes = {}
+_history_indexes_lock = threading.Lock()
+_packed_refs_signatures = weakref.WeakKeyDictionary()
+_commit_hooks = {}
+_lock_managers = {}
 
 
 class GitException(Exception):
@@ -24,6 +73,633 @@ class ConflictError(GitException):
     """Operation on a branch that does not exist."""
 
 
+class LockTimeoutError(ConflictError):
+    """Branch lock not acquired before the timeout."""
+
+
+class MergeConflictError(ConflictError):
+    """Concurrent changes of the same paths, listed in `paths`."""
+    def __init__(self, message, paths):
+        super(MergeConflictError, self).__init__(message)
+        self.paths = paths
+
+
+def object_cache(repository, max_size=None):
+    """Return the cache of git objects shared by all the `Git` objects
+    working on `repository`.
+
+    Git objects are immutable, the cache is keyed by SHA and never needs
+    to be invalidated.
+
+    :param repository: a Dulwich repository
+    :param max_size: maximum size in bytes of the cached objects, only used
+        when the cache is created. Default is `OBJECT_CACHE_SIZE`.
+
+    """
+    key = getattr(repository, 'path', None) or repository
+    with _object_caches_lock:
+        cache = _object_caches.get(key)
+        if cache is None:
+            cache = _object_caches[key] = LRUCache(
+                max_size or OBJECT_CACHE_SIZE,
+                sizeof=lambda obj: obj.raw_length())
+        return cache
+
+
+def read_object(repository, sha):
+    """Return the object `sha` of `repository`, from the object cache if
+    possible.
+
+    """
+    cache = object_cache(repository)
+    obj = cache.get(sha)
+    if obj is None:
+        object_store = repository.object_store
+        try:
+            obj = repository.get_object(sha)
+        except (KeyError, IOError, OSError):
+            # A maintenance may have packed the object since the packs were
+            # listed: list them again
+            if not isinstance(object_store, DiskObjectStore):
+                raise
+            forget_packs(object_store)
+            obj = repository.get_object(sha)
+        cache.set(sha, obj)
+    return obj
+
+
+def after_fork():
+    """Reset the registries of indexes and their locks in a process forked
+    from a multi-threaded process, where other threads may hold them.
+
+    The object caches are kept.
+
+    """
+    global _object_caches_lock, _ref_indexes_lock, _history_indexes_lock
+    _object_caches_lock = threading.Lock()
+    _ref_indexes_lock = threading.Lock()
+    _history_indexes_lock = threading.Lock()
+    _ref_indexes.clear()
+    _history_indexes.clear()
+
+
+def ref_index(repository, base):
+    """Return the `RefIndex` of the refs under `base` in `repository`,
+    shared by all its callers.
+
+    """
+    key = repository.controldir(), base
+    with _ref_indexes_lock:
+        index = _ref_indexes.get(key)
+        if index is None:
+            index = _ref_indexes[key] = RefIndex(repository, base)
+        return index
+
+
+def history_index(repository, ref):
+    """Return the `HistoryIndex` of `ref` in `repository`, shared by all
+    its callers.
+
+    """
+    key = repository.controldir(), ref
+    with _history_indexes_lock:
+        index = _history_indexes.get(key)
+        if index is None:
+            index = _history_indexes[key] = HistoryIndex(repository, ref)
+        return index
+
+
+def add_commit_hook(repository, hook, name=None):
+    """Call ``hook(git)`` after each commit made by a `Git` object in
+    `repository`.
+
+    Hooks are identified by `name`, default is `hook` itself: a hook
+    replaces the hook of `repository` with the same name, and is only
+    called once per commit.
+
+    """
+    if name is None:
+        name = hook
+    # Replaced instead of changed, commits may be calling the hooks
+    hooks = _commit_hooks.get(repository.controldir(), [])
+    _commit_hooks[repository.controldir()] = [
+        (hook_name, other_hook) for hook_name, other_hook in hooks
+        if hook_name != name] + [(name, hook)]
+
+
+def remove_commit_hook(repository, name):
+    """Stop calling the commit hook called `name` in `repository`."""
+    hooks = _commit_hooks.get(repository.controldir(), [])
+    _commit_hooks[repository.controldir()] = [
+        (hook_name, hook) for hook_name, hook in hooks if hook_name != name]
+
+
+def set_lock_manager(repository, manager):
+    """Serialize the commits of the `Git` objects in `repository` with the
+    `LockManager` `manager`, or stop serializing them if it is ``None``.
+
+    """
+    if manager is None:
+        _lock_managers.pop(repository.controldir(), None)
+    else:
+        _lock_managers[repository.controldir()] = manager
+
+
+def read_ref(repository, ref):
+    """Return the SHA of `ref` in `repository`, or ``None``.
+
+    Dulwich keeps the packed refs in memory once read: they are read again
+    when the ``packed-refs`` file has been changed, by another process for
+    example.
+
+    """
+    refs = repository.refs
+    if isinstance(refs, DiskRefsContainer):
+        signature = _signature(
+            os.path.join(repository.controldir(), 'packed-refs'))
+        if (signature is None or
+                signature != _packed_refs_signatures.get(refs)):
+            forget_packed_refs(refs)
+            _packed_refs_signatures[refs] = signature
+    return refs.read_ref(ref)
+
+
+def add_packed_refs(repository, refs):
+    """Add new refs to the packed refs of `repository`, in one transaction.
+
+    The refs that already exist are not changed.
+
+    :param refs: a dict mapping ref names to SHAs
+    :returns: the set of the names of the refs that already existed
+
+    """
+    container = repository.refs
+    existing = set()
+    packed_file = GitFile(
+        os.path.join(repository.controldir(), 'packed-refs'), 'wb')
+    try:
+        # Read the packed refs again while holding the lock
+        forget_packed_refs(container)
+        packed_refs = dict(container.get_packed_refs())
+        peeled = peeled_refs(container)
+        for name, sha in refs.iteritems():
+            if (name in packed_refs or
+                    container.read_loose_ref(name) is not None):
+                existing.add(name)
+            else:
+                packed_refs[name] = sha
+        write_packed_refs(packed_file, packed_refs, peeled)
+        packed_file.close()
+    finally:
+        packed_file.abort()
+        forget_packed_refs(container)
+    # Loose refs created meanwhile hide the packed ones
+    for name, sha in refs.iteritems():
+        if name not in existing and container.read_loose_ref(name) not in (
+                None, sha):
+            existing.add(name)
+    return existing
+
+
+def _signature(path):
+    """Return a value changing when the file at `path` is replaced or
+    modified, or ``None`` if the file does not exist.
+
+    Files modified during the last second get a unique signature: they
+    may be modified again without any visible change of their modification
+    time.
+
+    """
+    try:
+        stat_result = os.stat(path)
+    except OSError:
+        return None
+    if time.time() - stat_result.st_mtime < 1:
+        return object()
+    return stat_result.st_ino, stat_result.st_mtime
+
+
+class RefIndex(object):
+    """Index of the refs under `base`, such as ``'refs/heads/documents'``.
+
+    The index is refreshed when refs are read. The packed refs are only
+    read again when the ``packed-refs`` file changes, and the loose refs of
+    a directory only when its modification time changes.
+
+    :param repository: a Dulwich repository on disk
+    :param base: the prefix of the refs, without trailing slash
+
+    """
+    def __init__(self, repository, base):
+        self.controldir = repository.controldir()
+        self.base = base
+        self._packed = None, {}
+        self._loose = {}
+        self._lock = threading.Lock()
+
+    def refs(self):
+        """Return a dict mapping the names of the refs, relative to
+        `base`, to their SHA.
+
+        """
+        with self._lock:
+            self._refresh_packed()
+            self._refresh_loose()
+            refs = dict(self._packed[1])
+            for _, loose_refs, _ in self._loose.values():
+                refs.update(loose_refs)
+        return refs
+
+    def _refresh_packed(self):
+        """Read the packed refs again if they changed."""
+        filename = os.path.join(self.controldir, 'packed-refs')
+        signature = _signature(filename)
+        if signature == self._packed[0]:
+            return
+        refs = {}
+        if signature is not None:
+            prefix = self.base + '/'
+            with open(filename, 'rb') as packed_file:
+                for sha, name, _ in read_packed_refs_with_peeled(packed_file):
+                    if name.startswith(prefix):
+                        refs[name[len(prefix):]] = sha
+        self._packed = signature, refs
+
+    def _refresh_loose(self):
+        """Scan again the directories of loose refs that changed."""
+        root = os.path.join(self.controldir, self.base)
+        loose = {}
+        directories = [root]
+        while directories:
+            directory = directories.pop()
+            signature = _signature(directory)
+            if signature is None:
+                continue
+            cached = self._loose.get(directory)
+            if cached is None or cached[0] != signature:
+                cached = (signature,) + self._scan(root, directory)
+            loose[directory] = cached
+            directories.extend(cached[2])
+        self._loose = loose
+
+    @staticmethod
+    def _scan(root, directory):
+        """Return the loose refs and the sub-directories of `directory`."""
+        prefix = os.path.relpath(directory, root) + '/'
+        prefix = '' if prefix == './' else prefix
+        refs, sub_directories = {}, []
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if os.path.isdir(path):
+                sub_directories.append(path)
+            elif not name.endswith('.lock'):
+                try:
+                    with open(path, 'rb') as ref_file:
+                        sha = ref_file.read(40)
+                except IOError:
+                    # Removed since listdir
+                    continue
+                if len(sha) == 40 and not sha.startswith('ref: '):
+                    refs[prefix + name] = sha
+        return refs, sub_directories
+
+
+class LockManager(object):
+    """Serialize the writers of each branch of `repository`.
+
+    Each branch has its own lock file in the ``pynuts/locks`` directory of
+    the repository, locked with ``flock``: the writers of different
+    branches don't wait for each other, in this process or in others.
+    A thread can take again a lock it already holds.
+
+    :param repository: a Dulwich repository on disk
+    :param timeout: maximum time in seconds waited for a lock, or ``None``
+        to wait forever
+
+    """
+    def __init__(self, repository, timeout=None):
+        self.directory = os.path.join(
+            repository.controldir(), 'pynuts', 'locks')
+        self.timeout = timeout
+        self.acquired = 0
+        self.contended = 0
+        self.timeouts = 0
+        self.wait_time = 0
+        self.max_wait_time = 0
+        self._held = threading.local()
+        self._stats_lock = threading.Lock()
+
+    @contextmanager
+    def lock(self, ref):
+        """Return a context manager holding the lock of the branch `ref`.
+
+        :raises: LockTimeoutError
+
+        """
+        held = self._held.__dict__.setdefault('refs', set())
+        if ref in held:
+            yield
+            return
+        path = os.path.join(self.directory, ref + '.lock')
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # Created by another process
+                if not os.path.isdir(directory):
+                    raise
+        with open(path, 'a') as lock_file:
+            start = time.time()
+            contended = False
+            while True:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except IOError as exception:
+                    if exception.errno not in (errno.EAGAIN, errno.EACCES):
+                        raise
+                contended = True
+                if (self.timeout is not None and
+                        time.time() - start >= self.timeout):
+                    self._count(start, contended, timeout=True)
+                    raise LockTimeoutError(
+                        '%s is locked by another writer.' % ref)
+                time.sleep(LOCK_POLL_INTERVAL)
+            self._count(start, contended)
+            held.add(ref)
+            try:
+                yield
+            finally:
+                # The lock is released when the file is closed
+                held.discard(ref)
+
+    def _count(self, start, contended, timeout=False):
+        """Update the counters of a lock taken, or not, since `start`."""
+        wait_time = time.time() - start
+        with self._stats_lock:
+            if timeout:
+                self.timeouts += 1
+            else:
+                self.acquired += 1
+            self.contended += contended
+            self.wait_time += wait_time
+            self.max_wait_time = max(self.max_wait_time, wait_time)
+
+    def stats(self):
+        """Return a dict of counters about the locks usage.
+
+        Times are in seconds. ``contended`` is the number of locks that were
+        held by another writer when they were requested.
+
+        """
+        with self._stats_lock:
+            return {
+                'acquired': self.acquired, 'contended': self.contended,
+                'timeouts': self.timeouts, 'wait_time': self.wait_time,
+                'max_wait_time': self.max_wait_time}
+
+
+class HistoryEntry(namedtuple(
+        'HistoryEntry', 'id parent commit_time author message')):
+    """Description of a commit in the history of a branch.
+
+    `parent` is ``None`` for the first commit, `author` and `message` are
+    byte strings as stored in the commit.
+
+    """
+
+
+class HistoryIndex(object):
+    """Persistent index of the first-parent history of `ref`.
+
+    The index is stored in the ``pynuts/history`` directory of the
+    repository. The ``.idx`` file has a fixed-size record for each commit,
+    from the oldest to the newest, giving the commit and parent SHAs, the
+    commit time and the position of the author and message in the ``.dat``
+    file. Reading N entries only needs N small reads.
+
+    The index is brought up to date with the branch by `update`, appending
+    the new commits. It is rebuilt if the branch has been rewritten.
+
+    Commit times are expected to increase along the history, as they do
+    for the commits created by `Git.commit`.
+
+    :param repository: a Dulwich repository on disk
+    :param ref: the full name of the branch ref, such as
+        ``'refs/heads/master'``
+
+    """
+    record = struct.Struct('>20s20sqQI')
+
+    def __init__(self, repository, ref):
+        self.repository = repository
+        self.ref = ref
+        path = os.path.join(repository.controldir(), 'pynuts', 'history', ref)
+        self.index_path = path + '.idx'
+        self.data_path = path + '.dat'
+
+    def _open(self, lock):
+        """Open the index files, creating them if needed, and lock them
+        with `lock` (``fcntl.LOCK_SH`` or ``fcntl.LOCK_EX``).
+
+        """
+        directory = os.path.dirname(self.index_path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # Created by another process
+                if not os.path.isdir(directory):
+                    raise
+        index_file = open(self.index_path, 'a+b')
+        fcntl.flock(index_file, lock)
+        return index_file, open(self.data_path, 'a+b')
+
+    def _length(self, index_file):
+        """Return the number of complete records in `index_file`."""
+        return os.fstat(index_file.fileno()).st_size // self.record.size
+
+    def _last(self, index_file):
+        """Return the SHA of the last commit in `index_file`, or ``None``
+        if the index is empty.
+
+        """
+        length = self._length(index_file)
+        if length:
+            return hexlify(self._read_record(index_file, length - 1)[0])
+
+    def _read_record(self, index_file, position):
+        """Return the raw record at `position` in `index_file`."""
+        index_file.seek(position * self.record.size)
+        return self.record.unpack(index_file.read(self.record.size))
+
+    def _read_entry(self, index_file, data_file, position):
+        """Return the `HistoryEntry` at `position` in `index_file`."""
+        sha, parent, commit_time, offset, length = self._read_record(
+            index_file, position)
+        data_file.seek(offset)
+        author, message = data_file.read(length).split('\n', 1)
+        return HistoryEntry(
+            hexlify(sha), hexlify(parent) if parent.strip('\0') else None,
+            commit_time, author, message)
+
+    def update(self):
+        """Append the new commits of the branch to the index and return
+        the SHA of the head of the branch, or ``None`` if the branch does
+        not exist.
+
+        """
+        head = read_ref(self.repository, self.ref)
+        # Concurrent readers share the lock while the index is up to date
+        index_file, data_file = self._open(fcntl.LOCK_SH)
+        with index_file, data_file:
+            if self._last(index_file) == head:
+                return head
+
+        index_file, data_file = self._open(fcntl.LOCK_EX)
+        with index_file, data_file:
+            # The index may have been updated while waiting for the lock
+            last = self._last(index_file)
+            if head == last:
+                return head
+            length = self._length(index_file)
+
+            commits = []
+            sha = head
+            while sha and sha != last:
+                commit = read_object(self.repository, sha)
+                commits.append(commit)
+                sha = commit.parents[0] if commit.parents else None
+            if sha is None:
+                # The branch has been removed or rewritten
+                length = 0
+                data_file.truncate(0)
+            # Drop the incomplete record written by an interrupted update
+            index_file.truncate(length * self.record.size)
+
+            data_file.seek(0, os.SEEK_END)
+            offset = data_file.tell()
+            records = []
+            for commit in reversed(commits):
+                data = '%s\n%s' % (commit.author, commit.message)
+                data_file.write(data)
+                parent = commit.parents[0] if commit.parents else '0' * 40
+                records.append(self.record.pack(
+                    unhexlify(commit.id), unhexlify(parent),
+                    commit.commit_time, offset, len(data)))
+                offset += len(data)
+            # Records are only written when their data are stored
+            data_file.flush()
+            index_file.write(''.join(records))
+        return head
+
+    def entries(self, offset=0, limit=None, since=None, until=None):
+        """Return a list of `HistoryEntry`, from the newest to the oldest.
+
+        :param offset: number of entries skipped
+        :param limit: maximum number of entries returned
+        :param since: only include commits made at this timestamp or after
+        :param until: only include commits made at this timestamp or before
+
+        """
+        index_file, data_file = self._open(fcntl.LOCK_SH)
+        with index_file, data_file:
+            start, stop = 0, self._length(index_file)
+            if since is not None:
+                start = self._bisect(index_file, start, stop, since)
+            if until is not None:
+                stop = self._bisect(index_file, start, stop, until + 1)
+            stop -= offset
+            if limit is not None:
+                start = max(start, stop - limit)
+            return [
+                self._read_entry(index_file, data_file, position)
+                for position in xrange(stop - 1, start - 1, -1)]
+
+    def _bisect(self, index_file, low, high, commit_time):
+        """Return the position of the first record between `low` and
+        `high` whose commit time is at least `commit_time`.
+
+        """
+        while low < high:
+            middle = (low + high) // 2
+            if self._read_record(index_file, middle)[2] < commit_time:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+
+class BlobReader(object):
+    """Read-only file-like object giving the content of a loose blob,
+    decompressed by chunks.
+
+    :param path: the path of the loose object
+
+    The size of the content is given by the `size` attribute.
+
+    :raises IOError: if the object is not stored as a loose object
+    :raises ObjectTypeError: if the object is not a blob
+
+    """
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        self._decompressor = zlib.decompressobj()
+        self._buffer = ''
+        self._eof = False
+        while '\0' not in self._buffer and not self._eof:
+            self._fill()
+        header, _, self._buffer = self._buffer.partition('\0')
+        type_name, _, size = header.partition(' ')
+        if type_name != 'blob':
+            self.close()
+            raise ObjectTypeError('%s is a %s, expected a blob.' % (
+                path, type_name))
+        self.size = int(size)
+
+    def _fill(self):
+        """Decompress the next chunk of the file in the buffer."""
+        chunk = self._file.read(CHUNK_SIZE)
+        if chunk:
+            self._buffer += self._decompressor.decompress(chunk)
+        else:
+            self._buffer += self._decompressor.flush()
+            self._eof = True
+
+    def read(self, size=-1):
+        """Return at most `size` bytes, or all the remaining bytes."""
+        while not self._eof and (size < 0 or len(self._buffer) < size):
+            self._fill()
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def close(self):
+        """Close the object file."""
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _normalize_path(path):
+    """Return `path` as an UTF-8 byte string, without empty components."""
+    return '/'.join(part for part in path.encode('utf8').split('/') if part)
+
+
+def _copy_tree(tree):
+    """Return a new tree with the same entries as `tree`."""
+    new_tree = Tree()
+    for name, mode, sha in tree.iteritems():
+        new_tree.add(name, mode, sha)
+    return new_tree
+
+
 class Git(object):
     """Represents a commit and its tree in a git repository.
 
@@ -47,21 +723,66 @@ class Git(object):
 
     def __init__(self, repository, branch=None, commit=None):
         self.repository = repository
-        self._add_object = repository.object_store.add_object
-        self._get_object = repository.get_object
+        self._object_cache = object_cache(repository)
+        # Blob SHAs of the paths written but not in the tree yet
+        self._staged = {}
+        self._batch_depth = 0
 
         if branch:
             self.ref = 'refs/heads/' + branch
-            commit = commit or repository.refs.read_ref(self.ref)
+            commit = commit or read_ref(repository, self.ref)
         else:
             self.ref = None
 
         if commit:
-            self.head = repository.commit(commit)
-            self.tree = repository.tree(self.head.tree)
+            self.head = self._get_object(commit)
+            if self.head.type_name != 'commit':
+                raise ObjectTypeError('%s is a %s, expected a commit.'
+                                      % (commit, self.head.type_name))
+            # Loaded when needed
+            self._tree = None
         else:
             self.head = None
-            self.tree = Tree()
+            self._tree = Tree()
+
+    @property
+    def tree(self):
+        """Tree of the commit, including the changes made by `write`."""
+        if self._staged:
+            self._flush()
+        return self._base_tree()
+
+    @tree.setter
+    def tree(self, tree):
+        self._staged = {}
+        self._tree = tree
+
+    def _base_tree(self):
+        """Return the tree, without the staged writes."""
+        if self._tree is None:
+            self._tree = self._get_object(self.head.tree)
+        return self._tree
+
+    def _get_object(self, sha):
+        """Return the object `sha`, from the object cache if possible."""
+        return read_object(self.repository, sha)
+
+    def _add_object(self, obj):
+        """Add `obj` to the object store.
+
+        As git does, existing loose objects are touched: the maintenance
+        only prunes the objects that have not been written for a while.
+
+        """
+        object_store = self.repository.object_store
+        if isinstance(object_store, DiskObjectStore):
+            try:
+                os.utime(hex_to_filename(object_store.path, obj.id), None)
+                return
+            except OSError as exception:
+                if exception.errno != errno.ENOENT:
+                    raise
+        object_store.add_object(obj)
 
     def jinja_loader(self, sub_directory=None):
         """Return a jinja2.BaseLoader object with a `get_source` method
@@ -99,32 +820,119 @@ class Git(object):
         loader.get_source = get_source
         return loader
 
-    def history(self):
-        """Return an iterable of commit IDs, starting from this one.
+    def _path_index(self):
+        """Return a dict mapping every path in self.tree to a
+        ``(mode, sha)`` tuple.
+
+        The index is built in one recursive pass over the tree and shared
+        by all the Git objects on the same tree.
+
+        """
+        tree = self._base_tree()
+        index = _path_indexes.get(tree.id)
+        if index is None:
+            index = {}
+            self._index_tree(tree, '', index)
+            _path_indexes.set(tree.id, index)
+        return index
+
+    def _index_tree(self, tree, prefix, index):
+        """Add the paths in `tree` to `index`, recursively."""
+        for name, mode, sha in tree.iteritems():
+            path = prefix + name
+            index[path] = mode, sha
+            if stat.S_ISDIR(mode):
+                self._index_tree(self._get_object(sha), path + '/', index)
+
+    def walk(self):
+        """Yield a ``(path, mode, sha)`` tuple for every blob in the tree,
+        sorted by path.
+
+        """
+        if self._staged:
+            self._flush()
+        index = self._path_index()
+        for path in sorted(index):
+            mode, sha = index[path]
+            if not stat.S_ISDIR(mode):
+                yield path, mode, sha
+
+    def list_paths(self, sub_directory=None):
+        """Return the sorted list of the paths of the blobs in the tree.
+
+        :param sub_directory: only list the blobs in this directory
+
+        """
+        prefix = _normalize_path(sub_directory) + '/' if sub_directory else ''
+        return [path for path, _, _ in self.walk() if path.startswith(prefix)]
+
+    def history(self, offset=0, limit=None):
+        """Yield commit IDs, starting from this one.
 
         For merge commits, only the first parent is followed.
         The history is empty if the branch does not exist yet.
 
+        :param offset: number of commits skipped
+        :param limit: maximum number of commits returned
+
         """
-        commit = self.head
-        if not commit:
+        for entry in self._iter_history(offset, limit):
+            yield entry.id
+
+    def history_entries(self, offset=0, limit=None, since=None, until=None):
+        """Return a list of `HistoryEntry`, starting from this commit.
+
+        The history index of the branch is used when this commit is the
+        head of the branch.
+
+        See `HistoryIndex.entries` for the parameters.
+
+        """
+        return list(self._iter_history(offset, limit, since, until))
+
+    def _iter_history(self, offset=0, limit=None, since=None, until=None):
+        """Yield `HistoryEntry` objects, starting from this commit.
+
+        The commits are read one by one when the history index of the
+        branch can't be used.
+
+        """
+        if not self.head:
             return
-        while 1:
-            yield commit.id
-            if not commit.parents:
-                break
-            commit = self.repository.commit(commit.parents[0])
+        if self.ref:
+            index = history_index(self.repository, self.ref)
+            if index.update() == self.head.id:
+                for entry in index.entries(offset, limit, since, until):
+                    yield entry
+                return
+
+        commit = self.head
+        while commit and (limit is None or limit > 0):
+            if until is None or commit.commit_time <= until:
+                if since is not None and commit.commit_time < since:
+                    break
+                if offset:
+                    offset -= 1
+                else:
+                    if limit is not None:
+                        limit -= 1
+                    yield HistoryEntry(
+                        commit.id, (commit.parents or [None])[0],
+                        commit.commit_time, commit.author, commit.message)
+            commit = (
+                self._get_object(commit.parents[0]) if commit.parents
+                else None)
 
     def _lookup(self, path, create_trees=False):
         """
         :raises ValueError, NotFoundError, ObjectTypeError
         """
-        parts = [part for part in path.encode('utf8').split('/') if part]
-        if not parts:
+        parts = _normalize_path(path).split('/')
+        if parts == ['']:
             raise ValueError('empty path: %r' % path)
 
         last_i = len(parts) - 1
-        tree = self.tree
+        tree = self._base_tree()
         steps = []
         for i, name in enumerate(parts):
             if name in tree:
@@ -143,20 +951,123 @@ class Git(object):
             tree = obj
         return steps, obj
 
+    def blob_id(self, path):
+        """Return the SHA of the blob at `path`.
+
+        :raises: ValueError, NotFoundError, ObjectTypeError
+
+        """
+        normalized_path = _normalize_path(path)
+        if normalized_path in self._staged:
+            return self._staged[normalized_path]
+        if any(staged_path.startswith(normalized_path + '/')
+               for staged_path in self._staged):
+            raise ObjectTypeError("'%s' is a tree, expected a blob." % path)
+        entry = self._path_index().get(normalized_path)
+        if entry is not None and not stat.S_ISDIR(entry[0]):
+            return entry[1]
+        # Let _lookup raise the appropriate exception
+        _, obj = self._lookup(path)
+        if obj.type_name != 'blob':
+            raise ObjectTypeError("'%s' is a %s, expected a blob."
+                                  % (path, obj.type_name))
+        return obj.id
+
     def read(self, path):
         """Return as a byte string the content of the blob at `path`.
 
         :raises: ObjectTypeError
 
         """
-        _, blob = self._lookup(path)
-        if blob.type_name != 'blob':
-            raise ObjectTypeError("'%s' is a %s, expected a blob."
-                                  % (path, blob.type_name))
-        return blob.data
+        return self._get_object(self.blob_id(path)).data
+
+    def read_many(self, paths):
+        """Return a dict mapping the paths of `paths` found in the tree to
+        the content of their blob, as byte strings.
+
+        The paths are found in the path index of the tree, built in one
+        pass over the tree.
+
+        """
+        if self._staged:
+            self._flush()
+        index = self._path_index()
+        contents = {}
+        for path in paths:
+            entry = index.get(_normalize_path(path))
+            if entry is not None and not stat.S_ISDIR(entry[0]):
+                contents[path] = self._get_object(entry[1]).data
+        return contents
+
+    def open(self, path):
+        """Return a read-only file-like object giving the content of the
+        blob at `path`, with its size in the `size` attribute.
+
+        Loose blobs are read and decompressed by chunks, other blobs are
+        read in memory.
+
+        :raises: ValueError, NotFoundError, ObjectTypeError
+
+        """
+        sha = self.blob_id(path)
+        object_store = self.repository.object_store
+        if (sha not in self._object_cache and
+                isinstance(object_store, DiskObjectStore)):
+            try:
+                return BlobReader(hex_to_filename(object_store.path, sha))
+            except IOError as exception:
+                # Packed object
+                if exception.errno != errno.ENOENT:
+                    raise
+        data = self._get_object(sha).data
+        blob_file = io.BytesIO(data)
+        blob_file.size = len(data)
+        return blob_file
+
+    @contextmanager
+    def lock(self):
+        """Return a context manager holding the lock of the branch, if a
+        `LockManager` is set for the repository.
+
+        See `set_lock_manager`.
+
+        :raises: LockTimeoutError
+
+        """
+        manager = _lock_managers.get(self.repository.controldir())
+        if manager is None or not self.ref:
+            yield self
+        else:
+            with manager.lock(self.ref):
+                yield self
+
+    @contextmanager
+    def batch(self):
+        """Return a context manager staging the writes made in the context.
+
+        The trees including the written blobs are only built and stored
+        once, when the context is left, or when the tree is needed, by
+        `commit` for example. The staged writes are dropped if an exception
+        is raised in the context.
+
+        """
+        self._batch_depth += 1
+        try:
+            yield self
+        except:
+            if self._batch_depth == 1:
+                self._staged = {}
+            raise
+        finally:
+            self._batch_depth -= 1
+        if not self._batch_depth and self._staged:
+            self._flush()
 
     def write(self, path, bytestring):
-        """Update in place self.tree and make sure everything is stored.
+        """Update self.tree and make sure everything is stored.
+
+        In a `batch` context, the trees are only updated when the context
+        is left.
 
         :param path: path to the file to write
         :param bytestring: content of the file to write
@@ -164,45 +1075,147 @@ class Git(object):
         :raises ObjectTypeError
 
         """
-        steps, _ = self._lookup(path, create_trees=True)
-        tree, name, obj = steps.pop()
+        _, obj = self._lookup(path, create_trees=True)
         if obj and obj.type_name != 'blob':
             raise ObjectTypeError('Will not overwrite a %s at %s'
                                   % (obj.type_name, path))
+        path = _normalize_path(path)
+        for staged_path in self._staged:
+            if staged_path.startswith(path + '/'):
+                raise ObjectTypeError(
+                    'Will not overwrite a tree at %s' % path)
+            elif path.startswith(staged_path + '/'):
+                raise ObjectTypeError(
+                    "'%s' is a blob, expected a tree." % staged_path)
 
-        tree[name] = 0100644, self.store_bytes(bytestring).id
-        self._add_object(tree)
+        self._staged[path] = self.store_bytes(bytestring).id
+        if not self._batch_depth:
+            self._flush()
+
+    def _flush(self):
+        """Build and store the trees including the staged writes."""
+        changes = {}
+        for path, sha in self._staged.iteritems():
+            parts = path.split('/')
+            node = changes
+            for name in parts[:-1]:
+                node = node.setdefault(name, {})
+            node[parts[-1]] = sha
+        self._tree = self._build_tree(self._base_tree(), changes)
+        self._staged = {}
 
-        for tree, name, sub_tree in reversed(steps):
-            tree[name] = 040000, sub_tree.id
-            self._add_object(tree)
-        # self.tree ends up updated in-place.
+    def _build_tree(self, tree, changes):
+        """Store and return a copy of `tree` including `changes`, a nested
+        dict of names mapped to blob SHAs or to the changes of sub-trees.
 
-    def commit(self, author_name, author_email, message):
+        """
+        # Trees may be shared with other Git objects through the object
+        # cache: store modified copies instead of updating them in place.
+        tree = _copy_tree(tree)
+        for name, change in changes.iteritems():
+            if isinstance(change, dict):
+                sub_tree = (
+                    self._get_object(tree[name][1]) if name in tree
+                    else Tree())
+                tree[name] = 040000, self._build_tree(sub_tree, change).id
+            else:
+                tree[name] = 0100644, change
+        self._add_object(tree)
+        return tree
+
+    def commit(self, author_name, author_email, message, merge=False):
         """Add a new commit in the current branch with this one (if any)
         as a parent, and check that there is no conflict.
 
         :param author_name: commit author name
         :param author_email: commit author email
         :param message: commit message
+        :param merge: if `True` and other commits have been added to the
+            branch since this one, merge the changes with a three-way merge
+            and commit the result after the last commit of the branch.
+            Only changes of the same paths are conflicts.
+
+        The commit holds the lock of the branch, see `lock`.
 
-        :raises: ConflictError, GitException
+        :raises: ConflictError, MergeConflictError, LockTimeoutError,
+            GitException
 
         """
         if not self.ref:  # pragma: no cover
             raise GitException('Not on a branch.')
-        new_commit = self.store_commit(
-            self.tree.id, author_name, author_email, message,
-            parents=[self.head.id] if self.head else [])
-        refs = self.repository.refs
-        if self.head:
-            if not refs.set_if_equals(self.ref, self.head.id, new_commit.id):
-                raise ConflictError('%s is not the last commit in %s.'
-                                    % (self.head.id, self.ref))
-        else:
-            if not refs.add_if_new(self.ref, new_commit.id):
-                raise ConflictError('%s already exists.' % self.ref)
-        self.head = new_commit
+        with self.lock():
+            tree = self.tree
+            new_commit = self.store_commit(
+                tree.id, author_name, author_email, message,
+                parents=[self.head.id] if self.head else [])
+            refs = self.repository.refs
+            if self.head:
+                parent = self.head.id
+                for _ in xrange(MERGE_ATTEMPTS):
+                    if refs.set_if_equals(self.ref, parent, new_commit.id):
+                        break
+                    parent = read_ref(self.repository, self.ref)
+                    if not merge or parent is None:
+                        raise ConflictError(
+                            '%s is not the last commit in %s.'
+                            % (self.head.id, self.ref))
+                    conflicts = []
+                    tree = self._merge_trees(
+                        self._get_object(self.head.tree), self.tree,
+                        self._get_object(self._get_object(parent).tree),
+                        '', conflicts)
+                    if conflicts:
+                        raise MergeConflictError(
+                            'Conflicting changes in %s.'
+                            % ', '.join(conflicts), conflicts)
+                    new_commit = self.store_commit(
+                        tree.id, author_name, author_email, message,
+                        parents=[parent])
+                else:
+                    raise ConflictError('%s keeps changing.' % self.ref)
+            else:
+                if not refs.add_if_new(self.ref, new_commit.id):
+                    raise ConflictError('%s already exists.' % self.ref)
+            self.head = new_commit
+            self.tree = tree
+            history_index(self.repository, self.ref).update()
+        for _, hook in _commit_hooks.get(self.repository.controldir(), ()):
+            hook(self)
+
+    def _merge_trees(self, base, ours, theirs, prefix, conflicts):
+        """Store and return the three-way merge of the `ours` and `theirs`
+        trees, changed from the `base` tree.
+
+        The paths changed differently on both sides are added to
+        `conflicts`, and are left as in `base`.
+
+        """
+        tree = Tree()
+        for name in set(base) | set(ours) | set(theirs):
+            base_entry, our_entry, their_entry = (
+                tree_[name] if name in tree_ else None
+                for tree_ in (base, ours, theirs))
+            if our_entry == their_entry or their_entry == base_entry:
+                entry = our_entry
+            elif our_entry == base_entry:
+                entry = their_entry
+            elif (our_entry and their_entry and
+                  stat.S_ISDIR(our_entry[0]) and
+                  stat.S_ISDIR(their_entry[0]) and
+                  (base_entry is None or stat.S_ISDIR(base_entry[0]))):
+                base_tree, our_tree, their_tree = (
+                    self._get_object(entry[1]) if entry else Tree()
+                    for entry in (base_entry, our_entry, their_entry))
+                entry = 040000, self._merge_trees(
+                    base_tree, our_tree, their_tree, prefix + name + '/',
+                    conflicts).id
+            else:
+                conflicts.append(prefix + name)
+                entry = base_entry
+            if entry:
+                tree[name] = entry
+        self._add_object(tree)
+        return tree
 
     def store_commit(self, tree_id, author_name, author_email,
                      message, parents, timezone=None):
@@ -211,6 +1224,18 @@ class Git(object):
         Note that no branch will point to this commit. You may want to use
         `commit_into_branch` instead.
 
+        See `new_commit` for the parameters.
+
+        """
+        commit = self.new_commit(
+            tree_id, author_name, author_email, message, parents, timezone)
+        self._add_object(commit)
+        return commit
+
+    def new_commit(self, tree_id, author_name, author_email, message,
+                   parents, timezone=None):
+        """Return a new commit, without storing it.
+
         :param tree_id: git tree id
         :param author_name: commit author name
         :param author_email: commit author email
@@ -231,7 +1256,6 @@ class Git(object):
         commit.message = message.encode('utf8')
         commit.tree = tree_id
         commit.parents = parents
-        self._add_object(commit)
         return commit
 
     def store_directory(self, root):
@@ -255,15 +1279,60 @@ class Git(object):
         return tree
 
     def store_file(self, filename):
-        """Store a file as a blob and return its ID.
+        """Store a file as a blob and return the blob.
+
+        When the repository is on disk, the file is hashed and compressed
+        by chunks into a loose object, without reading everything in
+        memory. The data of the returned blob are then only read from the
+        object when they are used.
 
         :param filename: name of the file to store
 
+        :raises GitException: if the file is modified while being stored
+
         """
-        # TODO: store by chunks without reading everything in memory?
+        object_store = self.repository.object_store
+        if not isinstance(object_store, DiskObjectStore):
+            with open(filename, 'rb') as bytes_file:
+                return self.store_bytes(bytes_file.read())
 
         with open(filename, 'rb') as bytes_file:
-            return self.store_bytes(bytes_file.read())
+            size = os.fstat(bytes_file.fileno()).st_size
+            header = 'blob %i\0' % size
+            sha = sha1(header)
+            compressor = zlib.compressobj()
+            fd, temp_filename = tempfile.mkstemp(
+                dir=object_store.path, prefix='tmp_obj_')
+            try:
+                with os.fdopen(fd, 'wb') as object_file:
+                    object_file.write(compressor.compress(header))
+                    for chunk in iter(
+                            lambda: bytes_file.read(CHUNK_SIZE), ''):
+                        sha.update(chunk)
+                        object_file.write(compressor.compress(chunk))
+                        size -= len(chunk)
+                    object_file.write(compressor.flush())
+                if size:
+                    raise GitException(
+                        '%s changed while being stored.' % filename)
+                path = hex_to_filename(object_store.path, sha.hexdigest())
+                try:
+                    os.mkdir(os.path.dirname(path))
+                except OSError as exception:
+                    if exception.errno != errno.EEXIST:
+                        raise
+                try:
+                    # Touch the existing object, see _add_object
+                    os.utime(path, None)
+                except OSError as exception:
+                    if exception.errno != errno.ENOENT:
+                        raise
+                    os.chmod(temp_filename, 0444)
+                    os.rename(temp_filename, path)
+            finally:
+                if os.path.exists(temp_filename):
+                    os.remove(temp_filename)
+        return lazy_blob(path)
 
     def store_bytes(self, bytestring):
         """Store a byte string as a blob and return its ID.
@@ -0,0 +1,415 @@
+"""Background PDF rendering for Pynuts."""
+
+import threading
+import multiprocessing
+from collections import deque
+
+import flask
+
+from .cache import LRUCache, cache_key, after_fork as reset_caches
+from .git import NotFoundError, after_fork as reset_git
+
+
+#: Pynuts application of the worker processes
+_worker_pynuts = None
+
+
+def _init_worker(pynuts):
+    """Initialize a worker process rendering PDF documents.
+
+    Workers are forked from a thread of the application. They don't share
+    its repository and database connections, and the locks that its other
+    threads may hold are reset.
+
+    """
+    global _worker_pynuts
+    _worker_pynuts = pynuts
+    # Open the repository again instead of sharing the file descriptors of
+    # the parent process
+    pynuts.__dict__.pop('document_repository', None)
+    reset_caches()
+    reset_git()
+    sqlalchemy = pynuts.app.extensions.get('sqlalchemy')
+    if sqlalchemy is not None:
+        for connector in sqlalchemy.connectors.values():
+            connector.get_engine().dispose()
+
+
+def _render_pdf(document_type, document_id, version, part, archive, data):
+    """Render a PDF document in a worker process.
+
+    Return a ``(pdf, pdf_key, error)`` tuple, see `Job.finish`.
+
+    """
+    document_class = _worker_pynuts.documents[document_type]
+    with _worker_pynuts.app.test_request_context():
+        return _generate_job_pdf(
+            document_class, document_id, version, part, archive, data)
+
+
+def _generate_job_pdf(document_class, document_id, version, part, archive,
+                      data):
+    """Render the PDF document of a job.
+
+    Return a ``(pdf, pdf_key, error)`` tuple, where `error` is the message
+    of the exception raised by the rendering, or ``None``.
+
+    """
+    try:
+        pdf, pdf_key = _generate_pdf(
+            document_class, document_id, version, part, archive, data)
+    except Exception as exception:
+        return None, None, '%s: %s' % (type(exception).__name__, exception)
+    return pdf, pdf_key, None
+
+
+def _generate_pdf(document_class, document_id, version, part, archive,
+                  data):
+    """Render a PDF document.
+
+    Return a ``(pdf, pdf_key)`` tuple. When the PDF is stored in the PDF
+    cache of the document class, `pdf` is ``None`` and `pdf_key` is its key
+    in the cache.
+
+    """
+    document = document_class(document_id, version)
+    document.data = data
+    source = document._generate_rest(part=part, archive=archive)
+    pdf = document._generate_pdf(part=part, archive=archive, source=source)
+    if document.pdf_cache is not None:
+        pdf_key = document._cache_key('pdf', part, archive, source=source)
+        if pdf_key is not None and pdf_key in document.pdf_cache:
+            return None, pdf_key
+    return pdf, None
+
+
+def _render_batch_pdf(document_type, document, part, archive):
+    """Render a PDF document of a batch in a worker process."""
+    document_class = _worker_pynuts.documents[document_type]
+    with _worker_pynuts.app.test_request_context():
+        return _generate_batch_pdf(document_class, document, part, archive)
+
+
+def _generate_batch_pdf(document_class, document, part, archive):
+    """Render a PDF document of a batch.
+
+    Return a ``(document_id, pdf)`` tuple.
+
+    """
+    if isinstance(document, dict):
+        document = document_class.from_data(**document)
+    else:
+        document = document_class(document)
+        document.data = {}
+    return document.document_id, document._generate_batch_pdf(
+        part=part, archive=archive)
+
+
+class Job(object):
+    """A PDF rendering job.
+
+    The status of a job is ``'pending'``, ``'done'`` or ``'error'``.
+
+    :param store: a cache shared by the processes of the application, where
+        the status of the job is stored. The PDF is read from the PDF cache
+        of the document class when it is stored there, and stored in `store`
+        otherwise.
+
+    """
+    def __init__(self, id, document_class, document_id, version, part,
+                 archive, data, store=None):
+        self.id = id
+        self.document_class = document_class
+        self.document_id = document_id
+        self.version = version
+        self.part = part
+        self.archive = archive
+        self.data = data
+        self.store = store
+        self.pdf = None
+        #: Key of the PDF in the PDF cache of the document class, or ``None``
+        self.pdf_key = None
+        #: Message of the exception raised by the rendering, or ``None``
+        self.error = None
+        self._done = False
+
+    @classmethod
+    def from_record(cls, document_class, record, store):
+        """Return the job stored in `store` as `record`, see `save`."""
+        job = cls(
+            record['id'], document_class, record['document_id'],
+            record['version'], record['part'], record['archive'], None,
+            store)
+        job.error = record['error']
+        job.pdf_key = record['pdf_key']
+        job._done = record['status'] == 'done'
+        return job
+
+    @property
+    def args(self):
+        """Arguments of the rendering function."""
+        return (self.document_class.type_name, self.document_id,
+                self.version, self.part, self.archive, self.data)
+
+    @property
+    def status(self):
+        """Status of the job."""
+        if self.error is not None:
+            return 'error'
+        elif self._done:
+            return 'done'
+        return 'pending'
+
+    @property
+    def expired(self):
+        """Whether the rendered PDF has been removed from its cache."""
+        if not self._done or self.pdf is not None:
+            return False
+        store, key = self._pdf_location
+        return key not in store
+
+    @property
+    def _pdf_location(self):
+        """``(cache, key)`` tuple giving where the PDF is stored, or
+        ``(None, None)`` if it is kept in the job.
+
+        """
+        if self.pdf_key is not None:
+            return self.document_class.pdf_cache, self.pdf_key
+        elif self.store is not None:
+            return self.store, 'job-%s' % self.id
+        return None, None
+
+    def finish(self, result):
+        """Store the ``(pdf, pdf_key, error)`` result of the rendering.
+
+        `pdf` is ``None`` when the PDF is stored in the PDF cache of the
+        document class with the `pdf_key` key.
+
+        """
+        pdf, pdf_key, error = result
+        if error is not None:
+            self.error = error
+            self.save()
+            return
+        self.pdf_key = pdf_key
+        if pdf is None:
+            self._done = True
+            self.save()
+        else:
+            self.set_pdf(pdf)
+
+    def set_pdf(self, pdf):
+        """Store the rendered PDF, in the shared store when available."""
+        store, key = self._pdf_location
+        if store is not None:
+            store.set(key, pdf)
+        else:
+            self.pdf = pdf
+        self._done = True
+        self.save()
+
+    def get_pdf(self):
+        """Return the rendered PDF, or ``None`` if it is not available."""
+        if self.status != 'done':
+            return None
+        if self.pdf is not None:
+            return self.pdf
+        store, key = self._pdf_location
+        return store.get(key)
+
+    def save(self):
+        """Store the status of the job in the shared store, if any."""
+        if self.store is not None:
+            self.store.set(self.id, dict(
+                self.as_dict(), error=self.error, pdf_key=self.pdf_key))
+
+    def as_dict(self):
+        """Return a dict describing the job, serializable as JSON."""
+        return {
+            'id': self.id, 'status': self.status,
+            'document_type': self.document_class.type_name,
+            'document_id': self.document_id, 'version': self.version,
+            'part': self.part, 'archive': self.archive}
+
+
+class PDFJobs(object):
+    """Render PDF documents in a pool of processes.
+
+    Identical jobs submitted while a job is known share the same job.
+
+    :param pynuts: the Pynuts application
+    :param processes: the number of worker processes. With 0, the jobs are
+        rendered synchronously when they are submitted.
+    :param max_jobs: the maximum number of jobs remembered
+    :param store: a cache shared by the processes of the application, such
+        as a `pynuts.cache.FileSystemCache`. Without it, jobs are only known
+        by the process where they were submitted.
+
+    """
+    def __init__(self, pynuts, processes=0, max_jobs=1000, store=None):
+        self.pynuts = pynuts
+        self.processes = processes
+        self.store = store
+        self.jobs = LRUCache(max_jobs)
+        self._pool = None
+        self._lock = threading.Lock()
+
+    @property
+    def pool(self):
+        """Pool of worker processes, created when needed."""
+        with self._lock:
+            if self._pool is None:
+                self._pool = multiprocessing.Pool(
+                    self.processes, initializer=_init_worker,
+                    initargs=(self.pynuts,))
+            return self._pool
+
+    def submit(self, document_type, document_id, version=None,
+               part='index.rst.jinja2', archive=False, data=None):
+        """Submit a PDF rendering job and return the `Job`.
+
+        :param document_type: the type name of the document
+        :param document_id: the id of the document
+        :param version: version of the document, default is the latest one
+        :param part: part of the document to render
+        :param archive: render the archive of the document if `True`
+        :param data: data of the document, serializable as JSON
+
+        """
+        document_class = self.pynuts.documents[document_type]
+        part = 'index.rst' if archive else part
+        document = document_class(document_id, version)
+        git = document.archive_git if archive else document.git
+        if git.head is None:
+            raise NotFoundError('%s %s' % (document_type, document_id))
+        data = data or {}
+        # Jobs are identified by resolved versions
+        job_id = cache_key(
+            document_type, document_id, document.git.head.id,
+            git.head.id, part, archive, data)
+        with self._lock:
+            job = self.get(job_id)
+            if (job is not None and job.status != 'error' and
+                    not job.expired):
+                return job
+            job = Job(job_id, document_class, document_id,
+                      document.git.head.id, part, archive, data, self.store)
+            self.jobs.set(job_id, job)
+            job.save()
+
+        if self.processes:
+            self.pool.apply_async(_render_pdf, job.args, callback=job.finish)
+        else:
+            job.finish(_generate_job_pdf(
+                document_class, document_id, job.version, part, archive,
+                data))
+        return job
+
+    def map(self, document_class, documents, part='index.rst.jinja2',
+            archive=False):
+        """Render the PDF version of many documents.
+
+        Yield a ``(document_id, pdf)`` tuple for each document, in order.
+        At most twice as many documents as worker processes are rendered or
+        kept in memory at a time.
+
+        See :meth:`pynuts.document.Document.generate_pdf_batch`.
+
+        """
+        part = 'index.rst' if archive else part
+        if not self.processes:
+            for document in documents:
+                if flask.has_request_context():
+                    result = _generate_batch_pdf(
+                        document_class, document, part, archive)
+                else:
+                    with self.pynuts.app.test_request_context():
+                        result = _generate_batch_pdf(
+                            document_class, document, part, archive)
+                yield result
+            return
+
+        results = deque()
+        for document in documents:
+            results.append(self.pool.apply_async(
+                _render_batch_pdf,
+                (document_class.type_name, document, part, archive)))
+            if len(results) >= 2 * self.processes:
+                yield results.popleft().get()
+        while results:
+            yield results.popleft().get()
+
+    def get(self, job_id):
+        """Return the `Job` called `job_id`, or ``None``.
+
+        Jobs submitted by other processes are found in the shared store.
+
+        """
+        job = self.jobs.get(job_id)
+        if job is None and self.store is not None:
+            record = self.store.get(job_id)
+            if record is not None:
+                job = Job.from_record(
+                    self.pynuts.documents[record['document_type']], record,
+                    self.store)
+        return job
+
+    def close(self):
+        """Stop the worker processes."""
+        with self._lock:
+            if self._pool is not None:
+                self._pool.terminate()
+                self._pool.join()
+                self._pool = None
+
+
+def submit_pdf_job(pynuts):
+    """Submit a PDF rendering job.
+
+    It gets the job as JSON, with the ``document_type``, ``document_id``,
+    ``version``, ``part``, ``archive`` and ``data`` keys.
+
+    Return the job's information as JSON.
+
+    """
+    values = flask.request.json
+    try:
+        job = pynuts.pdf_jobs.submit(
+            values['document_type'], values['document_id'],
+            version=values.get('version') or None,
+            part=values.get('part') or 'index.rst.jinja2',
+            archive=values.get('archive', False), data=values.get('data'))
+    except NotFoundError:
+        flask.abort(404)
+    return flask.jsonify(job.as_dict())
+
+
+def pdf_job_status(pynuts, job_id):
+    """Return the job's information as JSON."""
+    job = pynuts.pdf_jobs.get(job_id)
+    if job is None:
+        flask.abort(404)
+    return flask.jsonify(job.as_dict())
+
+
+def pdf_job_result(pynuts, job_id):
+    """Return the PDF rendered by the job.
+
+    If the job is not done, return the job's information as JSON with a
+    "202 Accepted" status, or a "500 Internal Server Error" status if the
+    rendering failed.
+
+    """
+    job = pynuts.pdf_jobs.get(job_id)
+    if job is None:
+        flask.abort(404)
+    if job.status != 'done':
+        response = flask.jsonify(job.as_dict())
+        response.status_code = 500 if job.status == 'error' else 202
+        return response
+    pdf = job.get_pdf()
+    if pdf is None:
+        # Removed from the PDF cache
+        flask.abort(404)
+    return flask.Response(pdf, mimetype='application/pdf')
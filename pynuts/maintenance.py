@@ -0,0 +1,391 @@
+"""Maintenance of the document repository for Pynuts.
+
+Pynuts stores every new git object as a loose object, in its own file. The
+maintenance packs the reachable loose objects, removes the unreachable ones
+left by conflicting commits, and packs the refs. When there are too many
+packs, they are merged into the new pack.
+
+Readers of other processes may miss an object packed or merged since they
+listed the packs: `pynuts.git.read_object` lists them again and retries.
+Other readers of the repository get a `KeyError` in this case.
+
+The maintenance uses internals of Dulwich, see `pynuts.dulwich_internals`.
+
+It can be run from the command line::
+
+    python -m pynuts.maintenance path/to/documents.git
+
+"""
+
+import os
+import stat
+import time
+import errno
+import fcntl
+import argparse
+import threading
+from collections import defaultdict
+
+from dulwich.file import GitFile
+from dulwich.objects import hex_to_filename
+from dulwich.repo import Repo, write_packed_refs
+
+from .dulwich_internals import (
+    deltify, forget_packed_refs, forget_packs, get_loose_object,
+    iter_loose_objects, pack_paths, peeled_refs, write_pack)
+
+
+#: Minimum age in seconds of the unreachable loose objects removed. Objects
+#: are written before the commit making them reachable.
+PRUNE_GRACE_PERIOD = 3600
+
+#: Extensions of the blobs stored as deltas of other versions of the same
+#: file when they are packed.
+DELTA_EXTENSIONS = ('.rst', '.jinja', '.jinja2')
+
+#: Maximum size in bytes of the blobs stored as deltas.
+DELTA_MAX_SIZE = 256 * 1024
+
+#: Maximum number of versions of a file compared at once to find deltas.
+DELTA_BATCH_SIZE = 64
+
+#: Maximum number of packs kept. The packs are merged when a maintenance
+#: would add one more: objects are looked for in each pack in turn.
+MAX_PACKS = 8
+
+
+def reachable_objects(repository):
+    """Return a dict mapping the SHAs of the objects reachable from the
+    refs of `repository` to the path of the blobs, or ``None``.
+
+    """
+    store = repository.object_store
+    reachable = {}
+    pending = [(sha, None) for sha in repository.get_refs().values()]
+    while pending:
+        sha, path = pending.pop()
+        if sha in reachable:
+            continue
+        reachable[sha] = path
+        try:
+            obj = store[sha]
+        except KeyError:
+            continue
+        if obj.type_name == 'commit':
+            pending.append((obj.tree, ''))
+            pending.extend((parent, None) for parent in obj.parents)
+        elif obj.type_name == 'tree':
+            prefix = path or ''
+            for name, mode, child in obj.iteritems():
+                if stat.S_ISDIR(mode):
+                    pending.append((child, prefix + name + '/'))
+                elif child not in reachable:
+                    # Blobs have no children, no need to read them
+                    reachable[child] = prefix + name
+        elif obj.type_name == 'tag':
+            pending.append((obj.object[1], None))
+    return reachable
+
+
+def _get_object(store, sha):
+    """Return the object `sha` of `store`, loose or packed."""
+    return get_loose_object(store, sha) or store[sha]
+
+
+def _pack_records(store, shas, paths):
+    """Yield the ``(type_num, sha, delta_base, raw)`` records of the pack
+    of the objects `shas`.
+
+    Versions of the same template or ReST file are stored as deltas.
+
+    """
+    groups = defaultdict(list)
+    for sha in shas:
+        path = paths.get(sha)
+        if path and path.endswith(DELTA_EXTENSIONS):
+            groups[os.path.basename(path)].append(sha)
+            continue
+        obj = _get_object(store, sha)
+        yield obj.type_num, obj.sha().digest(), None, obj.as_raw_string()
+
+    for name in sorted(groups):
+        group = groups[name]
+        for start in xrange(0, len(group), DELTA_BATCH_SIZE):
+            objects = []
+            for sha in group[start:start + DELTA_BATCH_SIZE]:
+                obj = _get_object(store, sha)
+                if obj.raw_length() > DELTA_MAX_SIZE:
+                    yield (obj.type_num, obj.sha().digest(), None,
+                           obj.as_raw_string())
+                else:
+                    objects.append((obj, name))
+            for record in deltify(objects):
+                yield record
+
+
+def _is_old(path, grace_period):
+    """Return whether the file at `path` exists and has not been modified
+    for `grace_period` seconds.
+
+    """
+    try:
+        return time.time() - os.stat(path).st_mtime > grace_period
+    except OSError as exception:
+        if exception.errno != errno.ENOENT:
+            raise
+        return False
+
+
+def pack_objects(repository, reachable, grace_period=PRUNE_GRACE_PERIOD):
+    """Pack the reachable loose objects of `repository` and remove the
+    unreachable ones older than `grace_period` seconds.
+
+    If the repository would have more than `MAX_PACKS` packs, the objects
+    of the existing packs are packed too, and these packs are removed.
+
+    :param reachable: as returned by `reachable_objects`
+
+    Return a dict of counters. Sizes are the disk usage of the files.
+
+    """
+    store = repository.object_store
+    stats = dict.fromkeys((
+        'loose_objects', 'packed_objects', 'pruned_objects', 'merged_packs',
+        'bytes_before', 'bytes_after'), 0)
+    to_pack, to_remove, to_prune = [], [], []
+    now = time.time()
+    for sha in iter_loose_objects(store):
+        stat_result = os.stat(hex_to_filename(store.path, sha))
+        stats['loose_objects'] += 1
+        stats['bytes_before'] += stat_result.st_blocks * 512
+        if sha in reachable:
+            if not store.contains_packed(sha):
+                to_pack.append(sha)
+            to_remove.append(sha)
+        elif now - stat_result.st_mtime > grace_period:
+            to_prune.append((sha, stat_result.st_blocks * 512))
+        else:
+            # May be used by a commit being written
+            stats['bytes_after'] += stat_result.st_blocks * 512
+
+    old_packs = []
+    if to_pack and len(store.packs) >= MAX_PACKS:
+        old_packs = list(store.packs)
+        packed = set(to_pack)
+        for pack in old_packs:
+            stats['bytes_before'] += sum(
+                os.stat(path).st_blocks * 512 for path in pack_paths(pack))
+            for sha in pack:
+                if sha not in packed:
+                    packed.add(sha)
+                    to_pack.append(sha)
+
+    if to_pack:
+        if not os.path.isdir(store.pack_dir):
+            os.makedirs(store.pack_dir)
+        pack_file, commit, abort = store.add_pack()
+        try:
+            write_pack(
+                pack_file, _pack_records(store, to_pack, reachable),
+                len(to_pack))
+        except:
+            abort()
+            raise
+        pack = commit()
+        stats['packed_objects'] = len(to_pack)
+        stats['bytes_after'] += sum(
+            os.stat(path).st_blocks * 512 for path in pack_paths(pack))
+
+    for old_pack in old_packs:
+        old_pack.close()
+        for path in pack_paths(old_pack):
+            os.remove(path)
+        stats['merged_packs'] += 1
+    if old_packs:
+        forget_packs(store)
+
+    for sha in to_remove:
+        _remove_loose_object(store, sha)
+
+    if to_prune:
+        # Commits written since the reachable objects were found may use
+        # old objects again. These commits touch the objects they use
+        # before updating their ref, see pynuts.git.Git._add_object.
+        reachable = reachable_objects(repository)
+    for sha, size in to_prune:
+        path = hex_to_filename(store.path, sha)
+        if sha in reachable or not _is_old(path, grace_period):
+            stats['bytes_after'] += size
+            continue
+        _remove_loose_object(store, sha)
+        stats['pruned_objects'] += 1
+    return stats
+
+
+def _remove_loose_object(store, sha):
+    """Remove the loose object `sha` of `store`, and its directory if it is
+    empty.
+
+    """
+    path = hex_to_filename(store.path, sha)
+    os.remove(path)
+    try:
+        os.rmdir(os.path.dirname(path))
+    except OSError:
+        # Not empty
+        pass
+
+
+def pack_refs(repository):
+    """Move the loose refs of `repository` into its packed refs.
+
+    Return the number of refs packed.
+
+    """
+    container = repository.refs
+    controldir = repository.controldir()
+    loose_refs = {}
+    for directory, _, filenames in os.walk(os.path.join(controldir, 'refs')):
+        for filename in filenames:
+            if filename.endswith('.lock'):
+                continue
+            name = os.path.relpath(
+                os.path.join(directory, filename), controldir)
+            sha = container.read_loose_ref(name)
+            if sha and not sha.startswith('ref: '):
+                loose_refs[name] = sha
+    if not loose_refs:
+        return 0
+
+    packed_file = GitFile(os.path.join(controldir, 'packed-refs'), 'wb')
+    try:
+        forget_packed_refs(container)
+        packed_refs = dict(container.get_packed_refs())
+        packed_refs.update(loose_refs)
+        write_packed_refs(packed_file, packed_refs, peeled_refs(container))
+        packed_file.close()
+    finally:
+        packed_file.abort()
+        forget_packed_refs(container)
+
+    packed = 0
+    for name, sha in loose_refs.iteritems():
+        try:
+            lock = GitFile(container.refpath(name), 'wb')
+        except OSError as exception:
+            # Locked by a commit, keep the loose ref
+            if exception.errno != errno.EEXIST:
+                raise
+            continue
+        try:
+            # The packed ref is only visible if the loose ref is unchanged
+            if container.read_loose_ref(name) == sha:
+                os.remove(container.refpath(name))
+                packed += 1
+        finally:
+            lock.abort()
+    return packed
+
+
+def maintain(repository, grace_period=PRUNE_GRACE_PERIOD):
+    """Pack the objects and the refs of `repository`, and remove its
+    unreachable objects older than `grace_period` seconds.
+
+    Only one maintenance runs at a time on a repository. Return a dict of
+    counters, or ``None`` if a maintenance is already running.
+
+    """
+    directory = os.path.join(repository.controldir(), 'pynuts')
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(os.path.join(directory, 'maintenance.lock'), 'a') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as exception:
+            if exception.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            return None
+        start = time.time()
+        # Refs are packed first: refs created meanwhile are loose, and
+        # their objects are kept as they are recent
+        stats = {'packed_refs': pack_refs(repository)}
+        stats.update(pack_objects(
+            repository, reachable_objects(repository), grace_period))
+        stats['bytes_reclaimed'] = stats['bytes_before'] - stats['bytes_after']
+        stats['duration'] = time.time() - start
+        return stats
+
+
+class Maintenance(object):
+    """Schedule the maintenance of the document repository of `pynuts`.
+
+    The maintenance runs in a background thread after `commits` commits,
+    or at the first commit `interval` seconds after the last maintenance.
+
+    :param pynuts: the Pynuts application
+    :param commits: number of commits between two maintenances, or ``None``
+    :param interval: time in seconds between two maintenances, or ``None``
+    :param grace_period: see `maintain`
+
+    """
+    def __init__(self, pynuts, commits=None, interval=None,
+                 grace_period=PRUNE_GRACE_PERIOD):
+        self.pynuts = pynuts
+        self.commits = commits
+        self.interval = interval
+        self.grace_period = grace_period
+        #: Counters of the last maintenance
+        self.last_stats = None
+        self.last_run = time.time()
+        self._commit_count = 0
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def commit_hook(self, git):
+        """Count the commit of `git` and start the maintenance if needed."""
+        with self._lock:
+            self._commit_count += 1
+            due = (
+                (self.commits and self._commit_count >= self.commits) or
+                (self.interval and time.time() - self.last_run >= self.interval))
+            if not due or (self._thread and self._thread.is_alive()):
+                return
+            self._commit_count = 0
+            self.last_run = time.time()
+            self._thread = threading.Thread(target=self.run)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def run(self):
+        """Run the maintenance now and return its counters, or ``None``
+        if a maintenance is already running.
+
+        """
+        # Dulwich repositories are not thread-safe
+        repository = Repo(self.pynuts.document_repository.path)
+        stats = maintain(repository, self.grace_period)
+        if stats is not None:
+            self.last_stats = stats
+        return stats
+
+
+def main(argv=None):
+    """Run the maintenance of a repository from the command line."""
+    parser = argparse.ArgumentParser(
+        description='Pack and clean a Pynuts document repository.')
+    parser.add_argument('repository', help='path of the bare repository')
+    parser.add_argument(
+        '--grace-period', type=int, default=PRUNE_GRACE_PERIOD,
+        help='minimum age in seconds of the unreachable objects removed')
+    args = parser.parse_args(argv)
+    stats = maintain(Repo(args.repository), args.grace_period)
+    if stats is None:
+        print 'A maintenance is already running.'
+        return 1
+    for key in sorted(stats):
+        print '%s: %s' % (key, stats[key])
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -107,7 +107,11 @@ function save_content (options) {
                     divs.attr('data-document-version', this.version);
                     span_containers.attr('data-document-version', this.version);
                 });
-                if ('success_callback' in options) options.success_callback();
+                if (response.conflicts && response.conflicts.length) {
+                    if ('fail_callback' in options) options.fail_callback();
+                } else {
+                    if ('success_callback' in options) options.success_callback();
+                }
             } else {
                 if ('fail_callback' in options) options.fail_callback();
             }
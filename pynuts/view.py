@@ -1,5 +1,11 @@
 """View file for Pynuts."""
 
+import json
+import datetime
+from decimal import Decimal
+from itertools import chain
+from collections import namedtuple
+
 import flask
 import jinja2
 from flask_wtf import Form
@@ -7,13 +13,25 @@ from wtforms import TextField
 from wtforms.fields.core import UnboundField
 from functools import wraps
 from werkzeug.utils import cached_property
-from werkzeug.datastructures import FileStorage
-from sqlalchemy.orm import class_mapper
+from werkzeug.datastructures import FileStorage, MultiDict
+from sqlalchemy import Column, and_, or_
+from sqlalchemy.orm import (
+    ColumnProperty, RelationshipProperty, class_mapper, joinedload,
+    load_only, subqueryload)
+from sqlalchemy.orm.exc import UnmappedColumnError
+from sqlalchemy.sql import operators
+from sqlalchemy.sql.expression import ClauseElement, UnaryExpression
+from sqlalchemy.sql.visitors import iterate
 from sqlalchemy.util import classproperty
 from sqlalchemy.orm.attributes import InstrumentedAttribute
 
+from .filters import data as data_filter
+
 ACTIONS = ('list', 'table', 'create', 'read', 'update', 'delete')
 
+#: Number of template outputs joined in each chunk of streamed templates
+STREAM_BUFFER_SIZE = 64
+
 
 def auth_url_for(endpoint, **kwargs):
     ep_fun = flask.current_app.view_functions.get(endpoint)
@@ -24,6 +42,91 @@ def auth_url_for(endpoint, **kwargs):
     return flask.url_for(endpoint, **kwargs)
 
 
+def _keyset_json(value):
+    """Return `value` as a JSON-serializable value, for the keyset values
+    not supported by JSON. See `_keyset_value`.
+
+    """
+    if isinstance(value, (datetime.date, datetime.time)):
+        # Also for datetimes
+        return value.isoformat()
+    elif isinstance(value, Decimal):
+        return str(value)
+    raise TypeError('%r is not JSON serializable' % value)
+
+
+def _keyset_value(value, column):
+    """Return the keyset `value` loaded from JSON as a value of `column`.
+
+    :raises ValueError: if `value` is not valid
+
+    """
+    if value is None:
+        raise ValueError('Keyset values can\'t be null')
+    try:
+        python_type = column.type.python_type
+    except NotImplementedError:
+        return value
+    if python_type in (datetime.datetime, datetime.date, datetime.time):
+        formats = {
+            datetime.datetime: ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S'),
+            datetime.date: ('%Y-%m-%d',),
+            datetime.time: ('%H:%M:%S.%f', '%H:%M:%S')}[python_type]
+        for format_ in formats:
+            try:
+                parsed = datetime.datetime.strptime(value, format_)
+            except (TypeError, ValueError):
+                continue
+            if python_type is datetime.date:
+                return parsed.date()
+            elif python_type is datetime.time:
+                return parsed.time()
+            return parsed
+        raise ValueError('Invalid keyset value %r' % value)
+    elif python_type is Decimal:
+        try:
+            return Decimal(value)
+        except ArithmeticError:
+            raise ValueError('Invalid keyset value %r' % value)
+    return value
+
+
+def stream_template(template_name_or_list, **context):
+    """Render a template of the application like
+    ``flask.render_template``, but return an iterator of chunks.
+
+    The iterator needs the request context: wrap it in
+    ``flask.stream_with_context`` to stream a response.
+
+    """
+    app = flask.current_app
+    app.update_template_context(context)
+    template = app.jinja_env.get_or_select_template(template_name_or_list)
+    stream = template.stream(context)
+    stream.enable_buffering(STREAM_BUFFER_SIZE)
+    return stream
+
+
+def _stream_markup(template_name_or_list, **context):
+    """Stream a template like `stream_template`, in chunks that can be
+    included in other templates.
+
+    """
+    for chunk in stream_template(template_name_or_list, **context):
+        yield jinja2.Markup(chunk)
+
+
+def _peek(iterable):
+    """Return whether `iterable` is empty, and an iterator on all its
+    items.
+
+    """
+    iterator = iter(iterable)
+    for first in iterator:
+        return False, chain((first,), iterator)
+    return True, iterator
+
+
 class PynutsMROException(Exception):
     pass
 
@@ -40,6 +143,97 @@ class BaseForm(Form):
                     'error')
 
 
+class TableRow(namedtuple(
+        'TableRow', 'view primary_keys cells read_url update_url delete_url')):
+    """Row of a table, as given by :meth:`ModelView.table_rows`.
+
+    ``cells`` are the values of the table columns, formatted by the
+    ``data`` filter. The URLs are ``None`` if the action is not available.
+
+    """
+
+
+class Pager(object):
+    """Page of the elements of a `ModelView`, given as ``pager`` to the
+    list and table templates.
+
+    :param per_page: maximum number of elements in the page
+    :param page: number of the page, starting at 1, for offset pagination
+    :param after: keyset values of the element before the page, for keyset
+        pagination
+    :param has_next: whether elements follow the page
+    :param next_after: keyset values of the last element of the page, for
+        keyset pagination
+    :param total: number of elements, or ``None`` if not counted
+    :param prefix: prefix of the ``page`` and ``after`` request arguments
+        in the URLs of the other pages
+
+    """
+    def __init__(self, per_page, page=None, after=None, has_next=False,
+                 next_after=None, total=None, prefix=''):
+        self.per_page = per_page
+        self.page = page
+        self.after = after
+        self.has_next = has_next
+        self.next_after = next_after
+        self.total = total
+        self.prefix = prefix
+
+    @property
+    def keyset(self):
+        """Whether the page is found by keyset instead of by offset."""
+        return self.page is None
+
+    @property
+    def has_previous(self):
+        """Whether elements precede the page."""
+        return self.after is not None if self.keyset else self.page > 1
+
+    @property
+    def pages(self):
+        """Number of pages, or ``None`` if the elements are not counted."""
+        if self.total is not None:
+            return max(1, (self.total + self.per_page - 1) // self.per_page)
+
+    def url(self, **args):
+        """Return the URL of the current page with the query string
+        `args` changed, the names of `args` being given without `prefix`.
+        Arguments set to ``None`` are removed.
+
+        """
+        values = dict(flask.request.view_args or {})
+        values.update(flask.request.args.to_dict())
+        values.update(
+            (self.prefix + name, value) for name, value in args.items())
+        values = dict(
+            (key, value) for key, value in values.items()
+            if value is not None)
+        return flask.url_for(flask.request.endpoint, **values)
+
+    @property
+    def next_url(self):
+        """URL of the next page, or ``None``."""
+        if not self.has_next:
+            return None
+        if self.keyset:
+            return self.url(
+                after=json.dumps(self.next_after, default=_keyset_json),
+                page=None)
+        return self.url(page=self.page + 1, after=None)
+
+    @property
+    def previous_url(self):
+        """URL of the previous page with offset pagination, or ``None``."""
+        if self.has_previous and not self.keyset:
+            return self.url(page=self.page - 1, after=None)
+
+    @property
+    def first_url(self):
+        """URL of the first page, or ``None`` on the first page."""
+        if self.has_previous:
+            return self.url(page=None, after=None)
+
+
 class MetaView(type):
     """Metaclass for view classes."""
     def __init__(cls, name, bases, dict_):
@@ -151,6 +345,8 @@ class ModelView(object):
     # Templates
     view_list_template = '_pynuts/list.jinja2'
     view_table_template = '_pynuts/table.jinja2'
+    view_list_stream_template = '_pynuts/list_stream.jinja2'
+    view_table_stream_template = '_pynuts/table_stream.jinja2'
     view_create_template = '_pynuts/create.jinja2'
     view_read_template = '_pynuts/read.jinja2'
     view_update_template = '_pynuts/update.jinja2'
@@ -178,6 +374,25 @@ class ModelView(object):
     #: The columns you can edit
     update_columns = None
 
+    #: Default number of elements in the pages of paginated lists and
+    #: tables, or ``None`` for `max_per_page` elements
+    per_page = None
+
+    #: Maximum number of elements in a page, even if requested
+    max_per_page = 1000
+
+    #: Pagination mode, ``'offset'`` or ``'keyset'``. Keyset pagination
+    #: seeks the elements after the last element of the previous page by
+    #: `order_by` and primary key, its cost does not depend on the page.
+    pagination = 'offset'
+
+    #: Prefix of the ``page``, ``per_page`` and ``after`` request arguments
+    #: choosing the page, to paginate many lists or tables on one page
+    page_args_prefix = ''
+
+    #: Number of elements fetched at once by streamed lists and tables
+    stream_batch_size = 100
+
     _cached_create_form = None
 
     def __init__(self, keys=None, data=None):
@@ -197,8 +412,16 @@ class ModelView(object):
     def primary_keys(self):
         """Primary keys/value dict."""
         return dict(
-            (column.key, getattr(self.data, column.key))
-            for column in self.mapping.primary_key)
+            (key, getattr(self.data, key))
+            for key in self.primary_key_names())
+
+    @classmethod
+    def primary_key_names(cls):
+        """Return the names of the primary keys, found once per class."""
+        if '_primary_key_names' not in cls.__dict__:
+            cls._primary_key_names = tuple(
+                column.key for column in cls.mapping.primary_key)
+        return cls._primary_key_names
 
     @property
     def name(self):
@@ -271,28 +494,334 @@ class ModelView(object):
         return cls.model.query.session
 
     @classmethod
-    def query(cls, query=None, elements=None):
+    def load_options(cls, columns):
+        """Return the SQLAlchemy loader options loading what is needed to
+        show the `columns` of the model elements.
+
+        Only the columns used by `columns`, the primary keys and `order_by`
+        are loaded, unless one of `columns` is computed by Python code.
+        Many-to-one relationships are loaded with the elements by a join,
+        collections by one more query for all the elements.
+
+        """
+        mapper = cls.mapping
+        keys = set()
+        projected = True
+        options = []
+        order_by = getattr(cls, 'order_by', None)
+        if isinstance(order_by, InstrumentedAttribute):
+            keys.add(order_by.key)
+        for name in columns or ():
+            attribute = getattr(cls.model, name, None)
+            prop = getattr(attribute, 'property', None)
+            if isinstance(prop, RelationshipProperty):
+                options.append(
+                    subqueryload(attribute) if prop.uselist else
+                    joinedload(attribute))
+                model_columns = prop.local_columns
+            elif isinstance(prop, ColumnProperty):
+                model_columns = prop.columns
+            elif isinstance(attribute, ClauseElement):
+                # SQL expression of a hybrid property
+                model_columns = [
+                    element for element in iterate(attribute, {})
+                    if isinstance(element, Column)]
+            else:
+                projected = False
+                continue
+            for column in model_columns:
+                try:
+                    keys.add(mapper.get_property_by_column(column).key)
+                except UnmappedColumnError:
+                    projected = False
+        if projected and keys:
+            options.insert(0, load_only(*keys))
+        return options
+
+    @classmethod
+    def _load(cls, query, columns, yield_per=None):
+        """Add to `query` the loader options of `columns`, if it queries
+        the model elements.
+
+        With `yield_per`, the elements are fetched by batches of `yield_per`
+        elements, unless collections are loaded: SQLAlchemy can't load
+        them eagerly by batches.
+
+        """
+        entities = [
+            description['entity']
+            for description in query.column_descriptions]
+        if columns is not None and entities == [cls.model]:
+            query = query.options(*cls.load_options(columns))
+            for name in columns:
+                attribute = getattr(cls.model, name, None)
+                prop = getattr(attribute, 'property', None)
+                if isinstance(prop, RelationshipProperty) and prop.uselist:
+                    yield_per = None
+        if yield_per:
+            query = query.yield_per(yield_per)
+        return query
+
+    @classmethod
+    def query(cls, query=None, elements=None, columns=None, yield_per=None):
         """Return all the model elements according to a query..
 
         :param query: The SQLAlchemy query
         :type query: str
         :param elements: A model list (if present, does not execute query)
         :type elements: list
+        :param columns: only load what is needed to show these columns,
+            see :meth:`load_options`
+        :type columns: list
+        :param yield_per: fetch the elements by batches of this size while
+            they are iterated, instead of fetching them all at once
+        :type yield_per: int
 
         """
         if elements is not None:
             iterable = elements
         elif query:
-            iterable = query.all()
+            iterable = cls._load(query, columns, yield_per)
         else:
             iterable = cls.model.query
             if hasattr(cls, 'order_by') and cls.order_by is not None:
                 iterable = iterable.order_by(cls.order_by)
+            iterable = cls._load(iterable, columns, yield_per)
+        if not yield_per and elements is None:
             iterable = iterable.all()
 
         for data in iterable:
             yield cls(data=data)
 
+    @classmethod
+    def keyset_columns(cls, order_by=None):
+        """Return the ``(attribute name, attribute, descending)`` tuples
+        ordering the elements for keyset pagination: the `order_by` columns
+        if any, then the primary keys.
+
+        :param order_by: clauses ordering the elements, default is the
+            `order_by` attribute. Mapped attributes, optionally with
+            ``asc()`` or ``desc()``, and their names are supported.
+
+        :raises ValueError: if the elements can't be ordered by `order_by`
+            for keyset pagination
+
+        """
+        if order_by is None:
+            order_by = getattr(cls, 'order_by', None)
+        if order_by is None:
+            order_by = ()
+        elif not isinstance(order_by, (list, tuple)):
+            order_by = (order_by,)
+        columns = []
+        for clause in order_by:
+            key, descending = cls._keyset_key(clause)
+            prop = cls.mapping.get_property(key)
+            if any(column.nullable for column in prop.columns):
+                # Null values can't be compared
+                raise ValueError(
+                    '%s is nullable, it can\'t order the elements for '
+                    'keyset pagination' % key)
+            if key not in [name for name, _, _ in columns]:
+                columns.append((key, getattr(cls.model, key), descending))
+        for column in cls.mapping.primary_key:
+            key = cls.mapping.get_property_by_column(column).key
+            if key not in [name for name, _, _ in columns]:
+                columns.append((key, getattr(cls.model, key), False))
+        return columns
+
+    @classmethod
+    def _keyset_key(cls, clause, descending=False):
+        """Return the ``(attribute name, descending)`` tuple of an
+        `order_by` clause.
+
+        """
+        if isinstance(getattr(clause, 'element', None), basestring):
+            # Textual reference given to Query.order_by
+            clause = clause.element
+        if isinstance(clause, basestring):
+            attribute = getattr(cls.model, clause, None)
+            if not isinstance(attribute, InstrumentedAttribute):
+                raise ValueError(
+                    '%s can\'t order the elements for keyset pagination'
+                    % clause)
+            clause = attribute
+        if isinstance(clause, InstrumentedAttribute):
+            clause = clause.__clause_element__()
+        if isinstance(clause, UnaryExpression):
+            if clause.modifier is operators.desc_op:
+                return cls._keyset_key(clause.element, True)
+            elif clause.modifier is operators.asc_op:
+                return cls._keyset_key(clause.element, False)
+        try:
+            prop = cls.mapping.get_property_by_column(clause)
+        except (UnmappedColumnError, TypeError):
+            raise ValueError(
+                '%s can\'t order the elements for keyset pagination' % clause)
+        if not isinstance(prop, ColumnProperty):
+            raise ValueError(
+                '%s can\'t order the elements for keyset pagination' % clause)
+        return prop.key, descending
+
+    @classmethod
+    def paginate(cls, query=None, elements=None, page=None, per_page=None,
+                 after=None, count=False, columns=None, order_by=None,
+                 prefix=None):
+        """Return a ``(views, pager)`` tuple for a page of the model
+        elements. Only the elements of the page are loaded.
+
+        :param query: The SQLAlchemy query
+        :param elements: A model list (if present, does not execute query)
+        :param page: number of the page for offset pagination, default is
+            the ``page`` request argument or 1
+        :param per_page: number of elements in the page, default is the
+            ``per_page`` request argument or `per_page`, limited to
+            `max_per_page`
+        :param after: keyset values of the last element of the previous
+            page as JSON for keyset pagination, default is the ``after``
+            request argument
+        :param count: count the elements if `True`
+        :param columns: only load what is needed to show these columns,
+            see :meth:`load_options`
+        :param order_by: clauses ordering the elements, replacing the order
+            of `query`. Default is the `order_by` attribute for keyset
+            pagination and for the elements of the model, and the order of
+            `query` otherwise.
+        :param prefix: prefix of the request arguments, default is
+            `page_args_prefix`
+
+        Elements given as a list are always paginated by offset. Keyset
+        pagination orders the elements by `order_by` and by primary key,
+        see :meth:`keyset_columns`.
+
+        """
+        if prefix is None:
+            prefix = cls.page_args_prefix
+        args = (
+            flask.request.args if flask.has_request_context() else
+            MultiDict())
+        per_page = (
+            per_page or args.get(prefix + 'per_page', type=int) or
+            cls.per_page or cls.max_per_page)
+        per_page = max(1, min(per_page, cls.max_per_page))
+        keyset = cls.pagination == 'keyset' and elements is None
+        total = None
+
+        if keyset:
+            if after is None:
+                after = args.get(prefix + 'after')
+            if isinstance(after, basestring):
+                try:
+                    after = json.loads(after)
+                except ValueError:
+                    flask.abort(400)
+            if query is None:
+                query = cls.model.query
+            keys = cls.keyset_columns(order_by)
+            if count:
+                total = query.order_by(None).count()
+            query = query.order_by(None).order_by(*[
+                column.desc() if descending else column
+                for _, column, descending in keys])
+            if after is not None:
+                if (not isinstance(after, list) or
+                        len(after) != len(keys)):
+                    flask.abort(400)
+                try:
+                    after = [
+                        _keyset_value(value, column.property.columns[0])
+                        for value, (_, column, _) in zip(after, keys)]
+                except ValueError:
+                    flask.abort(400)
+                # Elements with the same first keys and a next key after
+                # the key of the previous element, for each key
+                seeks = []
+                for index, (_, column, descending) in enumerate(keys):
+                    seek = [
+                        key_column == value for (_, key_column, _), value
+                        in zip(keys[:index], after)]
+                    seek.append(
+                        column < after[index] if descending else
+                        column > after[index])
+                    seeks.append(and_(*seek))
+                query = query.filter(or_(*seeks))
+            if columns is not None:
+                # The keys of the last element give the next page
+                columns = list(columns) + [name for name, _, _ in keys]
+            rows = cls._load(query, columns).limit(per_page + 1).all()
+            pager = Pager(per_page, after=after, has_next=len(rows) > per_page,
+                          total=total, prefix=prefix)
+            rows = rows[:per_page]
+            if pager.has_next:
+                pager.next_after = [
+                    getattr(rows[-1], name) for name, _, _ in keys]
+        else:
+            page = max(1, page or args.get(prefix + 'page', 1, type=int) or 1)
+            start = (page - 1) * per_page
+            if elements is not None:
+                if count:
+                    total = len(elements)
+                rows = list(elements[start:start + per_page + 1])
+            else:
+                if query is None:
+                    query = cls.model.query
+                    if order_by is None:
+                        order_by = getattr(cls, 'order_by', None)
+                if order_by is not None:
+                    if not isinstance(order_by, (list, tuple)):
+                        order_by = (order_by,)
+                    query = query.order_by(None).order_by(*order_by)
+                if count:
+                    total = query.order_by(None).count()
+                rows = cls._load(query, columns).limit(
+                    per_page + 1).offset(start).all()
+            pager = Pager(per_page, page=page, has_next=len(rows) > per_page,
+                          total=total, prefix=prefix)
+            rows = rows[:per_page]
+
+        return [cls(data=data) for data in rows], pager
+
+    @classmethod
+    def table_labels(cls):
+        """Return the labels of the table columns."""
+        form = cls.TableForm(formdata=None)
+        return [form[column].label.text for column in cls.table_columns]
+
+    @classmethod
+    def table_rows(cls, views, ctx_args=None):
+        """Yield a `TableRow` for each view of `views`.
+
+        The fields of the table form are bound once, and given the values
+        of each row in turn: no form is built for each row.
+
+        :param ctx_args: extra arguments of the action URLs
+
+        """
+        ctx_args = ctx_args or {}
+        form = cls.TableForm(formdata=None)
+        fields = [(column, form[column]) for column in cls.table_columns]
+        actions = [
+            action for action in ('read', 'update', 'delete')
+            if getattr(cls, '%s_endpoint' % action, None) is not None]
+        for view in views:
+            data = view.data
+            cells = []
+            for column, field in fields:
+                # Same as binding a form with ``obj=data``
+                if hasattr(data, column):
+                    field.process(None, getattr(data, column))
+                else:
+                    field.process(None)
+                cells.append(data_filter(field))
+            primary_keys = view.primary_keys
+            url_args = dict(ctx_args, **primary_keys)
+            urls = dict(
+                (action, cls.action_url_for(action, **url_args))
+                for action in actions)
+            yield TableRow(
+                view, primary_keys, cells, urls.get('read'),
+                urls.get('update'), urls.get('delete'))
+
     @classmethod
     def _get_form_attributes(cls, form):
         """Return the form attributes which are defined on the model."""
@@ -357,9 +886,27 @@ class ModelView(object):
 
         return wrapper
 
+    @classmethod
+    def _views(cls, query, elements, paginated, page, per_page, after,
+               count, columns, order_by, prefix, yield_per=None):
+        """Return the views and the pager given to the list and table
+        templates.
+
+        Pages are fetched at once, `yield_per` only applies to the views of
+        all the elements.
+
+        """
+        if paginated or per_page:
+            return cls.paginate(
+                query, elements, page, per_page, after, count, columns,
+                order_by, prefix)
+        return cls.query(query, elements, columns, yield_per), None
+
     @classmethod
     def view_list(cls, query=None, no_result_message=None,
-                  elements=None, action=None, ctx_args=None, **kwargs):
+                  elements=None, action=None, ctx_args=None, paginated=False,
+                  page=None, per_page=None, after=None, count=False,
+                  order_by=None, prefix=None, stream=False, **kwargs):
         """Render the HTML for list_template.
 
         :param query: The SQLAlchemy query used for rendering the list
@@ -369,20 +916,40 @@ class ModelView(object):
         :type no_result_message: str
         :param elements: A model list replacing query
         :type elements: list
+        :param paginated: paginate the list, default is `True` if
+            `per_page` is given. See :meth:`paginate` for the other
+            pagination parameters.
+        :param stream: return an iterator of HTML chunks rendered while
+            the elements are fetched, see :meth:`view_table`
 
         """
         ctx_args = ctx_args or {}
+        views, pager = cls._views(
+            query, elements, paginated, page, per_page, after, count,
+            cls.list_columns, order_by, prefix,
+            stream and cls.stream_batch_size)
+
+        if stream:
+            empty, views = _peek(views)
+            return _stream_markup(
+                cls.environment.get_template(
+                    cls.view_list_stream_template).name,
+                views=views, empty=empty, pager=pager, action=action,
+                ctx_args=ctx_args, view_class=cls,
+                no_result_message=no_result_message, **kwargs)
 
         return jinja2.Markup(flask.render_template(
-            cls.environment.get_template(cls.view_list_template),
-            views=cls.query(query, elements), action=action, ctx_args=ctx_args,
+            cls.environment.get_template(cls.view_list_template).name,
+            views=views, pager=pager, action=action, ctx_args=ctx_args,
             view_class=cls, no_result_message=no_result_message, **kwargs))
 
     @classmethod
     def view_table(
             cls, query=None, no_result_message=None,
             elements=None, actions=None, no_default_actions=False,
-            ctx_args=None, **kwargs):
+            ctx_args=None, paginated=False, page=None, per_page=None,
+            after=None, count=False, order_by=None, prefix=None,
+            stream=False, **kwargs):
         """Render the HTML for table_template.
 
         :param query: The SQLAlchemy query used for rendering the table
@@ -392,17 +959,29 @@ class ModelView(object):
         :type no_result_message: str
         :param elements: A model list replacing query
         :type elements: list
+        :param paginated: paginate the table, default is `True` if
+            `per_page` is given. See :meth:`paginate` for the other
+            pagination parameters.
+        :param stream: return an iterator of HTML chunks instead of the
+            whole HTML. The rows are rendered while the elements are
+            fetched by batches of `stream_batch_size` elements, the
+            iterator needs the request context.
 
         """
         table_actions = actions or []
         ctx_args = ctx_args or {}
+        views, pager = cls._views(
+            query, elements, paginated, page, per_page, after, count,
+            cls.table_columns, order_by, prefix,
+            stream and cls.stream_batch_size)
 
-        def actions(view):
+        def actions(view, primary_keys=None):
             view_actions = []
             for action in table_actions:
                 view_action = dict(action)
-                view_action.setdefault('data', {})
-                view_action['data'].update(view.primary_keys)
+                view_action['data'] = dict(action.get('data', {}))
+                view_action['data'].update(
+                    primary_keys or view.primary_keys)
                 if ctx_args:
                     view_action['data'].update(ctx_args)
                 view_action['url'] = auth_url_for(
@@ -410,9 +989,24 @@ class ModelView(object):
                 view_actions.append(view_action)
             return view_actions
 
+        if stream:
+            # The views are only given as rows: they are only iterated once
+            empty, views = _peek(views)
+            return _stream_markup(
+                cls.environment.get_template(
+                    cls.view_table_stream_template).name,
+                empty=empty, rows=cls.table_rows(views, ctx_args),
+                labels=cls.table_labels(), pager=pager, ctx_args=ctx_args,
+                view_class=cls, no_result_message=no_result_message,
+                actions=actions, no_default_actions=no_default_actions,
+                **kwargs)
+
+        # Given as views and as rows, that may both be iterated
+        views = list(views)
         return jinja2.Markup(flask.render_template(
             cls.environment.get_template(cls.view_table_template).name,
-            views=cls.query(query, elements), ctx_args=ctx_args,
+            views=views, rows=cls.table_rows(views, ctx_args),
+            labels=cls.table_labels(), pager=pager, ctx_args=ctx_args,
             view_class=cls, no_result_message=no_result_message,
             actions=actions, no_default_actions=no_default_actions,
             **kwargs))
@@ -451,7 +1045,7 @@ class ModelView(object):
 
     # CRUD methods
     @classmethod
-    def list(cls, template=None, query=None, **kwargs):
+    def list(cls, template=None, query=None, stream=False, **kwargs):
         """Return the list_template.
 
         :param template: The template you want to render
@@ -460,13 +1054,20 @@ class ModelView(object):
         :param endpoint: The endpoint for the registered URL rule
         :type endpoint: str, func(lambda)
 
+        :param stream: return a streamed response, see :meth:`table`
+        :type stream: bool
+
         """
+        if stream:
+            return flask.Response(flask.stream_with_context(stream_template(
+                template or cls.list_template,
+                view_class=cls, query=query, stream=True, **kwargs)))
         return flask.render_template(
             template or cls.list_template,
             view_class=cls, query=query, **kwargs)
 
     @classmethod
-    def table(cls, template=None, query=None, **kwargs):
+    def table(cls, template=None, query=None, stream=False, **kwargs):
         """Return the table_template.
 
         :param template: The template you want to render
@@ -475,7 +1076,17 @@ class ModelView(object):
         :param endpoint: The endpoint for the registered URL rule
         :type endpoint: str, func(lambda)
 
+        :param stream: return a response streaming the template while it is
+            rendered. The template is given ``stream=True``, and can stream
+            the table with
+            ``{% for chunk in view_class.view_table(stream=stream) %}``.
+        :type stream: bool
+
         """
+        if stream:
+            return flask.Response(flask.stream_with_context(stream_template(
+                template or cls.read_template,
+                view_class=cls, query=query, stream=True, **kwargs)))
         return flask.render_template(
             template or cls.read_template,
             view_class=cls, query=query, **kwargs)
@@ -19,12 +19,30 @@
 
 import json
 import os
+import shutil
+import datetime
+from tempfile import mkdtemp
+from collections import namedtuple
+import time
+import fcntl
+import zipfile
 
+import flask
+from decimal import Decimal
 from flask import url_for
+from sqlalchemy import Column, Date, DateTime, Numeric
+from werkzeug.exceptions import BadRequest
+from werkzeug.urls import url_decode
 from cStringIO import StringIO
 
-from pynuts.document import InvalidId
-from pynuts.git import ConflictError
+from pynuts import Pynuts
+from pynuts.cache import LRUCache, FileSystemCache
+from pynuts.document import InvalidId, DocumentRegistry
+from pynuts.git import (
+    Git, ConflictError, NotFoundError, LockManager, set_lock_manager)
+from pynuts.jobs import PDFJobs
+from pynuts.view import Pager, _keyset_value
+from pynuts.maintenance import Maintenance
 
 from . import (
     teardown_func, setup_func, setup_fixture as setup_module,
@@ -210,6 +228,186 @@ class TestComplete(object):
             response = request(client.get, url_for('table_employees'))
             assert 'Tester Tester' in response.data
 
+    def test_pagination(self):
+        """Check the pagination of the employee views."""
+        from complete.application import app
+        from complete.view import EmployeeView
+        with app.test_request_context('/employees/table?per_page=2'):
+            app.preprocess_request()
+            views, pager = EmployeeView.paginate(count=True)
+            assert [view.data.person_id for view in views] == [1, 2]
+            assert (pager.page, pager.total, pager.pages) == (1, 3, 2)
+            assert pager.has_next and not pager.has_previous
+            assert 'page=2' in pager.next_url
+            assert 'per_page=2' in pager.next_url
+            html = EmployeeView.view_table(paginated=True)
+            assert 'Tester Tester' in html and 'Hired Tester' not in html
+            assert 'rel="next"' in html
+
+            views, pager = EmployeeView.paginate(page=2)
+            assert [view.data.person_id for view in views] == [3]
+            assert not pager.has_next and pager.has_previous
+            assert pager.total is None
+            assert 'page=1' in pager.previous_url
+
+            views, pager = EmployeeView.paginate(
+                elements=EmployeeView.model.query.all()[::-1], per_page=1)
+            assert [view.data.person_id for view in views] == [3]
+
+            EmployeeView.pagination = 'keyset'
+            try:
+                views, pager = EmployeeView.paginate()
+                assert [view.data.person_id for view in views] == [1, 2]
+                assert pager.keyset and pager.next_after == [2]
+                assert 'after=%5B2%5D' in pager.next_url
+                views, pager = EmployeeView.paginate(after='[2]')
+                assert [view.data.person_id for view in views] == [3]
+                assert not pager.has_next and pager.has_previous
+                assert pager.first_url.endswith('?per_page=2')
+                html = EmployeeView.view_list(after=[1], per_page=1)
+                assert 'Tester Tester' in html and 'admin' not in html
+
+                # Explicit order
+                views, pager = EmployeeView.paginate(
+                    order_by=EmployeeView.model.person_id.desc())
+                assert [view.data.person_id for view in views] == [3, 2]
+                EmployeeView.order_by = EmployeeView.model.person_id.desc()
+                views, pager = EmployeeView.paginate(after=pager.next_after)
+                assert [view.data.person_id for view in views] == [1]
+
+                try:
+                    EmployeeView.paginate(after='[null]')
+                except BadRequest:
+                    pass
+                else:
+                    raise StandardError('Null keys must be rejected')
+                EmployeeView.order_by = EmployeeView.model.order
+                try:
+                    EmployeeView.paginate()
+                except ValueError:
+                    pass
+                else:
+                    raise StandardError('Nullable keys must be rejected')
+            finally:
+                del EmployeeView.pagination
+                if 'order_by' in vars(EmployeeView):
+                    del EmployeeView.order_by
+
+            # Keyset values not supported by JSON
+            values = [
+                datetime.datetime(2016, 1, 2, 3, 4, 5, 6),
+                datetime.date(2016, 1, 2), Decimal('1.50')]
+            pager = Pager(2, has_next=True, next_after=values)
+            after = json.loads(url_decode(
+                pager.next_url.split('?', 1)[1])['after'])
+            assert [_keyset_value(value, Column(type_)) for value, type_ in
+                    zip(after, (DateTime(), Date(), Numeric()))] == values
+
+        # Arguments of the pages of many tables
+        with app.test_request_context(
+                '/employees/table?per_page=1&employees_page=2'):
+            app.preprocess_request()
+            EmployeeView.page_args_prefix = 'employees_'
+            try:
+                views, pager = EmployeeView.paginate(per_page=2)
+                assert [view.data.person_id for view in views] == [3]
+                assert 'employees_page=1' in pager.previous_url
+                views, pager = EmployeeView.paginate(prefix='')
+                assert [view.data.person_id for view in views] == [1]
+                args = url_decode(pager.next_url.split('?', 1)[1])
+                assert (args['page'], args['employees_page']) == ('2', '2')
+            finally:
+                del EmployeeView.page_args_prefix
+
+        with app.test_request_context('/employees/table'):
+            app.preprocess_request()
+            html = EmployeeView.view_table()
+            assert 'Hired Tester' in html and 'pager' not in html
+            # The per_page attribute only gives the size of paginated pages
+            EmployeeView.per_page = 1
+            try:
+                html = EmployeeView.view_table()
+                assert 'Hired Tester' in html and 'pager' not in html
+                html = EmployeeView.view_table(paginated=True)
+                assert 'Hired Tester' not in html and 'pager' in html
+            finally:
+                del EmployeeView.per_page
+
+    def test_load_options(self):
+        """Check the loading of the columns shown by the views."""
+        from complete.application import app
+        from complete.view import EmployeeView, CompanyView
+        with app.test_request_context():
+            query = EmployeeView._load(
+                EmployeeView.model.query.order_by('person_id'),
+                ('name', 'company'))
+            assert 'password' not in str(query)
+            employees = query.all()
+            assert 'password' not in employees[0].__dict__
+            assert employees[2].__dict__['company'].name == 'Test Company 1'
+            assert employees[0].password == 'root'
+
+            # Hybrid properties computed in Python can't be projected
+            query = EmployeeView._load(
+                EmployeeView.model.query, EmployeeView.table_columns)
+            assert 'password' in str(query)
+
+            query = CompanyView._load(
+                CompanyView.model.query, CompanyView.read_columns)
+            company = query.first()
+            assert 'employees' in company.__dict__
+            assert [employee.person_id for employee in company.employees] == [
+                3]
+
+    def test_table_rows(self):
+        """Check the rows rendered by the employee table."""
+        from complete.application import app
+        from complete.view import EmployeeView
+        with app.test_request_context('/employees/table'):
+            app.preprocess_request()
+            assert EmployeeView.table_labels() == [
+                'order', 'Employee name', 'Driving license']
+            views = EmployeeView.query(columns=EmployeeView.table_columns)
+            rows = list(EmployeeView.table_rows(views))
+            assert [row.primary_keys for row in rows] == [
+                {'person_id': 1}, {'person_id': 2}, {'person_id': 3}]
+            assert rows[1].cells[1] == 'Tester Tester'
+            assert rows[1].view.data.person_id == 2
+            assert rows[1].update_url == EmployeeView.action_url_for(
+                'update', person_id=2)
+            html = EmployeeView.view_table()
+            for row in rows:
+                assert row.cells[1] in html
+
+    def test_stream_table(self):
+        """Check the streamed employee tables and lists."""
+        from complete.application import app
+        from complete.view import EmployeeView, CompanyView
+        with app.test_request_context('/employees/table'):
+            app.preprocess_request()
+            html = u''.join(EmployeeView.view_table(stream=True))
+            assert html.split() == EmployeeView.view_table().split()
+            assert 'Hired Tester' in html
+
+            html = u''.join(EmployeeView.view_table(
+                elements=[], no_result_message='No employee', stream=True))
+            assert html.split() == ['<p>No', 'employee</p>']
+
+            html = u''.join(EmployeeView.view_list(stream=True))
+            assert html.count('<li>') == 3
+
+            query = EmployeeView._load(
+                EmployeeView.model.query, EmployeeView.table_columns, 10)
+            assert query._yield_per == 10
+            # Collections are not loaded by batches
+            query = CompanyView._load(
+                CompanyView.model.query, CompanyView.read_columns, 10)
+            assert query._yield_per is None
+
+            response = EmployeeView.table('table_employees.html', stream=True)
+            assert response.is_streamed
+            assert 'Tester Tester' in response.data
+
     @with_client
     def test_company_create_fields(self, client):
         """Check company create fields."""
@@ -285,10 +483,10 @@ class TestComplete(object):
                     'edit_employee_report', person_id=1,
                     version='370fc6c4f1cf798e954791d7d9bbd169afabca71'),
                 data={
-                    'document': 'new template',
-                    'message': 'Update new template',
+                    'document': 'other template',
+                    'message': 'Update other template',
                     '_old_commit': '370fc6c4f1cf798e954791d7d9bbd169afabca71'})
-            assert 'A conflict happened.' in response.data
+            assert 'A conflict happened in index.rst.jinja2.' in response.data
 
     @with_client
     def test_archive_employee_report(self, client):
@@ -390,6 +588,66 @@ class TestComplete(object):
                         content_type='application/json')
             assert "document" in response.data
 
+    @with_client
+    def test_update_content_merge(self, client):
+        """Test the merge of concurrent updates of a document."""
+        from complete.application import nuts
+        from complete.document import EmployeeDoc
+        old_version = EmployeeDoc(1).version
+
+        def update(part, content):
+            """Update a part of the first version of the document."""
+            response = request(client.post, url_for(
+                '_pynuts_resource_EmployeeDoc_update_content'),
+                data=json.dumps({
+                    'data': [{
+                        'part': part,
+                        'document_type': 'EmployeeDoc',
+                        'document_id': '1',
+                        'version': old_version,
+                        'content': content}],
+                    'message': None, 'author': None, 'author_email': None}),
+                data_content_type='application/json',
+                content_type='application/json')
+            return json.loads(response.data)
+
+        with client.application.test_request_context():
+            response = update('comments', 'comment by Alice')
+            assert response['conflicts'] == []
+            response = update('info', 'info by Bob')
+            assert response['conflicts'] == []
+            document = EmployeeDoc(1)
+            assert document.version == response['documents'][0]['version']
+            assert document.git.read('comments') == 'comment by Alice'
+            assert document.git.read('info') == 'info by Bob'
+
+            response = update('comments', 'comment by Carol')
+            assert response['conflicts'] == [{
+                'document_type': 'EmployeeDoc', 'document_id': '1',
+                'paths': ['comments']}]
+            assert response['documents'][0]['version'] == old_version
+            assert EmployeeDoc(1).version == document.version
+
+            # Lock held by another process
+            repository = nuts.document_repository
+            set_lock_manager(repository, LockManager(repository, timeout=0))
+            lock_path = os.path.join(
+                repository.controldir(), 'pynuts', 'locks',
+                document.git.ref + '.lock')
+            if not os.path.isdir(os.path.dirname(lock_path)):
+                os.makedirs(os.path.dirname(lock_path))
+            lock_file = open(lock_path, 'a')
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                response = update('info', 'info by Dave')
+                assert response['conflicts'] == [{
+                    'document_type': 'EmployeeDoc', 'document_id': '1',
+                    'paths': []}]
+                assert EmployeeDoc(1).version == document.version
+            finally:
+                lock_file.close()
+                set_lock_manager(repository, None)
+
     def test_InvalidId(self):
         """Test InvalidId exception."""
         # Use Document from the vanilla app, not from the test app
@@ -442,4 +700,417 @@ class TestComplete(object):
             return
         raise StandardError('This test must raise ConflictError')
 
+    def test_environment_pool(self):
+        """Test the sharing of Jinja environments between documents."""
+        from complete.document import EmployeeDoc
+        stats = EmployeeDoc.environment_pool.stats()
+        document = EmployeeDoc(1)
+        assert EmployeeDoc(1, document.version).jinja_environment is (
+            document.jinja_environment)
+        assert EmployeeDoc(2).jinja_environment is not (
+            document.jinja_environment)
+        assert EmployeeDoc.environment_pool.stats()['hits'] > stats['hits']
+
+    def test_warm_bytecode_cache(self):
+        """Test the compilation of all the document templates."""
+        from complete.application import nuts
+        # 3 documents with 3 templates each
+        assert nuts.warm_bytecode_cache() == 9
+
+    def test_render_cache(self):
+        """Test the cache of the HTML rendering of documents."""
+        from complete.application import app, nuts
+        from complete.document import EmployeeDoc
+        from complete.view import EmployeeView
+        EmployeeDoc.render_cache = cache = LRUCache(10)
+        EmployeeDoc.render_cache_data = lambda self: {
+            'person_id': self.data['employee'].data.person_id}
+        try:
+            with app.test_request_context():
+                employee = EmployeeView(1)
+                html = EmployeeDoc.generate_html(employee=employee)
+                assert cache.stats()['misses'] == 1
+                assert EmployeeDoc.generate_html(employee=employee) == html
+                assert cache.stats()['hits'] == 1
+                EmployeeDoc.generate_html(employee=employee, editable=False)
+                EmployeeDoc.generate_html(employee=EmployeeView(2))
+                assert cache.stats()['misses'] == 3
+
+                # Pinned versions rendering the latest comments are rendered
+                # again when the comments change
+                version = EmployeeDoc(1).version
+                html = EmployeeDoc.generate_html(
+                    version=version, employee=employee)
+                assert cache.stats()['hits'] == 2
+                git = Git(nuts.document_repository,
+                          branch='documents/EmployeeDoc/1')
+                git.write('comments', 'New comments')
+                git.commit('Alice', 'alice@pynuts.org', 'Comment')
+                new_html = EmployeeDoc.generate_html(
+                    version=version, employee=employee)
+                assert cache.stats()['misses'] == 4
+                assert 'New comments' in new_html['whole']
+                assert 'New comments' not in html['whole']
+        finally:
+            del EmployeeDoc.render_cache, EmployeeDoc.render_cache_data
+
+    @with_client
+    def test_pdf_cache(self, client):
+        """Test the cache and the ETags of PDF documents."""
+        from complete.document import EmployeeDoc
+        EmployeeDoc.pdf_cache = cache = LRUCache(10)
+        EmployeeDoc.render_cache_data = lambda self: {
+            'person_id': self.data['employee'].data.person_id}
+        try:
+            with client.application.test_request_context():
+                url = url_for('pdf_employee', person_id=1)
+                response = request(
+                    client.get, url, content_type='application/pdf')
+                etag = response.headers['ETag']
+                assert cache.stats()['misses'] == 1
+                response = client.get(url, headers={'If-None-Match': etag})
+                assert response.status_code == 304
+                assert cache.stats()['misses'] == 1
+                response = request(
+                    client.get, url, content_type='application/pdf')
+                assert response.headers['ETag'] == etag
+                assert cache.stats()['hits'] == 1
+        finally:
+            del EmployeeDoc.pdf_cache, EmployeeDoc.render_cache_data
+
+    @with_client
+    def test_pdf_jobs(self, client):
+        """Test the PDF rendering jobs."""
+        with client.application.test_request_context():
+            job = {'document_type': 'EmployeeDoc', 'document_id': '1',
+                   'part': 'comments.rst.jinja2'}
+            response = request(
+                client.post, url_for('_pynuts-submit_pdf_job'),
+                data=json.dumps(job), data_content_type='application/json',
+                content_type='application/json')
+            job_id = json.loads(response.data)['id']
+            assert json.loads(response.data)['status'] == 'done'
+            response = request(
+                client.post, url_for('_pynuts-submit_pdf_job'),
+                data=json.dumps(job), data_content_type='application/json',
+                content_type='application/json')
+            assert json.loads(response.data)['id'] == job_id
+            response = request(
+                client.get, url_for('_pynuts-pdf_job_status', job_id=job_id),
+                content_type='application/json')
+            assert json.loads(response.data)['version'] == (
+                '370fc6c4f1cf798e954791d7d9bbd169afabca71')
+            response = request(
+                client.get, url_for('_pynuts-pdf_job_result', job_id=job_id),
+                content_type='application/pdf')
+            assert '%PDF' in response.data[:4]
+            request(client.get, url_for(
+                '_pynuts-pdf_job_status', job_id='unknown'),
+                status_code=404)
+
+    def test_shared_pdf_jobs(self):
+        """Test the PDF jobs shared by the processes of the application."""
+        from complete.application import app, nuts
+        directory = mkdtemp()
+        try:
+            jobs = PDFJobs(nuts, store=FileSystemCache(directory, '.job'))
+            with app.test_request_context():
+                job = jobs.submit(
+                    'EmployeeDoc', '1', part='comments.rst.jinja2')
+            # Jobs of another process
+            other_jobs = PDFJobs(
+                nuts, store=FileSystemCache(directory, '.job'))
+            other_job = other_jobs.get(job.id)
+            assert other_job.as_dict() == job.as_dict()
+            assert '%PDF' in other_job.get_pdf()[:4]
+            assert other_jobs.submit(
+                'EmployeeDoc', '1', part='comments.rst.jinja2').id == job.id
+            assert other_jobs.jobs.get(job.id) is None
+
+            # Jobs rendered by worker processes
+            jobs = PDFJobs(
+                nuts, processes=1, store=FileSystemCache(directory, '.job'))
+            try:
+                job = jobs.submit(
+                    'EmployeeDoc', '2', part='comments.rst.jinja2')
+                for _ in range(300):
+                    if other_jobs.get(job.id).status != 'pending':
+                        break
+                    time.sleep(0.1)
+                assert other_jobs.get(job.id).status == 'done'
+                assert '%PDF' in other_jobs.get(job.id).get_pdf()[:4]
+            finally:
+                jobs.close()
+
+            # PDF files stored in the PDF cache are not stored again
+            from complete.document import EmployeeDoc
+            EmployeeDoc.pdf_cache = cache = LRUCache(10)
+            try:
+                jobs = PDFJobs(nuts, store=FileSystemCache(directory, '.job'))
+                with app.test_request_context():
+                    job = jobs.submit(
+                        'EmployeeDoc', '3', part='comments.rst.jinja2')
+                assert job.pdf_key in cache
+                assert len(cache) == 1
+                assert not os.path.exists(
+                    os.path.join(directory, 'job-%s.job' % job.id))
+                other_job = other_jobs.get(job.id)
+                assert other_job.get_pdf() == cache.get(job.pdf_key)
+            finally:
+                del EmployeeDoc.pdf_cache
+        finally:
+            shutil.rmtree(directory)
+
+        # The URLs of the jobs are only available if enabled
+        app = flask.Flask('other')
+        Pynuts(app)
+        assert '_pynuts-submit_pdf_job' not in app.view_functions
+
+    def test_pdf_batch(self):
+        """Test the generation of PDF documents in batches."""
+        from complete.application import app
+        from complete.document import EmployeeDoc
+        results = list(EmployeeDoc.generate_pdf_batch(
+            ['1', '2', '3'], part='comments.rst.jinja2'))
+        assert [document_id for document_id, _ in results] == ['1', '2', '3']
+        assert all('%PDF' in pdf[:4] for _, pdf in results)
+
+        zip_file = StringIO()
+        EmployeeDoc.write_pdf_zip(
+            zip_file, ['1', '3'], part='comments.rst.jinja2',
+            filename=u'Employee {0}.pdf')
+        assert zipfile.ZipFile(zip_file).namelist() == [
+            'Employee 1.pdf', 'Employee 3.pdf']
+
+        # Batches share the cached PDF documents and keep the settings
+        EmployeeDoc.pdf_cache = cache = LRUCache(10)
+        try:
+            list(EmployeeDoc.generate_pdf_batch(
+                ['1'], part='comments.rst.jinja2'))
+            assert cache.stats()['misses'] == 1
+            with app.test_request_context():
+                document = EmployeeDoc('1')
+                document.data = {}
+                document._generate_batch_pdf(part='comments.rst.jinja2')
+                assert 'stylesheet' not in document.docutils_settings
+                document._generate_pdf(part='comments.rst.jinja2')
+            assert cache.stats()['hits'] == 2
+        finally:
+            del EmployeeDoc.pdf_cache
+
+    def test_list_documents(self):
+        """Test the listing of documents."""
+        from complete.application import nuts
+        from complete.document import EmployeeDoc
+        assert EmployeeDoc.list_document_ids() == ['1', '2', '3']
+        assert EmployeeDoc.list_document_ids(offset=1, limit=1) == ['2']
+        assert EmployeeDoc.list_document_ids(prefix='3') == ['3']
+        summary = EmployeeDoc.list_summaries(limit=1)[0]
+        assert summary.document_id == '1'
+        assert summary.version == '370fc6c4f1cf798e954791d7d9bbd169afabca71'
+        assert summary.author == EmployeeDoc(1).author
+
+        git = Git(nuts.document_repository, branch='documents/EmployeeDoc/4')
+        git.write('index.rst', 'Index')
+        git.commit('Alice', 'alice@pynuts.org', 'Create 4')
+        assert EmployeeDoc.list_document_ids(offset=2) == ['3', '4']
+        assert EmployeeDoc.list_summaries(offset=3)[0].version == git.head.id
+
+    @with_client
+    def test_document_resource(self, client):
+        """Test the resources of documents."""
+        from complete.document import EmployeeDoc
+        document = EmployeeDoc(1)
+        with client.application.test_request_context():
+            response = request(
+                client.get, url_for(
+                    '_pynuts_resource_EmployeeDoc', document_id=1,
+                    version=document.version, filename='logo.png'),
+                content_type='image/png')
+        data = document.git.read('logo.png')
+        assert response.data == data
+        assert response.content_length == len(data)
+        etag = '"%s"' % document.git.blob_id('logo.png')
+        assert response.headers['ETag'] == etag
+        assert 'immutable' in response.headers['Cache-Control']
+
+        with client.application.test_request_context():
+            url = url_for(
+                '_pynuts_resource_EmployeeDoc', document_id=1,
+                version=document.version, filename='logo.png')
+            response = client.get(url, headers={'If-None-Match': etag})
+            assert response.status_code == 304
+            assert response.data == ''
+
+            response = client.get(url, headers={'Range': 'bytes=10-19'})
+            assert response.status_code == 206
+            assert response.data == data[10:20]
+            assert response.headers['Content-Range'] == (
+                'bytes 10-19/%i' % len(data))
+            response = client.get(url, headers={
+                'Range': 'bytes=-10', 'If-Range': etag})
+            assert response.status_code == 206
+            assert response.data == data[-10:]
+            response = client.get(url, headers={
+                'Range': 'bytes=10-19', 'If-Range': '"other"'})
+            assert response.status_code == 200
+            assert response.data == data
+            response = client.get(url, headers={
+                'Range': 'bytes=%i-' % len(data)})
+            assert response.status_code == 416
+
+            response = client.get(url_for(
+                '_pynuts_resource_EmployeeDoc', document_id=1,
+                version=document.version, filename='missing.png'))
+            assert response.status_code == 404
+            response = client.get(url_for(
+                '_pynuts_resource_EmployeeDoc', document_id=1,
+                version='HEAD', filename='logo.png'))
+            assert response.status_code == 404
+
+    def test_model_tree(self):
+        """Test the cache of the model tree."""
+        from complete.application import nuts
+        from complete.document import EmployeeDoc
+        model_path = EmployeeDoc.model_path
+        temp_path = os.path.join(mkdtemp(), 'models')
+        shutil.copytree(model_path, temp_path)
+        try:
+            EmployeeDoc.model_path = temp_path
+            tree = EmployeeDoc.model_tree()
+            assert tree.id == Git(nuts.document_repository).store_directory(
+                model_path).id
+            assert EmployeeDoc._model_tree[2] == tree.id
+            assert EmployeeDoc.model_tree() is EmployeeDoc.model_tree()
+
+            # Recently modified files are not trusted
+            with open(os.path.join(temp_path, 'style.css'), 'a') as css:
+                css.write('/* Modified */')
+            new_tree_id = EmployeeDoc.model_tree().id
+            assert new_tree_id != tree.id
+            assert EmployeeDoc._model_tree[2] == tree.id
+            os.utime(os.path.join(temp_path, 'style.css'), (0, 0))
+            assert EmployeeDoc.model_tree().id == new_tree_id
+            assert EmployeeDoc._model_tree[2] == new_tree_id
+        finally:
+            EmployeeDoc.model_path = model_path
+            shutil.rmtree(os.path.dirname(temp_path))
+
+    def test_create_many(self):
+        """Test the creation of documents in batches."""
+        from complete.application import nuts
+        from complete.document import EmployeeDoc
+        Data = namedtuple('Data', 'person_id')
+        Employee = namedtuple('Employee', 'data')
+        repository = nuts.document_repository
+        packs = len(repository.object_store.packs)
+
+        results = EmployeeDoc.create_many(
+            [{'employee': Employee(Data(person_id))}
+             for person_id in (10, 1, 11, 10)],
+            author_name='Alice', author_email='alice@pynuts.org')
+        assert [document_id for document_id, _ in results] == [
+            '10', '1', '11', '10']
+        assert [version is None for _, version in results] == [
+            False, True, False, True]
+        assert len(repository.object_store.packs) == packs + 1
+        assert EmployeeDoc(10).version == results[0][1]
+        assert EmployeeDoc(11).author == u'Alice <alice@pynuts.org>'
+        assert EmployeeDoc(11).message == u'Create 11'
+        assert EmployeeDoc(11).git.tree.id == EmployeeDoc.model_tree().id
+        assert EmployeeDoc(1).version == (
+            '370fc6c4f1cf798e954791d7d9bbd169afabca71')
+        assert EmployeeDoc.list_document_ids() == ['1', '10', '11', '2', '3']
+
+        # Packed documents can be edited
+        git = EmployeeDoc(10).git
+        git.write('index.rst', 'Index')
+        git.commit('Bob', 'bob@pynuts.org', 'Edit 10')
+        assert EmployeeDoc(10).version == git.head.id
+        assert EmployeeDoc.create_many(
+            [{'employee': Employee(Data(10))}]) == [('10', None)]
+
+    def test_maintenance(self):
+        """Test the maintenance of the document repository."""
+        from complete.application import nuts
+        from complete.document import EmployeeDoc
+        version = EmployeeDoc(1).version
+        stats = nuts.maintain_repository()
+        assert stats['packed_refs'] == 4
+        assert stats['packed_objects'] > 0
+        assert EmployeeDoc(1).version == version
+        assert EmployeeDoc.list_document_ids() == ['1', '2', '3']
+
+        maintenance = Maintenance(nuts, commits=2)
+        git = EmployeeDoc(1).git
+        git.write('index.rst', 'Index')
+        git.commit('Alice', 'alice@pynuts.org', 'Edit 1')
+        maintenance.commit_hook(git)
+        assert maintenance._thread is None
+        maintenance.commit_hook(git)
+        maintenance._thread.join()
+        assert maintenance.last_stats['packed_refs'] == 1
+        assert EmployeeDoc(1).version == git.head.id
+
+    def test_document_registry(self):
+        """Test the documents shared by the directives of a rendering."""
+        from complete.application import app, nuts
+        from complete.document import EmployeeDoc
+        from complete.view import EmployeeView
+        git = EmployeeDoc(1).git
+        git.write('comments', 'Shared comment')
+        git.commit('Alice', 'alice@pynuts.org', 'Add comments')
+        path = u'EmployeeDoc/1/%s' % git.head.id
+
+        registry = DocumentRegistry(nuts)
+        registry.prefetch(
+            u'.. editable:: %s/comments\n\n.. content:: %s/Employee\n'
+            u'   :renderer: employee\n' % (path, path))
+        document = registry.document(u'EmployeeDoc', u'1', git.head.id)
+        assert registry._contents[
+            (u'EmployeeDoc', u'1', git.head.id)] == {
+                u'comments': u'Shared comment'}
+        assert registry.read(
+            u'EmployeeDoc', u'1', git.head.id, u'comments') == (
+                u'Shared comment')
+        try:
+            registry.read(u'EmployeeDoc', u'1', git.head.id, u'Employee')
+        except NotFoundError:
+            pass
+        else:
+            raise StandardError('This test must raise NotFoundError')
+        assert registry.document(
+            u'EmployeeDoc', u'1', git.head.id) is document
+
+        with app.test_request_context():
+            html = EmployeeDoc.generate_html(
+                employee=EmployeeView(1))['article']
+        assert 'Shared comment' in html
+        assert 'Edit this !' in html
+
+    def test_history_summaries(self):
+        """Test the history summaries of a document."""
+        from complete.application import nuts
+        from complete.document import EmployeeDoc
+        first = EmployeeDoc(1, version=EmployeeDoc(1).version)
+        git = Git(nuts.document_repository, branch=first.branch)
+        git.write('index.rst', 'Index')
+        git.commit('Alice', 'alice@pynuts.org', 'Edit 1')
+
+        document = EmployeeDoc(1)
+        versions = [doc.version for doc in document.history]
+        assert versions == [git.head.id, first.version]
+        summaries = document.history_summaries()
+        assert [summary.version for summary in summaries] == versions
+        assert summaries[0].author == u'Alice <alice@pynuts.org>'
+        assert summaries[1].datetime == first.datetime
+        assert summaries[1].author == first.author
+        assert document.history_summaries(offset=1, limit=1) == summaries[1:]
+        assert document.history_summaries(since=summaries[0].datetime) == (
+            summaries[:1])
+        assert document.history_summaries(until=first.datetime) == (
+            summaries[1:])
+        assert [summary.version for summary in document.history_summaries(
+            archive=True)] == [doc.version for doc in document.archive_history]
+
 # pylint: enable=R0201,W0613
@@ -1,15 +1,26 @@
 """ Test suite of the Git module. """
 
 import os.path
+import fcntl
 import unittest
 import shutil
 import tempfile
+import threading
 
 import jinja2
 
+from pynuts.cache import LRUCache
+from pynuts.environment import create_environment, BlobBytecodeCache
 from pynuts.git import (Git, ObjectTypeError, NotFoundError,
-                        ConflictError)
-from dulwich.repo import Repo
+                        ConflictError, MergeConflictError, object_cache,
+                        history_index, BlobReader, CHUNK_SIZE,
+                        add_packed_refs, LockManager, LockTimeoutError,
+                        set_lock_manager, read_object, add_commit_hook,
+                        remove_commit_hook)
+from pynuts import dulwich_internals, maintenance
+from pynuts.maintenance import maintain, main
+from dulwich.objects import hex_to_filename
+from dulwich.repo import Repo, Commit, Blob
 
 
 class TestGit(unittest.TestCase):
@@ -97,3 +108,488 @@ class TestGit(unittest.TestCase):
         git = Git(repo, branch='inexistent')
         git.tree = git.store_directory(os.path.join(self.tempdir, 'refs'))
         assert git.read('heads/master').strip() == commit_2
+
+    def test_object_cache(self):
+        """Test the git objects cache shared by Git objects."""
+        cache = LRUCache(10, sizeof=len)
+        cache.set('a', 'aaaa')
+        cache.set('b', 'bbbb')
+        assert cache.get('a') == 'aaaa'
+        cache.set('c', 'cccc')  # 'b' is the least recently used
+        assert cache.get('b') is None
+        assert cache.get('c') == 'cccc'
+        cache.set('d', 'd' * 11)  # Too big to be cached
+        assert 'd' not in cache
+        assert cache.stats() == {
+            'hits': 2, 'misses': 1, 'entries': 2, 'size': 8, 'max_size': 10}
+
+        repo = Repo.init_bare(self.tempdir)
+        git = Git(repo, branch='master')
+        git.write('templates/hello.jinja', self.hello1_content)
+        git.commit('Alice', 'alice@pynuts.org', 'First commit')
+        tree = git.tree
+
+        cache = object_cache(repo)
+        assert object_cache(Repo(self.tempdir)) is cache
+        hits = cache.hits
+        git = Git(repo, branch='master')
+        assert git.read('templates/hello.jinja') == self.hello1_content
+        git2 = Git(repo, branch='master')
+        assert git2.read('templates/hello.jinja') == self.hello1_content
+        assert cache.hits > hits
+
+        # Cached trees are never modified in place
+        git.write('templates/hello.jinja', self.name_content)
+        assert git2.read('templates/hello.jinja') == self.hello1_content
+        assert git2.tree.id == tree.id
+
+    def test_path_index(self):
+        """Test the listing of paths from the path index of a tree."""
+        repo = Repo.init_bare(self.tempdir)
+        git = Git(repo, branch='master')
+        assert git.list_paths() == []
+        git.write('templates/hello.jinja', self.hello2_content)
+        git.write('templates/sub/name.jinja', self.name_content)
+        git.write('index.rst', 'Index')
+        git.commit('Alice', 'alice@pynuts.org', 'First commit')
+
+        git = Git(repo, branch='master')
+        assert git.list_paths() == [
+            'index.rst', 'templates/hello.jinja', 'templates/sub/name.jinja']
+        assert git.list_paths('/templates/sub/') == [
+            'templates/sub/name.jinja']
+        assert [path for path, _, _ in git.walk()] == git.list_paths()
+        path, mode, sha = list(git.walk())[0]
+        assert mode == 0100644
+        assert repo[sha].data == 'Index'
+        assert git.read('templates/sub/name.jinja') == self.name_content
+
+        # The index is shared by Git objects on the same tree
+        git2 = Git(repo, commit=git.head.id)
+        assert git2._path_index() is git._path_index()
+
+        git.write('templates/sub/name.jinja', 'Pynuts')
+        assert git.read('templates/sub/name.jinja') == 'Pynuts'
+        assert git2.read('templates/sub/name.jinja') == self.name_content
+
+    def test_history_index(self):
+        """Test the paged and time-range queries of the history index."""
+        repo = Repo.init_bare(self.tempdir)
+        git = Git(repo, branch='master')
+        tree_id = git.tree.id
+        repo.object_store.add_object(git.tree)
+
+        def store_commits(times, parent=None):
+            """Store commits made at `times` and return their IDs."""
+            ids = []
+            for commit_time in times:
+                commit = Commit()
+                commit.author = commit.committer = 'Alice <alice@pynuts.org>'
+                commit.author_time = commit.commit_time = commit_time
+                commit.author_timezone = commit.commit_timezone = 0
+                commit.message = 'Commit at %i\nDetails' % commit_time
+                commit.tree = tree_id
+                commit.parents = [parent] if parent else []
+                repo.object_store.add_object(commit)
+                parent = commit.id
+                ids.append(commit.id)
+            return ids
+
+        # Commits made without Git.commit are indexed when reading
+        ids = store_commits(range(1000, 1010))
+        repo.refs['refs/heads/master'] = ids[-1]
+        git = Git(repo, branch='master')
+        assert list(git.history()) == ids[::-1]
+        assert list(git.history(offset=2, limit=3)) == ids[7:4:-1]
+        assert list(git.history(offset=8, limit=5)) == ids[1::-1]
+        entries = git.history_entries(since=1003, until=1005)
+        assert [entry.id for entry in entries] == ids[5:2:-1]
+        assert entries[0].parent == ids[4]
+        assert entries[0].commit_time == 1005
+        assert entries[0].author == 'Alice <alice@pynuts.org>'
+        assert entries[0].message == 'Commit at 1005\nDetails'
+        assert git.history_entries(limit=1, until=999) == []
+        assert git.history_entries()[-1].parent is None
+
+        # Older commits are read without the index
+        old_git = Git(repo, branch='master', commit=ids[4])
+        assert list(old_git.history(offset=1, limit=2)) == [ids[3], ids[2]]
+        assert next(old_git.history()) == ids[4]
+        assert old_git.history_entries(since=1002, until=1003) == (
+            git.history_entries(since=1002, until=1003))
+
+        # Commits are appended
+        git.commit('Bob', 'bob@pynuts.org', 'New commit')
+        index = history_index(repo, 'refs/heads/master')
+        assert os.path.getsize(index.index_path) == 11 * index.record.size
+        assert list(git.history()) == [git.head.id] + ids[::-1]
+        assert git.history_entries(limit=1)[0].author == (
+            'Bob <bob@pynuts.org>')
+
+        # The index is rebuilt when the branch is rewritten
+        new_ids = store_commits(range(2000, 2003))
+        repo.refs['refs/heads/master'] = new_ids[-1]
+        git = Git(repo, branch='master')
+        assert list(git.history()) == new_ids[::-1]
+        assert os.path.getsize(index.index_path) == 3 * index.record.size
+
+    def test_streaming_blobs(self):
+        """Test the storage and the reading of blobs by chunks."""
+        os.mkdir(os.path.join(self.tempdir, 'repo'))
+        repo = Repo.init_bare(os.path.join(self.tempdir, 'repo'))
+        git = Git(repo, branch='master')
+        content = ''.join(chr(i % 251) for i in xrange(3 * CHUNK_SIZE + 7))
+        filename = os.path.join(self.tempdir, 'big.bin')
+        with open(filename, 'wb') as big_file:
+            big_file.write(content)
+
+        blob = git.store_file(filename)
+        blob_id = blob.id
+        assert blob_id == Blob.from_string(content).id
+        assert blob.data == content
+        assert repo[blob_id].data == content
+        # Storing the same file again keeps the same object
+        assert git.store_file(filename).id == blob_id
+
+        git.tree.add('big.bin', 0100644, blob_id)
+        with git.open('big.bin') as blob_file:
+            assert isinstance(blob_file, BlobReader)
+            assert blob_file.size == len(content)
+            assert blob_file.read(10) == content[:10]
+            assert blob_file.read(CHUNK_SIZE) == content[10:CHUNK_SIZE + 10]
+            assert blob_file.read() == content[CHUNK_SIZE + 10:]
+            assert blob_file.read() == ''
+
+        # Cached objects are read from memory
+        git.write('small.txt', 'Small')
+        git.read('small.txt')
+        blob_file = git.open('small.txt')
+        assert not isinstance(blob_file, BlobReader)
+        assert (blob_file.read(), blob_file.size) == ('Small', 5)
+        self.assertRaises(NotFoundError, git.open, 'missing.txt')
+
+    def test_packed_refs(self):
+        """Test the creation of packed refs."""
+        repo = Repo.init_bare(self.tempdir)
+        git = Git(repo, branch='master')
+        git.write('index.rst', 'Index')
+        git.commit('Alice', 'alice@pynuts.org', 'First commit')
+        # Packed refs are kept in memory by the other repository object
+        other_repo = Repo(self.tempdir)
+        assert Git(other_repo, branch='packed').head is None
+
+        commit = git.head.id
+        assert add_packed_refs(repo, {
+            'refs/heads/master': commit, 'refs/heads/packed': commit,
+        }) == set(['refs/heads/master'])
+        assert Git(other_repo, branch='packed').head.id == commit
+        assert add_packed_refs(repo, {
+            'refs/heads/packed': commit}) == set(['refs/heads/packed'])
+
+        git = Git(repo, branch='packed')
+        git.write('index.rst', 'New index')
+        git.commit('Bob', 'bob@pynuts.org', 'Second commit')
+        assert Git(other_repo, branch='packed').head.id == git.head.id
+
+    def test_maintenance(self):
+        """Test the packing and the pruning of the repository."""
+        repo = Repo.init_bare(self.tempdir)
+        git = Git(repo, branch='master')
+        versions = []
+        for i in range(5):
+            content = self.hello2_content * 20 + 'Version %i' % i
+            git.write('templates/hello.jinja2', content)
+            git.write('image.png', 'PNG %i' % i)
+            git.commit('Alice', 'alice@pynuts.org', 'Commit %i' % i)
+            versions.append((git.head.id, content))
+
+        # Objects of a conflicting commit
+        old_git = Git(repo, branch='master', commit=versions[0][0])
+        old_git.write('index.rst', 'Lost')
+        old_commit = old_git.store_commit(
+            old_git.tree.id, 'Bob', 'bob@pynuts.org', 'Lost', [])
+        lost = [old_commit.id, old_git.tree.id, old_git.blob_id('index.rst')]
+        for sha in lost[:2]:
+            os.utime(hex_to_filename(repo.object_store.path, sha), (0, 0))
+
+        stats = maintain(repo, grace_period=60)
+        assert stats['packed_refs'] == 1
+        assert stats['packed_objects'] == 5 * 5
+        assert stats['pruned_objects'] == 2
+        assert stats['bytes_reclaimed'] > 0
+        # Recent unreachable objects are kept, including the intermediate
+        # trees stored by write
+        loose = list(repo.object_store._iter_loose_objects())
+        assert lost[2] in loose
+        assert len(loose) == stats['loose_objects'] - 5 * 5 - 2
+        assert not os.path.exists(os.path.join(
+            self.tempdir, 'refs', 'heads', 'master'))
+
+        repo = Repo(self.tempdir)
+        assert old_commit.id not in repo.object_store
+        git = Git(repo, branch='master')
+        assert list(git.history()) == [commit for commit, _ in versions[::-1]]
+        for commit, content in versions:
+            git = Git(repo, commit=commit)
+            assert git.read('templates/hello.jinja2') == content
+
+        # Old unreachable objects written again are touched, and kept
+        git = Git(repo, branch='master')
+        path = hex_to_filename(repo.object_store.path, lost[2])
+        os.utime(path, (0, 0))
+        git.write('index.rst', 'Lost')
+        assert os.path.getmtime(path) > 0
+        assert maintain(repo, grace_period=60)['pruned_objects'] == 0
+        git.commit('Alice', 'alice@pynuts.org', 'Lost again')
+        assert Git(Repo(self.tempdir), branch='master').read(
+            'index.rst') == 'Lost'
+
+        # Readers list the packs again when an object is missing
+        other_repo = Repo(self.tempdir)
+        other_repo.object_store.packs
+        other_repo.object_store._pack_cache_time = float('inf')
+        git = Git(repo, branch='master')
+        git.write('index.rst', 'Index')
+        git.commit('Alice', 'alice@pynuts.org', 'Commit after packing')
+        assert main([self.tempdir, '--grace-period', '0']) == 0
+        repo = Repo(self.tempdir)
+        assert list(repo.object_store._iter_loose_objects()) == []
+        assert Git(repo, branch='master').read('index.rst') == 'Index'
+        object_cache(other_repo).clear()
+        assert read_object(other_repo, git.head.id).id == git.head.id
+
+        # Packs are merged instead of piling up
+        packs = len(repo.object_store.packs)
+        maintenance.MAX_PACKS = packs
+        try:
+            git.write('index.rst', 'Merged')
+            git.commit('Alice', 'alice@pynuts.org', 'Commit before merging')
+            stats = maintain(repo, grace_period=0)
+            assert stats['merged_packs'] == packs
+        finally:
+            maintenance.MAX_PACKS = 8
+        repo = Repo(self.tempdir)
+        assert len(repo.object_store.packs) == 1
+        git = Git(repo, branch='master')
+        assert git.read('index.rst') == 'Merged'
+        for commit, content in versions:
+            git = Git(repo, commit=commit)
+            assert git.read('templates/hello.jinja2') == content
+
+        # Missing internals of Dulwich are reported
+        class Store(object):
+            """Object store without the internals of Dulwich."""
+        try:
+            dulwich_internals.forget_packs(Store())
+        except dulwich_internals.UnsupportedDulwichError as exception:
+            assert 'Store._pack_cache' in str(exception)
+        else:
+            raise AssertionError('Missing internals must be reported')
+
+    def test_commit_hooks(self):
+        """Test the hooks called after commits."""
+        repo = Repo.init_bare(self.tempdir)
+        calls = []
+        add_commit_hook(repo, lambda git: calls.append('first'), 'hook')
+        add_commit_hook(repo, lambda git: calls.append('second'), 'hook')
+        hook = lambda git: calls.append('other')
+        add_commit_hook(repo, hook)
+        add_commit_hook(repo, hook)
+        try:
+            git = Git(repo, branch='master')
+            git.write('index.rst', 'Index')
+            git.commit('Alice', 'alice@pynuts.org', 'First commit')
+            assert calls == ['second', 'other']
+            remove_commit_hook(repo, 'hook')
+            remove_commit_hook(repo, hook)
+            git.write('index.rst', 'New index')
+            git.commit('Alice', 'alice@pynuts.org', 'Second commit')
+            assert calls == ['second', 'other']
+        finally:
+            remove_commit_hook(repo, 'hook')
+            remove_commit_hook(repo, hook)
+
+    def test_batch(self):
+        """Test the writes staged in a batch."""
+        repo = Repo.init_bare(self.tempdir)
+        git = Git(repo, branch='master')
+        git.write('templates/hello.jinja', self.hello1_content)
+        git.commit('Alice', 'alice@pynuts.org', 'First commit')
+
+        loose = set(repo.object_store._iter_loose_objects())
+        with git.batch():
+            for i in range(40):
+                git.write('parts/%i/part.rst' % (i % 4), 'Part %i' % i)
+            git.write('templates/sub/name.jinja', self.name_content)
+            assert set(repo.object_store._iter_loose_objects()) - loose == (
+                set(Blob.from_string('Part %i' % i).id for i in range(40))
+                | set([Blob.from_string(self.name_content).id]))
+            assert git.read('parts/1/part.rst') == 'Part 37'
+            assert git.read('templates/hello.jinja') == self.hello1_content
+            self.assertRaises(ObjectTypeError, git.read, 'parts/1')
+            self.assertRaises(ObjectTypeError, git.write, 'parts', 'foo')
+            self.assertRaises(
+                ObjectTypeError, git.write, 'parts/1/part.rst/foo', 'foo')
+            git.commit('Alice', 'alice@pynuts.org', 'Second commit')
+        # Root, parts, 4 part directories, templates and templates/sub
+        new_objects = set(repo.object_store._iter_loose_objects()) - loose
+        assert len([sha for sha in new_objects
+                    if repo[sha].type_name == 'tree']) == 8
+
+        git = Git(repo, branch='master')
+        assert git.list_paths() == [
+            'parts/0/part.rst', 'parts/1/part.rst', 'parts/2/part.rst',
+            'parts/3/part.rst', 'templates/hello.jinja',
+            'templates/sub/name.jinja']
+
+        # Writes are dropped when an exception is raised
+        def failing_batch():
+            """Write in a batch and fail."""
+            with git.batch():
+                git.write('index.rst', 'Index')
+                raise ValueError
+        self.assertRaises(ValueError, failing_batch)
+        self.assertRaises(NotFoundError, git.read, 'index.rst')
+        assert git.tree.id == git.head.tree
+
+    def test_merge(self):
+        """Test the merge of concurrent commits."""
+        repo = Repo.init_bare(self.tempdir)
+        git = Git(repo, branch='master')
+        git.write('parts/1.rst', 'Part 1')
+        git.write('parts/2.rst', 'Part 2')
+        git.commit('Alice', 'alice@pynuts.org', 'First commit')
+        first_commit = git.head.id
+
+        git1 = Git(repo, branch='master', commit=first_commit)
+        git1.write('parts/1.rst', 'Part 1 by Alice')
+        git1.commit('Alice', 'alice@pynuts.org', 'Edit part 1')
+        git2 = Git(repo, branch='master', commit=first_commit)
+        git2.write('parts/2.rst', 'Part 2 by Bob')
+        git2.write('parts/3.rst', 'Part 3 by Bob')
+        self.assertRaises(ConflictError, git2.commit,
+                          'Bob', 'bob@pynuts.org', 'Edit part 2')
+        git2.commit('Bob', 'bob@pynuts.org', 'Edit part 2', merge=True)
+        assert git2.head.parents == [git1.head.id]
+
+        git = Git(repo, branch='master')
+        assert git.head.id == git2.head.id
+        assert git.read('parts/1.rst') == 'Part 1 by Alice'
+        assert git.read('parts/2.rst') == 'Part 2 by Bob'
+        assert git.read('parts/3.rst') == 'Part 3 by Bob'
+
+        # Same changes are not conflicts
+        git3 = Git(repo, branch='master', commit=first_commit)
+        git3.write('parts/1.rst', 'Part 1 by Alice')
+        git3.commit('Alice', 'alice@pynuts.org', 'Edit part 1', merge=True)
+        assert git3.tree.id == git.tree.id
+
+        git4 = Git(repo, branch='master', commit=first_commit)
+        git4.write('parts/1.rst', 'Part 1 by Carol')
+        git4.write('parts/2.rst', 'Part 2 by Carol')
+        git4.write('parts/4.rst', 'Part 4 by Carol')
+        with self.assertRaises(MergeConflictError) as context:
+            git4.commit('Carol', 'carol@pynuts.org', 'Edit', merge=True)
+        assert sorted(context.exception.paths) == [
+            'parts/1.rst', 'parts/2.rst']
+        assert Git(repo, branch='master').head.id == git3.head.id
+
+    def test_branch_locks(self):
+        """Test the serialization of the commits of each branch."""
+        repo = Repo.init_bare(self.tempdir)
+        manager = LockManager(repo, timeout=0.05)
+        set_lock_manager(repo, manager)
+        try:
+            git = Git(repo, branch='master')
+            with git.lock():
+                git.write('hello.jinja', self.hello1_content)
+                git.commit('Alice', 'alice@pynuts.org', 'First commit')
+            assert manager.stats()['acquired'] == 1
+            assert manager.stats()['contended'] == 0
+
+            # Lock held by another process
+            lock_file = open(os.path.join(
+                self.tempdir, 'pynuts', 'locks', 'refs', 'heads',
+                'master.lock'), 'a')
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            git.write('hello.jinja', self.hello2_content)
+            self.assertRaises(LockTimeoutError, git.commit,
+                              'Alice', 'alice@pynuts.org', 'Second commit')
+            assert manager.stats()['timeouts'] == 1
+            assert manager.stats()['wait_time'] >= 0.05
+
+            # Other branches are not locked
+            other = Git(repo, branch='other')
+            other.write('hello.jinja', self.hello1_content)
+            other.commit('Bob', 'bob@pynuts.org', 'First commit')
+
+            # Commits wait for the lock
+            manager.timeout = None
+            thread = threading.Thread(target=git.commit, args=(
+                'Alice', 'alice@pynuts.org', 'Second commit'))
+            thread.start()
+            thread.join(0.1)
+            assert thread.is_alive()
+            lock_file.close()
+            thread.join()
+            assert Git(repo, branch='master').read('hello.jinja') == (
+                self.hello2_content)
+            stats = manager.stats()
+            assert stats['acquired'] == 3
+            assert stats['contended'] == 2
+            assert stats['max_wait_time'] >= 0.1
+        finally:
+            set_lock_manager(repo, None)
+
+    def test_bytecode_cache(self):
+        """Test the bytecode cache of templates stored in git."""
+        os.mkdir(os.path.join(self.tempdir, 'repo'))
+        repo = Repo.init_bare(os.path.join(self.tempdir, 'repo'))
+        cache_directory = os.path.join(self.tempdir, 'cache')
+        os.mkdir(cache_directory)
+        git = Git(repo, branch='master')
+        git.write('hello.jinja', self.hello1_content)
+        git.commit('Alice', 'alice@pynuts.org', 'First commit')
+        git2 = Git(repo, branch='master')
+        git2.write('index.rst', 'Index')
+        git2.commit('Bob', 'bob@pynuts.org', 'Second commit')
+
+        environment = create_environment(
+            git.jinja_loader(), BlobBytecodeCache(cache_directory))
+        template = environment.get_template('hello.jinja')
+        assert template.render() == self.hello1_content
+        assert environment.compile_time > 0
+        assert len(os.listdir(cache_directory)) == 1
+
+        # Same template in another commit, with a cold environment
+        environment = create_environment(
+            git2.jinja_loader(), BlobBytecodeCache(cache_directory))
+        template = environment.get_template('hello.jinja')
+        assert template.render() == self.hello1_content
+        assert environment.compile_time == 0
+
+        # Environments with other settings don't share the compiled code
+        environment = create_environment(
+            git2.jinja_loader(), BlobBytecodeCache(cache_directory))
+        environment.autoescape = True
+        template = environment.get_template('hello.jinja')
+        assert environment.compile_time > 0
+        assert len(os.listdir(cache_directory)) == 2
+
+    def test_show_on_match(self):
+        """Test the showonmatch tag with stored templates."""
+        repo = Repo.init_bare(self.tempdir)
+        git = Git(repo, branch='master')
+        git.write('list.jinja', (
+            "{% showonmatch selector %}<ul>{% for item in items %}"
+            "<li class='item'>{{ item }}</li>{% endfor %}</ul>"
+            "{% else %}Empty{% endshowonmatch %}"))
+        git.commit('Alice', 'alice@pynuts.org', 'First commit')
+        template = create_environment(git.jinja_loader()).get_template(
+            'list.jinja')
+        for selector in ('ul li', 'ul li.item', 'li'):
+            assert template.render(selector=selector, items=[]) == 'Empty'
+            assert template.render(
+                selector=selector, items=range(1000)).count('<li') == 1000
+        assert template.render(selector='ol li', items=[1]) == 'Empty'
+        assert template.render(selector='ul ul li', items=[1]) == 'Empty'